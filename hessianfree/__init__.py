@@ -1,17 +1,49 @@
-import os
-try:
-    import pycuda
-    import skcuda
+import sys
 
-    gpu_enabled = True
-    from hessianfree import gpu
-except ImportError:
-    gpu_enabled = False
-
-from hessianfree import nonlinearities, optimizers, dataplotter, loss_funcs
+from hessianfree import (nonlinearities, optimizers, loss_funcs, solvers,
+                         fileio, inference, connections, plan, precision)
 from hessianfree import nonlinearities as nl
 from hessianfree import optimizers as opt
 from hessianfree.ffnet import FFNet
 from hessianfree.rnnet import RNNet
 from hessianfree.version import __version__
-from hessianfree import demos
+
+# note: these modules pull in heavy dependencies (matplotlib, pycuda), so they
+# are only imported when they are first accessed (on Python >= 3.7)
+_lazy_modules = ("demos", "dataplotter", "gpu")
+
+
+def _check_gpu():
+    """Returns True if the GPU packages (PyCUDA and scikit-cuda) are
+    installed."""
+
+    try:
+        import pycuda
+        import skcuda
+    except ImportError:
+        return False
+
+    return True
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _lazy_modules:
+            import importlib
+            return importlib.import_module("hessianfree." + name)
+        if name == "gpu_enabled":
+            global gpu_enabled
+            gpu_enabled = _check_gpu()
+            return gpu_enabled
+
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+
+    def __dir__():
+        return sorted(list(globals().keys()) + list(_lazy_modules) +
+                      ["gpu_enabled"])
+else:
+    gpu_enabled = _check_gpu()
+    if gpu_enabled:
+        from hessianfree import gpu
+    from hessianfree import dataplotter, demos
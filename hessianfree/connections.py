@@ -0,0 +1,460 @@
+"""Connection types, which define how the weights between two layers are
+stored in the parameter vector and how they are applied.
+
+Connection types are specified via the ``conn_types`` parameter of
+:class:`.FFNet`.
+"""
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+
+def issparse(x):
+    """Check whether ``x`` is a :mod:`scipy:scipy.sparse` matrix.
+
+    Note: this does not import scipy (if scipy.sparse hasn't been imported
+    then ``x`` can't be a sparse matrix).
+    """
+
+    sparse = sys.modules.get("scipy.sparse", None)
+    return sparse is not None and sparse.issparse(x)
+
+
+def _sparse_out(result, out):
+    """Write the result of a sparse product into ``out`` (if given)."""
+
+    if issparse(result):
+        result = result.toarray()
+    if out is None:
+        return np.asarray(result)
+    out[...] = result
+    return out
+
+
+class Connection(object):
+    """Base class for connection types.
+
+    The weights for each connection are stored as a flat section of the
+    overall parameter vector (followed by the biases for the post layer).
+    Subclasses define how that flat vector is interpreted.
+    """
+
+    def n_weights(self, pre, post):
+        """Number of weights (not including biases) in the parameter vector.
+
+        :param int pre: size of the presynaptic layer
+        :param int post: size of the postsynaptic layer
+        """
+
+        raise NotImplementedError()
+
+    def reshape(self, W, pre, post):
+        """Convert the flat weights into the structure used by :meth:`dot`,
+        :meth:`dot_T`, and :meth:`grad` (this should return a view of ``W``,
+        not a copy).
+
+        :param W: flat weight vector for this connection
+        :type W: :class:`~numpy:numpy.ndarray`
+        :param int pre: size of the presynaptic layer
+        :param int post: size of the postsynaptic layer
+        """
+
+        raise NotImplementedError()
+
+    def dot(self, x, W, out=None):
+        """Apply the weights to the presynaptic activities.
+
+        :param x: presynaptic activities, shape ``(batch_size, pre)`` (this
+            may be a :mod:`scipy:scipy.sparse` matrix for connections from the
+            input layer)
+        :param W: weights (from :meth:`reshape`)
+        :param out: if not None, write the output to this array
+        :returns: postsynaptic input, shape ``(batch_size, post)``
+        """
+
+        raise NotImplementedError()
+
+    def dot_T(self, d, W, out=None):
+        """Apply the transposed weights to the postsynaptic error.
+
+        :param d: postsynaptic error, shape ``(batch_size, post)``
+        :param W: weights (from :meth:`reshape`)
+        :param out: if not None, write the output to this array
+        :returns: presynaptic error, shape ``(batch_size, pre)``
+        """
+
+        raise NotImplementedError()
+
+    def grad(self, x, d, out):
+        """Compute the gradient of the weights (summed over the batch).
+
+        :param x: presynaptic activities, shape ``(batch_size, pre)`` (may be
+            sparse, as in :meth:`dot`)
+        :param d: postsynaptic error, shape ``(batch_size, post)``
+        :param out: gradient output (from :meth:`reshape`)
+        """
+
+        raise NotImplementedError()
+
+    def init_weights(self, rng, pre, post, init_type="sparse", coeff=1.0):
+        """Generate initial values for the weights (not including biases).
+
+        :param rng: random number generator
+        :type rng: :class:`~numpy:numpy.random.RandomState`
+        :param int pre: size of the presynaptic layer
+        :param int post: size of the postsynaptic layer
+        :param str init_type: type of initialization (see
+            :meth:`.FFNet.init_weights`)
+        :param float coeff: scales the magnitude of the weights
+        :returns: flat vector of weights
+        """
+
+        raise NotImplementedError()
+
+    def get_config(self):
+        """Return the constructor arguments for this connection (used to
+        save it in a model file, see :func:`.fileio.save_model`)."""
+
+        return {}
+
+
+class Dense(Connection):
+    """All-to-all connection (the weights are a ``(pre, post)`` matrix).
+
+    This is the default connection type.  Note that :class:`.FFNet`
+    handles the initialization of dense connections itself (see
+    :meth:`.FFNet.init_weights`).
+    """
+
+    def n_weights(self, pre, post):
+        return pre * post
+
+    def reshape(self, W, pre, post):
+        return W.reshape((pre, post))
+
+    def dot(self, x, W, out=None):
+        if issparse(x):
+            return _sparse_out(x.dot(W), out)
+        return np.dot(x, W, out=out)
+
+    def dot_T(self, d, W, out=None):
+        return np.dot(d, W.T, out=out)
+
+    def grad(self, x, d, out):
+        if issparse(x):
+            # note: sparse-dense product, so only the nonzero inputs
+            # contribute any computation
+            return _sparse_out(x.T.dot(d), out)
+        return np.dot(x.T, d, out=out)
+
+
+class Sparse(Connection):
+    """Connection with a fixed sparsity pattern.
+
+    Only the weights for the connections that exist are stored in the
+    parameter vector, and they are applied using sparse matrix products,
+    so the cost of the connection is proportional to the number of
+    connections rather than ``pre * post``.
+
+    Requires scipy.
+
+    :param pattern: ``(pre, post)`` matrix whose nonzero entries indicate
+        which connections exist (for example, the logical not of a
+        :attr:`.FFNet.mask` for this connection)
+    :type pattern: :class:`~numpy:numpy.ndarray` or
+        :mod:`~scipy:scipy.sparse` matrix
+    """
+
+    # maximum number of elements in temporary arrays used in grad
+    chunk_size = 2 ** 20
+
+    def __init__(self, pattern):
+        import scipy.sparse
+
+        pattern = scipy.sparse.csc_matrix(pattern, dtype=bool)
+        pattern.eliminate_zeros()
+        pattern.sort_indices()
+
+        self.shape = pattern.shape
+        self.indices = pattern.indices.astype(np.int32)
+        self.indptr = pattern.indptr.astype(np.int32)
+
+        # pre/post index of each weight (in the order they are stored in the
+        # parameter vector)
+        self.rows = self.indices
+        self.cols = np.repeat(np.arange(self.shape[1], dtype=np.int32),
+                              np.diff(self.indptr))
+
+    def check_shape(self, pre, post):
+        if (pre, post) != self.shape:
+            raise ValueError("Connection shape %s does not match sparsity "
+                             "pattern shape %s" % ((pre, post), self.shape))
+
+    def n_weights(self, pre, post):
+        self.check_shape(pre, post)
+        return len(self.indices)
+
+    def reshape(self, W, pre, post):
+        import scipy.sparse
+
+        self.check_shape(pre, post)
+
+        # note: the weights are stored in compressed sparse column format, so
+        # that this can be a view of W.  the arrays are assigned directly
+        # because the csc_matrix constructor copies data that is a small
+        # part of a larger array (which W usually is).
+        mat = scipy.sparse.csc_matrix(self.shape, dtype=W.dtype)
+        mat.indices = self.indices
+        mat.indptr = self.indptr
+        mat.data = W
+        mat.has_sorted_indices = True
+        return mat
+
+    def dot(self, x, W, out=None):
+        if issparse(x):
+            return _sparse_out(x.dot(W), out)
+
+        # note: computed as (W.T x.T).T so that it is a sparse-dense product
+        return _sparse_out(W.T.dot(x.T).T, out)
+
+    def dot_T(self, d, W, out=None):
+        return _sparse_out(W.dot(d.T).T, out)
+
+    def grad(self, x, d, out):
+        # only compute the gradient for the connections that exist (processed
+        # in chunks to limit the size of the temporary arrays)
+        if issparse(x):
+            x = x.tocsc()
+        chunk = max(self.chunk_size // max(x.shape[0], 1), 1)
+        for start in range(0, len(self.rows), chunk):
+            end = start + chunk
+            rows = self.rows[start:end]
+            cols = self.cols[start:end]
+            if issparse(x):
+                out.data[start:end] = np.asarray(
+                    x[:, rows].multiply(d[:, cols]).sum(axis=0)).ravel()
+            else:
+                np.einsum("ij,ij->j", x[:, rows], d[:, cols],
+                          out=out.data[start:end])
+        return out
+
+    def init_weights(self, rng, pre, post, init_type="sparse", coeff=1.0):
+        self.check_shape(pre, post)
+
+        n = len(self.indices)
+        if init_type in ("sparse", "gaussian"):
+            # note: the sparsity pattern takes the place of the sparse
+            # initialization, but units may still have many more than 15
+            # inputs; the weights are scaled so that the input variance is
+            # the same as with (at most) 15 connections
+            fan_in = np.maximum(np.diff(self.indptr), 1)[self.cols]
+            return rng.randn(n) * coeff * np.sqrt(np.minimum(15, fan_in) /
+                                                  fan_in.astype(float))
+        elif init_type == "uniform":
+            # scale based on the number of inputs to each post unit
+            fan_in = np.maximum(np.diff(self.indptr), 1)[self.cols]
+            return rng.uniform(-1, 1, n) * coeff / np.sqrt(fan_in)
+        else:
+            raise ValueError("Unknown weight initialization (%s)" % init_type)
+
+    def get_config(self):
+        import scipy.sparse
+
+        return {"pattern": scipy.sparse.csc_matrix(
+            (np.ones(len(self.indices), dtype=bool), self.indices,
+             self.indptr), shape=self.shape)}
+
+
+class Convolution(Connection):
+    """Convolutional connection (the weights are a kernel that is shared
+    across all positions in the input).
+
+    The pre and post layers are flat vectors, which are interpreted as
+    ``(channels,) + spatial_shape`` arrays (in C order).  Only the kernel is
+    stored in the parameter vector; note that the biases are still one per
+    post unit (they are not tied across positions).
+
+    See :class:`Conv1D` and :class:`Conv2D`.
+
+    :param tuple in_shape: ``(channels,) + spatial_shape`` of the pre layer
+    :param tuple kernel_shape: ``(filters,) + kernel_spatial_shape``
+    :param int stride: step between kernel positions (in each spatial
+        dimension)
+    :param int padding: number of zeros added to each side of the input (in
+        each spatial dimension)
+    """
+
+    def __init__(self, in_shape, kernel_shape, stride=1, padding=0):
+        if len(in_shape) != len(kernel_shape):
+            raise ValueError("Input shape %s and kernel shape %s must have "
+                             "the same number of dimensions" %
+                             (in_shape, kernel_shape))
+
+        self.in_shape = tuple(int(x) for x in in_shape)
+        self.kernel_shape = tuple(int(x) for x in kernel_shape)
+        self.stride = int(stride)
+        self.padding = int(padding)
+
+        padded = [s + 2 * self.padding for s in self.in_shape[1:]]
+        if any(p < k for p, k in zip(padded, self.kernel_shape[1:])):
+            raise ValueError("Kernel shape %s larger than input shape %s" %
+                             (self.kernel_shape, self.in_shape))
+
+        self.out_shape = (self.kernel_shape[0],) + tuple(
+            (p - k) // self.stride + 1
+            for p, k in zip(padded, self.kernel_shape[1:]))
+
+        # full shape of the kernel array, (filters, channels, ...)
+        self.W_shape = ((self.kernel_shape[0], self.in_shape[0]) +
+                        self.kernel_shape[1:])
+
+        self.n_dims = len(self.in_shape) - 1
+
+    def check_shape(self, pre, post):
+        if (pre, post) != (np.prod(self.in_shape), np.prod(self.out_shape)):
+            raise ValueError("Connection shape %s does not match convolution "
+                             "shape %s -> %s" % ((pre, post), self.in_shape,
+                                                 self.out_shape))
+
+    def n_weights(self, pre, post):
+        self.check_shape(pre, post)
+        return int(np.prod(self.W_shape))
+
+    def reshape(self, W, pre, post):
+        self.check_shape(pre, post)
+        return W.reshape(self.W_shape)
+
+    def pad(self, x):
+        """Reshape flat input vectors into ``(batch_size, channels,
+        spatial...)`` arrays and apply zero padding."""
+
+        x = x.reshape((x.shape[0],) + self.in_shape)
+        if self.padding > 0:
+            x = np.pad(x, [(0, 0), (0, 0)] +
+                       [(self.padding, self.padding)] * self.n_dims,
+                       mode="constant")
+        return x
+
+    def patches(self, x):
+        """View of the input patches each kernel position is applied to.
+
+        :param x: padded input, from :meth:`pad`
+        :returns: array with shape ``(batch_size, channels, out_spatial...,
+            kernel_spatial...)`` (a strided view of ``x``, not a copy, so it
+            should not be written to)
+        """
+
+        x = np.ascontiguousarray(x)
+        spatial = x.strides[2:]
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(x.shape[:2] + self.out_shape[1:] +
+                      self.kernel_shape[1:]),
+            strides=(x.strides[:2] + tuple(s * self.stride for s in spatial) +
+                     spatial))
+
+    def dot(self, x, W, out=None):
+        if issparse(x):
+            x = x.toarray()
+
+        # note: tensordot copies the patches into a (positions, kernel)
+        # matrix and then does a single matrix product (i.e., im2col)
+        k_axes = list(range(self.n_dims + 2, 2 * self.n_dims + 2))
+        result = np.tensordot(self.patches(self.pad(x)), W,
+                              axes=([1] + k_axes,
+                                    list(range(1, self.n_dims + 2))))
+
+        # (batch, out_spatial..., filters) -> (batch, filters, out_spatial...)
+        result = np.rollaxis(result, -1, 1).reshape((x.shape[0], -1))
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def dot_T(self, d, W, out=None):
+        d = d.reshape((d.shape[0],) + self.out_shape)
+
+        # contribution of each output position to each patch element,
+        # (batch, out_spatial..., channels, kernel_spatial...)
+        cols = np.tensordot(d, W, axes=([1], [0]))
+
+        # add the patches back into the (padded) input
+        dx = np.zeros((d.shape[0], self.in_shape[0]) +
+                      tuple(s + 2 * self.padding for s in self.in_shape[1:]),
+                      dtype=d.dtype)
+        for k in np.ndindex(*self.kernel_shape[1:]):
+            idx = (slice(None), slice(None)) + tuple(
+                slice(k_i, k_i + self.stride * n, self.stride)
+                for k_i, n in zip(k, self.out_shape[1:]))
+            dx[idx] += np.rollaxis(cols[(Ellipsis,) + k], -1, 1)
+
+        if self.padding > 0:
+            dx = dx[(slice(None), slice(None)) +
+                    (slice(self.padding, -self.padding),) * self.n_dims]
+
+        dx = dx.reshape((d.shape[0], -1))
+        if out is None:
+            return dx
+        out[...] = dx
+        return out
+
+    def grad(self, x, d, out):
+        if issparse(x):
+            x = x.toarray()
+
+        d = d.reshape((d.shape[0],) + self.out_shape)
+        pos_axes = [0] + list(range(2, self.n_dims + 2))
+        out[...] = np.tensordot(d, self.patches(self.pad(x)),
+                                axes=(pos_axes, pos_axes))
+        return out
+
+    def init_weights(self, rng, pre, post, init_type="sparse", coeff=1.0):
+        n = self.n_weights(pre, post)
+
+        # scale based on the number of inputs to each kernel (channels *
+        # kernel size), which can be large (e.g. 800 for a 5x5x32 kernel)
+        fan_in = np.prod(self.W_shape[1:])
+        if init_type in ("sparse", "gaussian"):
+            return rng.randn(n) * coeff / np.sqrt(fan_in)
+        elif init_type == "uniform":
+            return rng.uniform(-1, 1, n) * coeff / np.sqrt(fan_in)
+        else:
+            raise ValueError("Unknown weight initialization (%s)" % init_type)
+
+    def get_config(self):
+        return {"in_shape": list(self.in_shape),
+                "kernel_shape": list(self.kernel_shape),
+                "stride": self.stride, "padding": self.padding}
+
+
+class Conv1D(Convolution):
+    """1D convolution (e.g., for signals).
+
+    :param tuple in_shape: ``(channels, length)`` of the pre layer
+    :param tuple kernel_shape: ``(filters, kernel_length)``
+
+    See :class:`Convolution` for the remaining parameters.
+    """
+
+    def __init__(self, in_shape, kernel_shape, stride=1, padding=0):
+        if len(in_shape) != 2:
+            raise ValueError("Conv1D input shape must be (channels, length)")
+        super(Conv1D, self).__init__(in_shape, kernel_shape, stride, padding)
+
+
+class Conv2D(Convolution):
+    """2D convolution (e.g., for images).
+
+    :param tuple in_shape: ``(channels, height, width)`` of the pre layer
+    :param tuple kernel_shape: ``(filters, kernel_height, kernel_width)``
+
+    See :class:`Convolution` for the remaining parameters.
+    """
+
+    def __init__(self, in_shape, kernel_shape, stride=1, padding=0):
+        if len(in_shape) != 3:
+            raise ValueError("Conv2D input shape must be (channels, height, "
+                             "width)")
+        super(Conv2D, self).__init__(in_shape, kernel_shape, stride, padding)
@@ -1,44 +1,103 @@
 """Run this script to display the data output during a run."""
 
-import pickle
+import os
 import threading
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from hessianfree.fileio import read_records
 
-def run(filename):
-    with open(filename, "rb") as f:
-        plots = pickle.load(f)
 
-    axes = []
-    lines = []
-    for p in plots:
-        plt.figure()
-        plt.title(p)
-        if "(log)" in p:
-            plt.yscale("log")
-        axes += [plt.gca()]
-        lines += [plt.plot(plots[p])[0]]
+def decimate(data, max_points=1000):
+    """Downsample data for display, keeping the minimum and maximum value
+    within each bin (so that spikes in the data are still visible).
 
+    :param list data: the full data series
+    :param int max_points: maximum number of points in the output
+    :returns: x and y values of the downsampled data
+    """
+
+    data = np.asarray(data)
+    n = len(data)
+
+    if n <= max_points:
+        return np.arange(n), data
+
+    size = int(np.ceil(2.0 * n / max_points))
+    starts = np.arange(0, n, size)
+
+    x = np.repeat(starts + (np.minimum(starts + size, n) - starts - 1) / 2.0,
+                  2)
+    y = np.empty(2 * len(starts), dtype=data.dtype)
+    y[::2] = np.minimum.reduceat(data, starts)
+    y[1::2] = np.maximum.reduceat(data, starts)
+
+    return x, y
+
+
+def run(filename, max_points=1000, poll=1.0):
+    """Display the data in a plot log, updating as new data is appended.
+
+    :param str filename: the log file being written by
+        :meth:`.FFNet.run_epochs`
+    :param int max_points: long histories will be downsampled to this many
+        points for display (see :func:`decimate`)
+    :param float poll: time (in seconds) between checks for changes to the log
+    """
+
+    plots = {}
+    axes = {}
+    lines = {}
+
+    f = open(filename, "rb")
+    stat = None
     while True:
-        with open(filename, "rb") as f:
-            plots = pickle.load(f)
+        # wait until the log file changes
+        new_stat = os.stat(filename)
+        new_stat = (new_stat.st_ino, new_stat.st_size, new_stat.st_mtime)
+        if new_stat == stat:
+            plt.pause(poll)
+            continue
+        stat = new_stat
+
+        # check whether the log has been replaced (e.g. by a new run)
+        if os.fstat(f.fileno()).st_ino != stat[0]:
+            f.close()
+            f = open(filename, "rb")
+            for p in plots:
+                plots[p] = []
+
+        # read the data appended since the last update
+        changed = set(plots) if f.tell() == 0 else set()
+        for record in read_records(f):
+            for p, vals in record.items():
+                if p not in plots:
+                    plt.figure()
+                    plt.title(p)
+                    if "(log)" in p:
+                        plt.yscale("log")
+                    axes[p] = plt.gca()
+                    lines[p] = plt.plot([])[0]
+                    plots[p] = []
+
+                plots[p] += vals
+                changed.add(p)
 
-        for i, p in enumerate(plots):
-            lines[i].set_data(np.arange(len(plots[p])), plots[p])
-            axes[i].relim()
-            axes[i].autoscale_view()
+        for p in changed:
+            lines[p].set_data(*decimate(plots[p], max_points))
+            axes[p].relim()
+            axes[p].autoscale_view()
 
         plt.draw()
-        plt.pause(10)
+        plt.pause(poll)
 
 
-def run_thread(filename):
-    p = threading.Thread(target=run, args=(filename,))
+def run_thread(filename, **kwargs):
+    p = threading.Thread(target=run, args=(filename,), kwargs=kwargs)
     p.daemon = True
     p.start()
 
 
 if __name__ == "__main__":
-    run("HF_plots.pkl")
+    run("HF_plots.jsonl")
@@ -11,7 +11,6 @@ of the 27th International Conference on Machine Learning.
 from __future__ import print_function
 
 from collections import defaultdict, OrderedDict
-import pickle
 import warnings
 
 import numpy as np
@@ -19,6 +18,16 @@ import numpy as np
 import hessianfree as hf
 
 
+class _NullContext(object):
+    """Context manager that does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
 class FFNet(object):
     """Implementation of feed-forward network (including gradient/curvature
     computation).
@@ -45,12 +54,41 @@ class FFNet(object):
     :type rng: :class:`~numpy:numpy.random.RandomState`
     :param dtype: floating point precision used throughout the network
     :type dtype: :class:`~numpy:numpy.dtype`
+    :param dict conn_types: ``{(pre, post): connection, ...}`` specifying the
+        :class:`~.connections.Connection` type for some of the connections in
+        ``conns`` (any not specified will be
+        :class:`~.connections.Dense`)
+    :param int threads: if greater than 1, layers that don't depend on each
+        other (parallel branches in ``conns``) will be processed concurrently
+        on a pool with this many threads (see :meth:`run_stages`)
+    :param d_act_precision: storage format for the cached
+        ``d_activations`` (or a list giving a format for each layer), which
+        are upcast to ``dtype`` when they are used; can be a
+        :class:`~.precision.Precision` instance, ``"bfloat16"``, or a data
+        type (default is to store them in ``dtype``)
+    :param act_precision: storage format for the cached ``activations``
+        (or a list giving a format for each layer); the input layer is always
+        stored in ``dtype``
     """
 
+    # attributes that hold data about the current minibatch/run, which will
+    # not be included when pickling the network (see __getstate__)
+    transient_attrs = ("inputs", "targets", "activations", "d_activations",
+                       "d2_loss", "tmp_space", "R_activations", "R_errors",
+                       "best_W")
+
+    # if True, the transient attributes will be pickled
+    pickle_cache = False
+
+    # maximum number of BLAS threads used by each task when processing layers
+    # concurrently (requires threadpoolctl)
+    blas_threads = 1
+
     def __init__(self, shape, layers=hf.nl.Logistic(), conns=None,
                  loss_type=hf.loss_funcs.SquaredError(), W_init_params=None,
                  use_GPU=False, load_weights=None, debug=False, rng=None,
-                 dtype=np.float32):
+                 dtype=np.float32, conn_types=None, threads=None,
+                 d_act_precision=None, act_precision=None):
 
         self.debug = debug
         self.shape = shape
@@ -59,6 +97,9 @@ class FFNet(object):
         self.mask = None
         self._optimizer = None
         self.rng = np.random.RandomState() if rng is None else rng
+        self.threads = threads
+        self._thread_pool = None
+        self._blas_controller = None
 
         # note: this isn't used internally, it is just here so that an
         # external process with a handle to this object can tell what epoch
@@ -94,6 +135,16 @@ class FFNet(object):
                                 "nonlinearities.Nonlinearity" % t)
             self.layers += [t]
 
+        # initialize precision of cached values
+        if not isinstance(act_precision, (list, tuple)):
+            act_precision = ([None] +
+                             [act_precision for _ in range(self.n_layers - 1)])
+        elif act_precision[0] is not None:
+            raise ValueError("Input layer activations cannot be stored in "
+                             "reduced precision")
+        self.act_precision = self.init_precision(act_precision)
+        self.d_act_precision = self.init_precision(d_act_precision)
+
         # initialize loss function
         self.init_loss(loss_type)
 
@@ -125,10 +176,33 @@ class FFNet(object):
         self.conns[self.n_layers - 1] = []
         self.back_conns[0] = []
 
+        # initialize connection types
+        self.conn_types = dict(((pre, post), hf.connections.Dense())
+                               for pre in self.conns
+                               for post in self.conns[pre])
+        if conn_types is not None:
+            for c in conn_types:
+                if c not in self.conn_types:
+                    raise ValueError("Connection type specified for "
+                                     "nonexistent connection %s" % (c,))
+                if not isinstance(conn_types[c], hf.connections.Connection):
+                    raise TypeError("Connection type (%s) must be an "
+                                    "instance of connections.Connection"
+                                    % conn_types[c])
+            self.conn_types.update(conn_types)
+        if use_GPU and not self.dense:
+            raise ValueError("GPU computation only supports Dense "
+                             "connections")
+
         # compute indices for the different connection weight matrices in the
         # overall parameter vector
         self.compute_offsets()
 
+        # compile the connection graph into the sequence of operations used
+        # in the forward/backward passes
+        self.plan = hf.plan.ExecutionPlan(self.shape, self.conns,
+                                          self.conn_types, self.offsets)
+
         # initialize connection weights
         if load_weights is None:
             if W_init_params is None:
@@ -136,6 +210,9 @@ class FFNet(object):
             self.W = self.init_weights(
                 [(self.shape[pre], self.shape[post])
                  for pre in self.conns for post in self.conns[pre]],
+                conn_types=[self.conn_types[(pre, post)]
+                            for pre in self.conns
+                            for post in self.conns[pre]],
                 **W_init_params)
         else:
             if isinstance(load_weights, np.ndarray):
@@ -171,7 +248,7 @@ class FFNet(object):
     def run_epochs(self, inputs, targets, optimizer,
                    max_epochs=100, minibatch_size=None, test=None,
                    test_err=None, target_err=1e-6, plotting=False,
-                   file_output=None, print_period=10):
+                   file_output=None, print_period=10, resume=None):
         """Apply the given optimizer with a sequence of (mini)batches.
 
         :param inputs: input vectors (or a :class:`~.nonlinearities.Plant` that
@@ -195,10 +272,15 @@ class FFNet(object):
             reached
         :param str file_output: output files from the run will use this as a
             prefix (if None then don't output files)
-        :param bool plotting: if True then data from the run will be output to
-            a file, which can be displayed via dataplotter.py
+        :param bool plotting: if True then data from the run will be appended
+            to a log file (``<file_output>_plots.jsonl``), which can be
+            displayed via dataplotter.py
         :param int print_period: print out information about the run every `x`
             epochs
+        :param str resume: continue a previous run from the given checkpoint
+            file (checkpoints are saved to ``<file_output>_checkpoint.pkl``
+            after each epoch if ``file_output`` is set); note that
+            ``max_epochs`` includes the epochs from the previous run
         """
 
         test_errs = []
@@ -208,8 +290,59 @@ class FFNet(object):
         minibatch_size = minibatch_size or inputs.shape[0]
         plots = defaultdict(list)
         self.optimizer = optimizer
-
-        for i in range(max_epochs):
+        start = 0
+
+        if resume is not None:
+            state = hf.fileio.load_checkpoint(resume)
+
+            if state["W"].shape != self.W.shape:
+                raise ValueError("Checkpoint weights shape %s does not match "
+                                 "network %s" % (state["W"].shape,
+                                                 self.W.shape))
+
+            self.W[...] = state["W"]
+            self.best_W = state["best_W"]
+            self.best_error = state["best_error"]
+            test_errs = state["test_errs"]
+            plots = defaultdict(list, state["plots"])
+            self.rng.set_state(state["rng"])
+            optimizer.set_state(state["optimizer"])
+            start = state["epoch"] + 1
+
+        if file_output is None and not plotting:
+            writer = None
+        else:
+            writer = hf.fileio.BackgroundWriter()
+        try:
+            self._run_epochs(inputs, targets, optimizer, start, max_epochs,
+                             minibatch_size, test, test_err, target_err,
+                             plotting, file_output, print_period, prefix,
+                             test_errs, plots, writer)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _run_epochs(self, inputs, targets, optimizer, start, max_epochs,
+                    minibatch_size, test, test_err, target_err, plotting,
+                    file_output, print_period, prefix, test_errs, plots,
+                    writer):
+        """Main loop for :meth:`run_epochs`."""
+
+        if plotting:
+            # start a new plot log (containing any data from the resumed run),
+            # and keep track of how much of each plot has been written
+            plot_file = "%s_plots.jsonl" % prefix
+            writer.submit(hf.fileio.write_records, plot_file,
+                          [self._plot_record(plots, {})] if plots else [])
+            plot_counts = dict((k, len(v)) for k, v in plots.items())
+
+        if test is None:
+            test = (inputs, targets)
+        if test[1] is not None:
+            # precompute the nan information for the test targets
+            test = (test[0], hf.loss_funcs.Targets(test[1]))
+
+        for i in range(start, max_epochs):
             self.epoch = i
             printing = print_period is not None and (i % print_period == 0 or
                                                      self.debug)
@@ -220,10 +353,11 @@ class FFNet(object):
 
             # run minibatches
             indices = self.rng.permutation(inputs.shape[0])
-            for start in range(0, inputs.shape[0], minibatch_size):
+            for batch_start in range(0, inputs.shape[0], minibatch_size):
                 # generate minibatch and cache activations
                 self.cache_minibatch(
-                    inputs, targets, indices[start:start + minibatch_size])
+                    inputs, targets,
+                    indices[batch_start:batch_start + minibatch_size])
 
                 # validity checks
                 if self.inputs.shape[-1] != self.shape[0]:
@@ -257,16 +391,13 @@ class FFNet(object):
                 self.GPU_activations = None
 
             # compute test error
-            if test is None:
-                test_in, test_t = inputs, targets
-            else:
-                test_in, test_t = test[0], test[1]
+            test_in, test_t = test
 
             if test_err is None:
                 err = self.error(self.W, test_in, test_t)
             else:
                 output = self.forward(test_in, self.W)
-                err = test_err.batch_loss(output, test_t)
+                err = test_err.loss_value(output, test_t)
             test_errs += [err]
 
             if printing:
@@ -286,12 +417,28 @@ class FFNet(object):
                 if hasattr(optimizer, "plots"):
                     plots.update(optimizer.plots)
 
-                with open("%s_plots.pkl" % prefix, "wb") as f:
-                    pickle.dump(plots, f)
+                # append the new values to the log
+                writer.submit(hf.fileio.append_record, plot_file,
+                              self._plot_record(plots, plot_counts))
+                plot_counts = dict((k, len(v)) for k, v in plots.items())
 
             # dump weights
             if file_output is not None:
-                np.save("%s_weights.npy" % prefix, self.W)
+                writer.submit(hf.fileio.save_array,
+                              "%s_weights.npy" % prefix, self.W.copy())
+
+                # note: everything is copied here, since the write happens
+                # while the next epoch is modifying the originals
+                writer.submit(hf.fileio.save_checkpoint,
+                              "%s_checkpoint.pkl" % prefix,
+                              {"epoch": i, "W": self.W.copy(),
+                               "best_W": self.best_W,
+                               "best_error": self.best_error,
+                               "test_errs": list(test_errs),
+                               "plots": dict((k, list(v))
+                                             for k, v in plots.items()),
+                               "rng": self.rng.get_state(),
+                               "optimizer": optimizer.get_state()})
 
             # check for termination
             if test_errs[-1] < target_err:
@@ -303,16 +450,27 @@ class FFNet(object):
                     print("overfitting detected, terminating")
                 break
 
+    @staticmethod
+    def _plot_record(plots, counts):
+        """Collect the plot values that have been added since the lengths in
+        ``counts`` (in a form that can be written to the plot log)."""
+
+        return dict((k, [float(x) for x in v[counts.get(k, 0):]])
+                    for k, v in plots.items() if len(v) > counts.get(k, 0))
+
     def forward(self, inputs, params=None, deriv=False):
         """Compute layer activations for given input and parameters.
 
-        :param inputs: input vectors (passed to first layer)
+        :param inputs: input vectors (passed to first layer); this can also
+            be a :mod:`scipy:scipy.sparse` matrix, if the first layer is
+            :class:`~.nonlinearities.Linear`
         :type inputs: :class:`~numpy:numpy.ndarray`
         :param params: parameter vector (weights) for the network (defaults to
             ``self.W``)
         :type params: :class:`~numpy:numpy.ndarray`
         :param bool deriv: if True then also compute the derivative of the
-            activations
+            activations (note: the derivative is not computed for sparse
+            inputs, since it is not needed)
         """
 
         params = self.W if params is None else params
@@ -324,31 +482,44 @@ class FFNet(object):
         if deriv:
             d_activations = [None for _ in range(self.n_layers)]
 
-        for i in range(self.n_layers):
+        def layer_forward(i):
             if i == 0:
                 if isinstance(inputs, hf.nl.Plant):
-                    inputs = inputs(None)
+                    x = inputs(None)
+                elif hf.connections.issparse(inputs):
+                    if not isinstance(self.layers[0], hf.nl.Linear):
+                        raise TypeError("Sparse inputs require a Linear input "
+                                        "layer")
+
+                    # note: sparse inputs are passed through unchanged, and
+                    # the first layer products use sparse-dense kernels
+                    activations[0] = inputs.tocsr()
+                    return
                 else:
-                    inputs = inputs
+                    x = inputs
             else:
-                inputs = np.zeros((inputs.shape[0], self.shape[i]),
-                                  dtype=self.dtype)
-                for pre in self.back_conns[i]:
-                    W, b = self.get_weights(params, (pre, i))
-                    inputs += np.dot(activations[pre], W)
-                    inputs += b
+                x = np.zeros((activations[0].shape[0], self.shape[i]),
+                             dtype=self.dtype)
+                for e in self.plan.in_edges[i]:
+                    W, b = e.weights(params)
+                    x += e.conn.dot(activations[e.pre], W)
+                    x += b
                     # note: we're applying a bias on each connection to a
                     # neuron (rather than one for each neuron). just because
                     # it's easier than tracking how many connections there are
                     # for each layer (but we could do it if it becomes
                     # important).
-            activations[i] = self.layers[i].activation(inputs)
+            activations[i] = self.layers[i].activation(x)
 
             if deriv:
-                d_activations[i] = self.layers[i].d_activation(inputs,
+                d_activations[i] = self.layers[i].d_activation(x,
                                                                activations[i])
 
+        self.run_stages(layer_forward)
+
         for i, a in enumerate(activations):
+            if hf.connections.issparse(a):
+                a = a.data
             if not np.all(np.isfinite(a)):
                 raise OverflowError("Non-finite nonlinearity activation "
                                     "value (layer %d) \n %s" %
@@ -358,6 +529,62 @@ class FFNet(object):
 
         return activations
 
+    def run_stages(self, func, reverse=False):
+        """Call ``func(i)`` for each layer ``i``, in the order given by the
+        execution plan (see :class:`~.plan.ExecutionPlan`).
+
+        If ``self.threads > 1`` then the layers within each stage (which don't
+        depend on each other) are processed concurrently on a thread pool.
+        While that is happening, if threadpoolctl is installed, the number of
+        BLAS threads is limited to ``self.blas_threads`` (so that the
+        concurrent tasks don't oversubscribe the cores).
+
+        :param func: function to be applied to each layer
+        :param bool reverse: if True, process the stages in reverse order (for
+            the backward pass)
+        """
+
+        stages = self.plan.stages[::-1] if reverse else self.plan.stages
+
+        for stage in stages:
+            if self.threads is None or self.threads <= 1 or len(stage) == 1:
+                for i in (stage[::-1] if reverse else stage):
+                    func(i)
+            else:
+                with self._blas_limits():
+                    # note: list() so that exceptions are raised here
+                    list(self.thread_pool.map(func, stage))
+
+    @property
+    def thread_pool(self):
+        """Thread pool used in :meth:`run_stages` (created when first
+        needed)."""
+
+        if self._thread_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._thread_pool = ThreadPoolExecutor(self.threads)
+        return self._thread_pool
+
+    def _blas_limits(self):
+        """Context manager that limits the number of BLAS threads (if
+        threadpoolctl is installed)."""
+
+        if self._blas_controller is None:
+            # note: the controller is cached, since looking up the loaded
+            # BLAS libraries is relatively slow
+            try:
+                from threadpoolctl import ThreadpoolController
+                self._blas_controller = ThreadpoolController()
+            except ImportError:
+                self._blas_controller = False
+
+        if self._blas_controller is False:
+            return _NullContext()
+
+        return self._blas_controller.limit(limits=self.blas_threads,
+                                           user_api="blas")
+
     def error(self, W=None, inputs=None, targets=None):
         """Compute network error.
 
@@ -378,7 +605,7 @@ class FFNet(object):
         if (W is self.W and inputs is self.inputs and
                     self.activations is not None):
             # use cached activations
-            activations = self.activations
+            activations = [hf.precision.decode(a) for a in self.activations]
         else:
             # compute activations
             activations = self.forward(inputs, W)
@@ -394,7 +621,7 @@ class FFNet(object):
         # where the target is not defined. those get translated to
         # zero error in the loss function.
 
-        error = self.loss.batch_loss(activations, targets)
+        error = self.loss.loss_value(activations, targets)
 
         return error
 
@@ -431,18 +658,37 @@ class FFNet(object):
         if self.inputs.dtype != self.dtype:
             warnings.warn("Input dtype (%s) not equal to self.dtype (%s)" %
                           (self.inputs.dtype, self.dtype))
-        self.inputs = np.asarray(self.inputs, dtype=self.dtype)
-        self.targets = np.asarray(self.targets, dtype=self.dtype)
-        self.activations = [np.asarray(a, dtype=self.dtype)
-                            for a in self.activations]
-        self.d_activations = [np.asarray(a, dtype=self.dtype)
+        if hf.connections.issparse(self.inputs):
+            if self.use_GPU:
+                raise TypeError("Sparse inputs are not supported on the GPU")
+            self.inputs = self.inputs.tocsr().astype(self.dtype, copy=False)
+            self.activations[0] = self.inputs
+        else:
+            self.inputs = np.asarray(self.inputs, dtype=self.dtype)
+            self.activations[0] = np.asarray(self.activations[0],
+                                             dtype=self.dtype)
+        self.targets = hf.loss_funcs.Targets(np.asarray(self.targets,
+                                                        dtype=self.dtype))
+        self.activations[1:] = [np.asarray(a, dtype=self.dtype)
+                                for a in self.activations[1:]]
+        self.d_activations = [None if a is None else
+                              np.asarray(a, dtype=self.dtype)
                               for a in self.d_activations]
         self.d2_loss = self.loss.d2_loss(self.activations, self.targets)
 
+        # store cached values in reduced precision (note: this is done after
+        # d2_loss, which is computed from the full precision activations)
+        self.activations = [
+            a if p is None else hf.precision.CachedArray(a, p, self.dtype)
+            for a, p in zip(self.activations, self.act_precision)]
+        self.d_activations = [
+            a if a is None or p is None else
+            hf.precision.CachedArray(a, p, self.dtype)
+            for a, p in zip(self.d_activations, self.d_act_precision)]
+
         # allocate temporary space for intermediate values, to save on
         # memory allocations
-        self.tmp_space = [np.zeros(a.shape, self.dtype)
-                          for a in self.activations]
+        self.alloc_tmp_space()
 
         if self.use_GPU:
             # TODO: we could just allocate these on the first timestep and
@@ -450,6 +696,24 @@ class FFNet(object):
             # ever became a significant part of the computation time
             self.load_GPU_data()
 
+    def alloc_tmp_space(self):
+        """Allocate the temporary space used in :meth:`calc_G` (based on the
+        cached minibatch).
+
+        Layers share buffers where possible, based on when their values are
+        needed (see :class:`~.plan.ExecutionPlan`).
+        """
+
+        batch_size = self.inputs.shape[0]
+        self.tmp_space = self.plan.alloc_scratch(batch_size, self.dtype)
+        if self.use_GPU:
+            # GPU_calc_G uses its own buffers
+            self.R_activations = self.R_errors = None
+        else:
+            self.R_activations, self.R_errors = self.plan.alloc_R(
+                batch_size, self.dtype,
+                [i for i, d2 in enumerate(self.d2_loss) if d2 is not None])
+
     def load_GPU_data(self):
         """Load data for the current epoch onto GPU."""
 
@@ -466,12 +730,16 @@ class FFNet(object):
             del self.GPU_tmp_space
 
         self.GPU_W = gpuarray.to_gpu(self.W)
-        self.GPU_activations = [gpuarray.to_gpu(a)
+        self.GPU_activations = [gpuarray.to_gpu(np.asarray(a))
                                 for a in self.activations]
-        self.GPU_d_activations = [gpuarray.to_gpu(a)
+        self.GPU_d_activations = [gpuarray.to_gpu(np.asarray(a))
                                   for a in self.d_activations]
-        self.GPU_d2_loss = [gpuarray.to_gpu(a) if a is not None else None
-                            for a in self.d2_loss]
+        # note: d2_loss may be a scalar, which is expanded to the full shape
+        # here
+        self.GPU_d2_loss = [
+            gpuarray.to_gpu(d2 * np.ones(a.shape, self.dtype))
+            if d2 is not None else None
+            for a, d2 in zip(self.activations, self.d2_loss)]
         self.GPU_tmp_space = [gpuarray.empty(a.shape, self.dtype)
                               for a in self.activations]
 
@@ -522,25 +790,35 @@ class FFNet(object):
         # pass has already been run elsewhere
 
         # compute output error for each layer
-        error = self.loss.d_loss(self.activations, self.targets)
+        activations = [hf.precision.decode(a) for a in self.activations]
+        error = self.loss.d_loss(activations, self.targets)
 
-        error = [np.zeros_like(self.activations[i]) if e is None else e
-                 for i, e in enumerate(error)]
+        # note: the error/deltas for the input layer are never used (and the
+        # inputs may be a large sparse matrix), so they aren't allocated
+        error = [None if i == 0 else
+                 np.zeros(self.activations[i].shape, self.dtype) if e is None
+                 else e for i, e in enumerate(error)]
 
-        deltas = [np.zeros_like(a) for a in self.activations]
+        deltas = [None] + [np.zeros(a.shape, self.dtype)
+                           for a in self.activations[1:]]
 
         # backwards pass
-        for i in range(self.n_layers - 1, -1, -1):
-            for post in self.conns[i]:
-                error[i] += np.dot(deltas[post],
-                                   self.get_weights(self.W, (i, post))[0].T)
+        def layer_backward(i):
+            for e in self.plan.out_edges[i]:
+                if i > 0:
+                    # note: the error for the input layer is never used
+                    error[i] += e.conn.dot_T(deltas[e.post],
+                                             e.weights(self.W)[0])
+
+                W_grad, b_grad = e.weights(grad)
+                e.conn.grad(activations[i], deltas[e.post], out=W_grad)
+                np.sum(deltas[e.post], axis=0, out=b_grad)
 
-                W_grad, b_grad = self.get_weights(grad, (i, post))
-                np.dot(self.activations[i].T, deltas[post], out=W_grad)
-                np.sum(deltas[post], axis=0, out=b_grad)
+            if i > 0:
+                self.J_dot(hf.precision.decode(self.d_activations[i]),
+                           error[i], transpose_J=True, out=deltas[i])
 
-            self.J_dot(self.d_activations[i], error[i], transpose_J=True,
-                       out=deltas[i])
+        self.run_stages(layer_backward, reverse=True)
 
         grad /= self.inputs.shape[0]
 
@@ -582,46 +860,90 @@ class FFNet(object):
             Gv = out
             Gv.fill(0)
 
+        # note: values stored in reduced precision (see hf.precision) are
+        # decoded at most once per call. a layer's activations are decoded
+        # in its forward step and released after its backward step.
+        activations = list(self.activations)
+        d_activations = list(self.d_activations)
+
+        def d_act(i):
+            d = d_activations[i]
+            if isinstance(d, hf.precision.CachedArray):
+                if d.ndim == 2:
+                    # diagonal Jacobian, which can be applied elementwise
+                    # without decoding a full array (if necessary it is
+                    # decoded into the scratch buffer)
+                    return d.operand(out=self.tmp_space[i])
+
+                d = d_activations[i] = d.decode()
+            return d
+
         # R forward pass
-        R_activations = [np.zeros_like(a) for a in self.activations]
-        for i in range(1, self.n_layers):
-            for pre in self.back_conns[i]:
-                vw, vb = self.get_weights(v, (pre, i))
-                Ww, _ = self.get_weights(self.W, (pre, i))
+        # note: the R buffers are allocated in cache_minibatch, and reused
+        # across layers (so each layer's buffer needs to be reset here)
+        R_activations = self.R_activations
 
-                R_activations[i] += np.dot(self.activations[pre], vw,
-                                           out=self.tmp_space[i])
+        def layer_R_forward(i):
+            if len(self.plan.out_edges[i]) > 0:
+                activations[i] = hf.precision.decode(activations[i])
+
+            if i == 0:
+                # the input layer doesn't depend on the weights, so
+                # R_activations[0] is always zero
+                return
+
+            R_activations[i].fill(0)
+            for e in self.plan.in_edges[i]:
+                vw, vb = e.weights(v)
+
+                R_activations[i] += e.conn.dot(activations[e.pre], vw,
+                                               out=self.tmp_space[i])
                 R_activations[i] += vb
-                R_activations[i] += np.dot(R_activations[pre], Ww,
-                                           out=self.tmp_space[i])
+                if e.pre > 0:
+                    R_activations[i] += e.conn.dot(R_activations[e.pre],
+                                                   e.weights(self.W)[0],
+                                                   out=self.tmp_space[i])
+
+            self.J_dot(d_act(i), R_activations[i], out=R_activations[i])
 
-            self.J_dot(self.d_activations[i], R_activations[i],
-                       out=R_activations[i])
+        self.run_stages(layer_R_forward)
 
         # backward pass
-        R_error = R_activations
+        R_error = self.R_errors
 
-        for i in range(self.n_layers - 1, -1, -1):
-            if self.d2_loss[i] is not None:
-                # note: R_error[i] is already set to R_activations[i]
-                R_error[i] *= self.d2_loss[i]
+        def layer_R_backward(i):
+            if i == 0:
+                # the error for the input layer is never used
+                pass
+            elif self.d2_loss[i] is not None:
+                # note: R_error[i] shares a buffer with R_activations[i] (and
+                # constant curvature of 1 doesn't need to be applied at all)
+                if not (np.ndim(self.d2_loss[i]) == 0 and
+                        self.d2_loss[i] == 1):
+                    R_error[i] *= self.d2_loss[i]
             else:
                 R_error[i].fill(0)
 
-            for post in self.conns[i]:
-                W, _ = self.get_weights(self.W, (i, post))
+            for e in self.plan.out_edges[i]:
+                if i > 0:
+                    R_error[i] += e.conn.dot_T(R_error[e.post],
+                                               e.weights(self.W)[0],
+                                               out=self.tmp_space[i])
 
-                R_error[i] += np.dot(R_error[post], W.T,
-                                     out=self.tmp_space[i])
+                W_g, b_g = e.weights(Gv)
+                e.conn.grad(activations[i], R_error[e.post], out=W_g)
+                np.sum(R_error[e.post], axis=0, out=b_g)
 
-                W_g, b_g = self.get_weights(Gv, (i, post))
-                np.dot(self.activations[i].T, R_error[post], out=W_g)
-                np.sum(R_error[post], axis=0, out=b_g)
+            if i > 0:
+                self.J_dot(d_act(i), R_error[i], out=R_error[i],
+                           transpose_J=True)
+
+            # decoded values aren't needed after this
+            activations[i] = d_activations[i] = None
 
-            self.J_dot(self.d_activations[i], R_error[i],
-                       out=R_error[i], transpose_J=True)
+        self.run_stages(layer_R_backward, reverse=True)
 
-        Gv /= len(self.inputs)
+        Gv /= self.inputs.shape[0]
 
         Gv += damping * v  # Tikhonov damping
 
@@ -710,7 +1032,10 @@ class FFNet(object):
             dec = self.forward(self.inputs, self.W - inc_i)
 
             for l in range(self.n_layers):
-                J_i = (inc[l] - dec[l]) / (2 * eps)
+                J_i = inc[l] - dec[l]
+                if hf.connections.issparse(J_i):
+                    J_i = J_i.toarray()
+                J_i /= 2 * eps
                 if J[l] is None:
                     J[l] = J_i[..., None]
                 else:
@@ -727,10 +1052,13 @@ class FFNet(object):
         J = self.check_J()
 
         # second derivative of loss function
-        L = self.loss.d2_loss(self.activations, self.targets)
+        L = self.loss.d2_loss([hf.precision.decode(a)
+                               for a in self.activations], self.targets)
         # TODO: check loss via finite differences
 
-        G = np.sum([np.einsum("aji,aj,ajk->ik", J[l], L[l], J[l])
+        G = np.sum([np.einsum("aji,aj,ajk->ik", J[l],
+                              L[l] * np.ones(self.activations[l].shape),
+                              J[l])
                     for l in range(self.n_layers) if L[l] is not None], axis=0)
 
         # divide by batch size
@@ -752,7 +1080,8 @@ class FFNet(object):
             print(calc_G / Gv)
             input("Paused (press enter to continue)")
 
-    def init_weights(self, shapes, coeff=1.0, biases=0.0, init_type="sparse"):
+    def init_weights(self, shapes, coeff=1.0, biases=0.0, init_type="sparse",
+                     conn_types=None):
         """Weight initialization, given shapes of weight matrices.
 
         Note: coeff, biases, and init_type can be specified by the
@@ -765,6 +1094,8 @@ class FFNet(object):
         :param float biases: bias values for the post of each matrix
         :param str init_type: type of initialization to use (currently supports
             'sparse', 'uniform', 'gaussian')
+        :param list conn_types: :class:`~.connections.Connection` type for
+            each weight matrix (defaults to :class:`~.connections.Dense`)
         """
 
         # if given single parameters, expand for all matrices
@@ -775,39 +1106,81 @@ class FFNet(object):
         if isinstance(init_type, str):
             init_type = [init_type] * len(shapes)
 
-        W = [np.zeros((pre + 1, post), dtype=self.dtype)
-             for pre, post in shapes]
+        if conn_types is None:
+            conn_types = [hf.connections.Dense() for _ in shapes]
+
+        # allocate the flat parameter vector, and fill in a view of it for
+        # each matrix
+        W = np.zeros(sum(c.n_weights(*s) + s[1]
+                         for s, c in zip(shapes, conn_types)),
+                     dtype=self.dtype)
+        offset = 0
 
         for i, s in enumerate(shapes):
+            if not isinstance(conn_types[i], hf.connections.Dense):
+                # structured connections handle their own initialization
+                n = conn_types[i].n_weights(*s)
+                W[offset:offset + n] = conn_types[i].init_weights(
+                    self.rng, s[0], s[1], init_type[i], coeff[i])
+                W[offset + n:offset + n + s[1]] = biases[i]
+                offset += n + s[1]
+                continue
+
+            W_i = W[offset:offset + (s[0] + 1) * s[1]].reshape(
+                (s[0] + 1, s[1]))
+            offset += W_i.size
+
             if init_type[i] == "sparse":
                 # sparse initialization (from martens)
-                num_conn = 15
+                num_conn = min(15, s[0])
 
-                for j in range(s[1]):
-                    # pick num_conn random pre neurons
-                    indices = self.rng.choice(np.arange(s[0]),
-                                              size=min(num_conn, s[0]),
-                                              replace=False)
+                # pick num_conn random pre neurons for each post neuron
+                indices = self.sparse_indices(s[0], s[1], num_conn)
 
-                    # connect to post
-                    W[i][indices, j] = self.rng.randn(indices.size) * coeff[i]
+                # connect to post
+                W_i[indices, np.arange(s[1])[:, None]] = (
+                    self.rng.randn(s[1], num_conn) * coeff[i])
             elif init_type[i] == "uniform":
-                W[i][:-1] = self.rng.uniform(-coeff[i] / np.sqrt(s[0]),
-                                             coeff[i] / np.sqrt(s[0]),
-                                             (s[0], s[1]))
+                W_i[:-1] = self.rng.uniform(-coeff[i] / np.sqrt(s[0]),
+                                            coeff[i] / np.sqrt(s[0]),
+                                            (s[0], s[1]))
             elif init_type[i] == "gaussian":
-                W[i][:-1] = self.rng.randn(s[0], s[1]) * coeff[i]
+                W_i[:-1] = self.rng.randn(s[0], s[1]) * coeff[i]
             else:
                 raise ValueError("Unknown weight initialization (%s)"
                                  % init_type)
 
             # set biases
-            W[i][-1, :] = biases[i]
-
-        W = np.concatenate([w.flatten() for w in W])
+            W_i[-1, :] = biases[i]
 
         return W
 
+    def sparse_indices(self, n, rows, k):
+        """Randomly pick ``k`` distinct indices in ``range(n)`` (independently
+        for each row).
+
+        :param int n: number of indices to choose from
+        :param int rows: number of rows
+        :param int k: number of indices to pick in each row
+        :returns: array of indices with shape ``(rows, k)``
+        """
+
+        if n <= 10 * k:
+            # when most of the indices are being picked, just shuffle them
+            return np.argsort(self.rng.rand(rows, n), axis=1)[:, :k]
+
+        # otherwise sample with replacement, and redraw any rows that
+        # picked the same index more than once (which will be rare)
+        indices = self.rng.randint(n, size=(rows, k))
+        redraw = np.arange(rows)
+        while True:
+            sort_idx = np.sort(indices[redraw], axis=1)
+            redraw = redraw[np.any(sort_idx[:, 1:] == sort_idx[:, :-1],
+                                   axis=1)]
+            if len(redraw) == 0:
+                return indices
+            indices[redraw] = self.rng.randint(n, size=(len(redraw), k))
+
     def compute_offsets(self):
         """Precompute offsets for layers in the overall parameter vector."""
 
@@ -815,7 +1188,8 @@ class FFNet(object):
         offset = 0
         for pre in self.conns:
             for post in self.conns[pre]:
-                n_params = (self.shape[pre] + 1) * self.shape[post]
+                n_params = self.conn_types[(pre, post)].n_weights(
+                    self.shape[pre], self.shape[post]) + self.shape[post]
                 self.offsets[(pre, post)] = (
                     offset,
                     offset + n_params - self.shape[post],
@@ -833,7 +1207,52 @@ class FFNet(object):
         offset, W_end, b_end = self.offsets[conn]
         W = params[offset:W_end]
         b = params[W_end:b_end]
-        return W.reshape((self.shape[conn[0]], self.shape[conn[1]])), b
+
+        if conn in self.conn_types:
+            W = self.conn_types[conn].reshape(W, self.shape[conn[0]],
+                                              self.shape[conn[1]])
+        else:
+            W = W.reshape((self.shape[conn[0]], self.shape[conn[1]]))
+
+        return W, b
+
+    @property
+    def dense(self):
+        """True if all the connections in the network are
+        :class:`~.connections.Dense`."""
+
+        return all(isinstance(c, hf.connections.Dense)
+                   for c in self.conn_types.values())
+
+    def export_predictor(self, max_batch_size=256):
+        """Create a frozen, inference-only version of this network.
+
+        :param int max_batch_size: batch size used to allocate the buffers
+            in the predictor (larger batches are processed in chunks)
+        :returns: :class:`~.inference.Predictor`
+        """
+
+        return hf.inference.Predictor(self, max_batch_size)
+
+    def init_precision(self, precision):
+        """Look up the storage format for each layer's cached values.
+
+        :param precision: storage format (or a list giving a format for each
+            layer), see :func:`.precision.lookup`
+        :returns: list containing a :class:`~.precision.Precision` (or None,
+            for full precision) for each layer
+        """
+
+        if not isinstance(precision, (list, tuple)):
+            precision = [precision for _ in range(self.n_layers)]
+
+        if len(precision) != self.n_layers:
+            raise ValueError("Number of precisions (%d) does not match "
+                             "number of layers (%d)" %
+                             (len(precision), self.n_layers))
+
+        return [None if p is None else hf.precision.lookup(p)
+                for p in precision]
 
     def init_loss(self, loss_type):
         """Set the loss type for this network to the given
@@ -887,6 +1306,34 @@ class FFNet(object):
             # compute update
             self.W += self.optimizer.compute_update(False)
 
+    def __getstate__(self):
+        """Drop the data cached for the current minibatch (unless
+        ``pickle_cache`` is True) and any GPU handles when pickling.
+
+        The cached data will be recomputed on the next call to
+        :meth:`cache_minibatch`.
+        """
+
+        state = self.__dict__.copy()
+
+        for k in list(state.keys()):
+            if k.startswith("GPU_"):
+                del state[k]
+            elif k in self.transient_attrs and not self.pickle_cache:
+                state[k] = None
+
+        # thread pools can't be pickled (these will be recreated when needed)
+        state["_thread_pool"] = None
+        state["_blas_controller"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        if self.use_GPU:
+            hf.gpu.init_kernels()
+
     @property
     def optimizer(self):
         return self._optimizer
@@ -0,0 +1,466 @@
+"""Utilities for writing training output (checkpoints, weights, etc.) to
+disk without blocking the optimization."""
+
+from __future__ import print_function
+
+import base64
+import errno
+import json
+import os
+import pickle
+import struct
+import threading
+import uuid
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# incremented whenever the contents of the checkpoint dictionary change in
+# a way that isn't backwards compatible
+CHECKPOINT_VERSION = 1
+
+# model file format (see save_model)
+MODEL_MAGIC = b"HFMODEL\0"
+MODEL_VERSION = 1
+MODEL_ALIGN = 64
+
+
+class BackgroundWriter(object):
+    """Executes file output functions in a background thread.
+
+    Functions are executed in the order they are submitted.  Any exception
+    raised by a function is re-raised in the calling thread on the next call
+    to :meth:`submit`, :meth:`flush`, or :meth:`close`.
+
+    Note that the arguments are not copied, so the caller is responsible for
+    passing data that will not be modified while the write is pending.
+
+    :param int max_pending: maximum number of functions waiting to be
+        executed; :meth:`submit` blocks when this many are pending (so that
+        data waiting to be written can't accumulate without limit if writes
+        are slower than the training loop)
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+
+                func, args, kwargs = item
+                func(*args, **kwargs)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        """Re-raise any error that occurred in the background thread."""
+
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)`` to run in the background
+        (blocking if ``max_pending`` functions are already waiting)."""
+
+        self.check()
+
+        if not self.thread.is_alive():
+            raise RuntimeError("Submitting to closed writer")
+
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """Block until all submitted functions have completed."""
+
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """Complete all pending writes and shut down the background thread."""
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+
+def _replace(src, dst):
+    """Rename ``src`` to ``dst``, overwriting ``dst`` if it exists."""
+
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # note: on Python 2 os.rename fails on Windows if dst exists, so it
+        # has to be removed first (which means the replacement isn't atomic
+        # on that platform)
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def _create_temp(filename, mode):
+    """Create a new temporary file next to ``filename``.
+
+    Unlike ``tempfile.mkstemp`` (which always uses mode 0600), the file is
+    created with the normal permissions for new files (i.e., 0666 minus the
+    umask, which is applied by the OS).
+
+    :returns: ``(fd, name)`` of the open file
+    """
+
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY
+    if "b" in mode:
+        flags |= getattr(os, "O_BINARY", 0)
+
+    while True:
+        name = "%s.%s.tmp" % (os.path.abspath(filename), uuid.uuid4().hex)
+        try:
+            return os.open(name, flags, 0o666), name
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def atomic_write(filename, write_func, mode="wb"):
+    """Write a file such that readers will never see a partially written
+    version.
+
+    The data is written to a temporary file in the same directory, which
+    then replaces ``filename`` in a single step.
+
+    :param str filename: name of the output file
+    :param write_func: function that will be called with the open file
+        object to write the contents
+    :param str mode: mode used to open the file
+    """
+
+    fd, tmp_name = _create_temp(filename, mode)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(tmp_name, filename)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+
+def save_checkpoint(filename, state):
+    """Atomically save a training checkpoint.
+
+    :param str filename: name of the checkpoint file
+    :param dict state: training state (see :meth:`.FFNet.run_epochs`)
+    """
+
+    state = dict(state, version=CHECKPOINT_VERSION)
+    atomic_write(filename, lambda f: pickle.dump(
+        state, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_checkpoint(filename):
+    """Load a training checkpoint saved by :func:`save_checkpoint`.
+
+    :param str filename: name of the checkpoint file
+    """
+
+    with open(filename, "rb") as f:
+        state = pickle.load(f)
+
+    version = state.get("version", None)
+    if version != CHECKPOINT_VERSION:
+        raise ValueError("Checkpoint version (%s) does not match current "
+                         "version (%s)" % (version, CHECKPOINT_VERSION))
+
+    return state
+
+
+def save_array(filename, array):
+    """Atomically save an array in ``.npy`` format.
+
+    :param str filename: name of the output file
+    :param array: data to be saved
+    :type array: :class:`~numpy:numpy.ndarray`
+    """
+
+    atomic_write(filename, lambda f: np.save(f, array))
+
+
+def append_record(filename, record):
+    """Append a record to a line-delimited JSON log file.
+
+    :param str filename: name of the log file
+    :param dict record: JSON-serializable data to be appended
+    """
+
+    with open(filename, "ab") as f:
+        f.write((json.dumps(record) + "\n").encode("utf-8"))
+
+
+def write_records(filename, records):
+    """Atomically replace the contents of a log file with the given records.
+
+    :param str filename: name of the log file
+    :param list records: list of JSON-serializable records
+    """
+
+    atomic_write(filename, lambda f: f.write(
+        "".join(json.dumps(r) + "\n" for r in records).encode("utf-8")))
+
+
+def read_records(f):
+    """Read all the complete records from the current position of a log file
+    (being written by :func:`append_record`).
+
+    If the last line has only been partially written, it is not read, and
+    the file position is left at the beginning of that line (so that it will
+    be read on the next call, once it is complete).
+
+    :param f: log file opened in binary mode
+    """
+
+    records = []
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            f.seek(pos)
+            return records
+        records += [json.loads(line.decode("utf-8"))]
+
+
+def encode_layer(layer):
+    """Encode a nonlinearity as a JSON-serializable dictionary.
+
+    Built-in nonlinearities are encoded by name and constructor parameters
+    (read from the attributes of the same name); anything else is
+    pickled.
+
+    :param layer: the nonlinearity to be encoded
+    :type layer: :class:`~.nonlinearities.Nonlinearity`
+    """
+
+    # note: imported here to avoid circular import (and to keep import time
+    # down)
+    import inspect
+    from hessianfree import nonlinearities
+
+    cls = type(layer)
+    if getattr(nonlinearities, cls.__name__, None) is cls:
+        try:
+            spec = inspect.getfullargspec(cls.__init__)
+        except AttributeError:
+            spec = inspect.getargspec(cls.__init__)
+
+        params = {}
+        for arg in spec.args[1:]:
+            if not hasattr(layer, arg):
+                break
+            val = getattr(layer, arg)
+            if isinstance(val, nonlinearities.Nonlinearity):
+                val = encode_layer(val)
+            elif isinstance(val, (np.generic, np.ndarray)):
+                val = val.tolist()
+            params[arg] = val
+        else:
+            try:
+                # make sure the parameters can be serialized
+                json.dumps(params)
+                return {"type": cls.__name__, "params": params}
+            except TypeError:
+                pass
+
+    return {"pickle": base64.b64encode(pickle.dumps(
+        layer, protocol=pickle.HIGHEST_PROTOCOL)).decode("ascii")}
+
+
+def decode_layer(data):
+    """Reconstruct a nonlinearity encoded by :func:`encode_layer`."""
+
+    from hessianfree import nonlinearities
+
+    if "pickle" in data:
+        return pickle.loads(base64.b64decode(data["pickle"]))
+
+    params = dict((k, decode_layer(v) if isinstance(v, dict) else v)
+                  for k, v in data["params"].items())
+    return getattr(nonlinearities, data["type"])(**params)
+
+
+def encode_connection(conn):
+    """Encode a connection type as a JSON-serializable dictionary.
+
+    Built-in connection types are encoded by name and the parameters returned
+    by :meth:`~.connections.Connection.get_config` (sparse matrices are stored
+    by their compressed column indices); anything else is pickled.
+
+    :param conn: the connection type to be encoded
+    :type conn: :class:`~.connections.Connection`
+    """
+
+    from hessianfree import connections
+
+    cls = type(conn)
+    if getattr(connections, cls.__name__, None) is cls:
+        params = {}
+        for k, val in conn.get_config().items():
+            if hasattr(val, "tocsc"):
+                # scipy sparse matrix
+                val = val.tocsc()
+                val = {"csc": {"shape": [int(x) for x in val.shape],
+                               "indices": val.indices.tolist(),
+                               "indptr": val.indptr.tolist()}}
+            elif isinstance(val, (np.generic, np.ndarray)):
+                val = val.tolist()
+            params[k] = val
+
+        try:
+            json.dumps(params)
+            return {"type": cls.__name__, "params": params}
+        except TypeError:
+            pass
+
+    return {"pickle": base64.b64encode(pickle.dumps(
+        conn, protocol=pickle.HIGHEST_PROTOCOL)).decode("ascii")}
+
+
+def decode_connection(data):
+    """Reconstruct a connection type encoded by :func:`encode_connection`."""
+
+    from hessianfree import connections
+
+    if "pickle" in data:
+        return pickle.loads(base64.b64decode(data["pickle"]))
+
+    params = {}
+    for k, val in data["params"].items():
+        if isinstance(val, dict) and "csc" in val:
+            import scipy.sparse
+
+            val = val["csc"]
+            val = scipy.sparse.csc_matrix(
+                (np.ones(len(val["indices"]), dtype=bool), val["indices"],
+                 val["indptr"]), shape=val["shape"])
+        params[k] = val
+
+    return getattr(connections, data["type"])(**params)
+
+
+def save_model(net, filename):
+    """Save a network's architecture and weights to a single file.
+
+    The file consists of a JSON header describing the network (shape,
+    nonlinearities, connections and their types, dtype, etc.), followed by
+    the weights as a raw array (aligned so that it can be memory-mapped by
+    :func:`load_model`).  Note that the loss function and optimizer are not
+    saved.
+
+    :param net: the network to be saved
+    :type net: :class:`.FFNet` or :class:`.RNNet`
+    :param str filename: name of the output file
+    """
+
+    from hessianfree import RNNet, connections
+
+    header = {"version": MODEL_VERSION,
+              "class": "RNNet" if isinstance(net, RNNet) else "FFNet",
+              "shape": [int(x) for x in net.shape],
+              "layers": [encode_layer(l) for l in net.layers],
+              "conns": dict((str(pre), [int(x) for x in post])
+                            for pre, post in net.conns.items()
+                            if len(post) > 0),
+              "conn_types": dict(
+                  ("%d,%d" % c, encode_connection(t))
+                  for c, t in net.conn_types.items()
+                  if not isinstance(t, connections.Dense)),
+              "dtype": np.dtype(net.dtype).str,
+              "n_weights": len(net.W)}
+    if isinstance(net, RNNet):
+        header["rec_layers"] = [int(x) for x in net.rec_layers]
+        header["truncation"] = (None if net.truncation is None else
+                                [int(x) for x in net.truncation])
+    header = json.dumps(header).encode("utf-8")
+
+    # pad the header so that the weights start on an aligned offset
+    offset = len(MODEL_MAGIC) + 4 + len(header)
+    header += b" " * (-offset % MODEL_ALIGN)
+
+    def write(f):
+        f.write(MODEL_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        np.ascontiguousarray(net.W, dtype=net.dtype).tofile(f)
+
+    atomic_write(filename, write)
+
+
+def load_model(filename, mmap_mode="c", **kwargs):
+    """Load a network saved by :func:`save_model`.
+
+    By default the weights are memory-mapped, rather than read into memory,
+    so that many processes can load (and share the memory of) a large model
+    with little overhead.
+
+    :param str filename: name of the model file
+    :param str mmap_mode: mode used to memory-map the weights (see
+        :class:`~numpy:numpy.memmap`); the default ``"c"`` (copy-on-write)
+        allows the weights to be modified in memory without changing the
+        file.  If None, the weights will be read into memory instead.
+    :param kwargs: any additional arguments (e.g., ``loss_type``) are passed
+        to the network constructor
+    """
+
+    import hessianfree as hf
+
+    with open(filename, "rb") as f:
+        if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise ValueError("%s is not a model file" % filename)
+        header_len = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        offset = f.tell()
+
+        if header["version"] != MODEL_VERSION:
+            raise ValueError("Model version (%s) does not match current "
+                             "version (%s)" % (header["version"],
+                                               MODEL_VERSION))
+
+        dtype = np.dtype(header["dtype"])
+        if mmap_mode is None:
+            W = np.fromfile(f, dtype=dtype, count=header["n_weights"])
+        else:
+            W = np.memmap(filename, dtype=dtype, mode=mmap_mode,
+                          offset=offset, shape=(header["n_weights"],))
+
+    args = {"layers": [decode_layer(l) for l in header["layers"]],
+            "conns": dict((int(pre), post)
+                          for pre, post in header["conns"].items()),
+            "dtype": dtype.type, "load_weights": W}
+    conn_types = header.get("conn_types", {})
+    if len(conn_types) > 0:
+        args["conn_types"] = dict(
+            (tuple(int(x) for x in c.split(",")), decode_connection(t))
+            for c, t in conn_types.items())
+    if header["class"] == "RNNet":
+        args["rec_layers"] = header["rec_layers"]
+        args["truncation"] = (None if header["truncation"] is None else
+                              tuple(header["truncation"]))
+    args.update(kwargs)
+
+    return getattr(hf, header["class"])(header["shape"], **args)
@@ -0,0 +1,529 @@
+"""Lightweight inference-only versions of trained networks.
+
+These are created via :meth:`.FFNet.export_predictor` or
+:meth:`.RNNet.export_predictor`.
+"""
+
+from __future__ import print_function
+
+import copy
+import threading
+import time
+
+import numpy as np
+
+import hessianfree as hf
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Predictor(object):
+    """Frozen, inference-only version of a trained :class:`.FFNet`.
+
+    The weights are copied out of the network's parameter vector into
+    contiguous matrices (in topological order), the biases on all the
+    connections into a layer are combined, and the buffers used to compute
+    each layer's input are allocated ahead of time.  No derivatives, losses,
+    or finiteness checks are computed.
+
+    Note that because of the preallocated buffers a Predictor should not be
+    called from multiple threads simultaneously.
+
+    :param net: the trained network
+    :type net: :class:`.FFNet`
+    :param int max_batch_size: buffers are allocated for this many inputs;
+        larger batches will be processed in chunks of this size
+    """
+
+    def __init__(self, net, max_batch_size=256):
+        self.shape = list(net.shape)
+        self.n_layers = net.n_layers
+        self.dtype = net.dtype
+        self.max_batch_size = max_batch_size
+
+        # note: we make a copy of the nonlinearities, so that any internal
+        # state is kept separate from the original network
+        self.layers = copy.deepcopy(net.layers)
+
+        # weight matrices (and connection type) for each connection into each
+        # layer, and the combined bias for each layer
+        self.W = [[] for _ in range(self.n_layers)]
+        self.b = [None for _ in range(self.n_layers)]
+        for post in range(1, self.n_layers):
+            self.b[post] = np.zeros(self.shape[post], dtype=self.dtype)
+            for pre in net.back_conns[post]:
+                conn = net.conn_types[(pre, post)]
+                offset, W_end, b_end = net.offsets[(pre, post)]
+                W = conn.reshape(np.array(net.W[offset:W_end],
+                                          dtype=self.dtype),
+                                 self.shape[pre], self.shape[post])
+                self.W[post] += [(pre, conn, W)]
+                self.b[post] += net.W[W_end:b_end]
+
+        self.buffers = self.alloc_buffers()
+        self.tmp = self.alloc_buffers()
+
+    def alloc_buffers(self):
+        """Allocate a buffer for the input to each layer."""
+
+        return [np.zeros((self.max_batch_size, l), dtype=self.dtype)
+                for l in self.shape]
+
+    def ff_input(self, i, activations, out, tmp):
+        """Compute the feedforward input to layer ``i``.
+
+        :param int i: index of the layer
+        :param list activations: activations of the lower layers
+        :param out: output buffer
+        :param tmp: temporary buffer (same shape as ``out``)
+        """
+
+        for j, (pre, conn, W) in enumerate(self.W[i]):
+            if j == 0:
+                conn.dot(activations[pre], W, out=out)
+            else:
+                out += conn.dot(activations[pre], W, out=tmp)
+        if len(self.W[i]) == 0:
+            out[...] = 0
+        out += self.b[i]
+
+        return out
+
+    def predict(self, inputs):
+        """Compute the network output for the given inputs.
+
+        :param inputs: input vectors (can be a :mod:`scipy:scipy.sparse`
+            matrix, as in :meth:`.FFNet.forward`)
+        :type inputs: :class:`~numpy:numpy.ndarray`
+        :returns: the output of the last layer
+        """
+
+        if hf.connections.issparse(inputs):
+            inputs = inputs.tocsr().astype(self.dtype, copy=False)
+        else:
+            inputs = np.asarray(inputs, dtype=self.dtype)
+        outputs = np.zeros(inputs.shape[:-1] + (self.shape[-1],),
+                           dtype=self.dtype)
+
+        for start in range(0, inputs.shape[0], self.max_batch_size):
+            end = min(start + self.max_batch_size, inputs.shape[0])
+            outputs[start:end] = self.predict_chunk(inputs[start:end])
+
+        return outputs
+
+    def predict_chunk(self, inputs):
+        """Compute the network output for a batch no larger than
+        ``max_batch_size``."""
+
+        n = inputs.shape[0]
+        activations = [None for _ in range(self.n_layers)]
+        for i in range(self.n_layers):
+            if i == 0:
+                x = inputs
+            else:
+                x = self.ff_input(i, activations, self.buffers[i][:n],
+                                  self.tmp[i][:n])
+            activations[i] = self.layers[i].activation(x)
+
+        return activations[-1]
+
+    __call__ = predict
+
+
+class RNNPredictor(Predictor):
+    """Frozen, inference-only version of a trained :class:`.RNNet`.
+
+    Only the activations of the previous timestep are retained for each
+    layer, so memory use does not depend on the length of the sequence.
+    Note that inputs generated by a :class:`~.nonlinearities.Plant` are
+    not supported.
+
+    See :class:`Predictor` for parameter descriptions.
+    """
+
+    def __init__(self, net, max_batch_size=256):
+        super(RNNPredictor, self).__init__(net, max_batch_size)
+
+        self.rec_layers = [i for i in range(self.n_layers)
+                           if i in net.rec_layers]
+        self.W_rec = [None for _ in range(self.n_layers)]
+        self.b_rec = [None for _ in range(self.n_layers)]
+        for i in self.rec_layers:
+            W, b = net.get_weights(net.W, (i, i))
+            self.W_rec[i] = np.array(W, dtype=self.dtype, order="C")
+            self.b_rec[i] = np.array(b, dtype=self.dtype)
+
+        # alternate between two sets of buffers on each timestep, so that
+        # the previous timestep's activations aren't overwritten
+        self.buffers = [self.buffers, self.alloc_buffers()]
+
+    def step(self, inputs, prev, parity=0):
+        """Advance the network by one timestep.
+
+        :param inputs: input vectors for this timestep, shape
+            ``(batch_size, input_dim)``
+        :param list prev: activations of each layer on the previous timestep
+            (or None if this is the first timestep)
+        :param int parity: which set of buffers to use (should alternate
+            between timesteps)
+        :returns: list of activations for each layer
+        """
+
+        n = inputs.shape[0]
+        activations = [None for _ in range(self.n_layers)]
+        for i in range(self.n_layers):
+            if i == 0:
+                x = inputs
+            else:
+                x = self.ff_input(i, activations,
+                                  self.buffers[parity][i][:n],
+                                  self.tmp[i][:n])
+
+            if i in self.rec_layers:
+                if prev is None:
+                    # apply bias input on first timestep
+                    rec_input = self.b_rec[i]
+                else:
+                    rec_input = np.dot(prev[i], self.W_rec[i],
+                                       out=self.tmp[i][:n])
+
+                # note: don't modify the input array in place
+                x = x + rec_input if i == 0 else np.add(x, rec_input, out=x)
+
+            activations[i] = self.layers[i].activation(x)
+
+        return activations
+
+    def predict_chunk(self, inputs):
+        for l in self.layers:
+            l.reset()
+
+        outputs = np.zeros(inputs.shape[:-1] + (self.shape[-1],),
+                           dtype=self.dtype)
+        activations = None
+        for s in range(inputs.shape[1]):
+            activations = self.step(inputs[:, s], activations, parity=s % 2)
+            outputs[:, s] = activations[-1]
+
+        return outputs
+
+    def stream(self, n_streams=1):
+        """Create an :class:`RNNStream` for step-by-step inference.
+
+        :param int n_streams: number of independent input streams
+        """
+
+        return RNNStream(self, n_streams)
+
+
+class RNNStream(object):
+    """Runs an :class:`RNNPredictor` incrementally on a batch of independent
+    input streams, carrying the recurrent activations and nonlinearity state
+    between calls.
+
+    Each call to :meth:`step` (or :meth:`run`) continues from where the
+    previous one left off, so the cost per timestep does not depend on the
+    length of the history.
+
+    :param predictor: the predictor to be run (the weights are shared, but
+        the stream has its own copies of the nonlinearities and buffers)
+    :type predictor: :class:`RNNPredictor`
+    :param int n_streams: number of independent input streams
+    """
+
+    def __init__(self, predictor, n_streams=1):
+        self.n_streams = n_streams
+
+        self.net = copy.copy(predictor)
+        self.net.layers = copy.deepcopy(predictor.layers)
+        self.net.max_batch_size = n_streams
+        self.net.buffers = [self.net.alloc_buffers(),
+                            self.net.alloc_buffers()]
+        self.net.tmp = self.net.alloc_buffers()
+
+        self.reset()
+
+    def reset(self, init_activations=None, init_state=None):
+        """Start a new sequence in all streams.
+
+        :param list init_activations: initial values for the activations in
+            each layer (see :meth:`.RNNet.forward`)
+        :param list init_state: initial values for the internal state of any
+            stateful nonlinearities
+        """
+
+        for i, l in enumerate(self.net.layers):
+            l.reset(None if init_state is None else init_state[i])
+
+        self.activations = (None if init_activations is None else
+                            [np.array(a, dtype=self.net.dtype)
+                             for a in init_activations])
+        self.parity = 0
+
+    def step(self, inputs):
+        """Advance all the streams by one timestep.
+
+        :param inputs: input for each stream, shape ``(n_streams, input_dim)``
+        :type inputs: :class:`~numpy:numpy.ndarray`
+        :returns: network output for each stream, shape
+            ``(n_streams, output_dim)``
+        """
+
+        inputs = np.asarray(inputs, dtype=self.net.dtype)
+        if inputs.shape[0] != self.n_streams:
+            raise ValueError("Input batch size (%d) does not match number "
+                             "of streams (%d)" % (inputs.shape[0],
+                                                  self.n_streams))
+
+        self.activations = self.net.step(inputs, self.activations,
+                                         parity=self.parity)
+        self.parity = 1 - self.parity
+
+        return self.activations[-1].copy()
+
+    def run(self, inputs):
+        """Advance all the streams by several timesteps.
+
+        :param inputs: input for each stream, shape
+            ``(n_streams, n_steps, input_dim)``
+        :type inputs: :class:`~numpy:numpy.ndarray`
+        :returns: network output for each stream, shape
+            ``(n_streams, n_steps, output_dim)``
+        """
+
+        outputs = np.zeros(np.shape(inputs)[:-1] + (self.net.shape[-1],),
+                           dtype=self.net.dtype)
+        for s in range(outputs.shape[1]):
+            outputs[:, s] = self.step(inputs[:, s])
+
+        return outputs
+
+
+class BatchServer(object):
+    """Coalesces concurrent inference requests into larger batches.
+
+    Requests can be submitted from any number of threads.  A single
+    background thread collects pending requests until either
+    ``max_batch_size`` inputs have accumulated or the oldest request has
+    waited for ``max_latency`` seconds, evaluates them all with one call
+    to the model, and then returns the corresponding outputs to each
+    request.
+
+    Requests are only combined if their inputs have the same shape (apart
+    from the batch dimension), e.g. RNN inputs with the same sequence length.
+
+    :param model: the network used to compute the outputs; this can be
+        a :class:`Predictor` or a trained :class:`.FFNet`/:class:`.RNNet`
+        (in which case the output of the last layer of
+        :meth:`~.FFNet.forward` is returned)
+    :param int max_batch_size: maximum number of inputs evaluated at once
+    :param float max_latency: maximum time (in seconds) that a request will
+        wait for other requests to arrive
+    """
+
+    def __init__(self, model, max_batch_size=64, max_latency=0.005):
+        try:
+            from concurrent.futures import Future
+        except ImportError:
+            raise ImportError("BatchServer requires concurrent.futures "
+                              "(install the 'futures' package on Python 2)")
+        self.Future = Future
+
+        if hasattr(model, "predict"):
+            self.func = model.predict
+        else:
+            self.func = lambda x: model.forward(x)[-1]
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reset_stats()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, inputs):
+        """Submit a request to be evaluated.
+
+        :param inputs: batch of input vectors
+        :type inputs: :class:`~numpy:numpy.ndarray`
+        :returns: :class:`~concurrent.futures.Future` that will contain the
+            model output for ``inputs``
+        """
+
+        inputs = np.asarray(inputs)
+        future = self.Future()
+
+        # note: the check and the put are done together under the lock, so
+        # that nothing can be added after close() adds the sentinel
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Submitting to closed server")
+            self.queue.put((inputs, future, time.time()))
+
+        return future
+
+    def predict(self, inputs, timeout=None):
+        """Submit a request and wait for the result.
+
+        See :meth:`submit` for parameter descriptions.
+
+        :param float timeout: maximum time (in seconds) to wait for result
+        """
+
+        return self.submit(inputs).result(timeout=timeout)
+
+    def close(self):
+        """Evaluate any pending requests and shut down the server."""
+
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        try:
+            self._serve()
+        finally:
+            with self.lock:
+                self.closed = True
+
+            # any requests remaining in the queue will never be evaluated,
+            # so fail them rather than leaving them waiting forever
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None and item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(RuntimeError("server closed"))
+
+    def _serve(self):
+        """Main loop of the background thread."""
+
+        pending = None
+        closing = False
+        while not closing:
+            # wait for a new request
+            item = self.queue.get() if pending is None else pending
+            pending = None
+            if item is None:
+                break
+
+            # collect additional requests until the batch is full or the
+            # deadline is reached
+            batch = [item]
+            n = len(item[0])
+            deadline = item[2] + self.max_latency
+            while n < self.max_batch_size:
+                # note: once the deadline has passed we still add any
+                # requests that are already waiting
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        item = self.queue.get(timeout=remaining)
+                    else:
+                        item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    closing = True
+                    break
+
+                if n + len(item[0]) > self.max_batch_size:
+                    # save this request for the next batch
+                    pending = item
+                    break
+
+                batch += [item]
+                n += len(item[0])
+
+            self._process(batch)
+
+        # shut down
+        if pending is not None:
+            self._process([pending])
+
+    def _process(self, batch):
+        """Evaluate a batch of requests and set their results."""
+
+        # skip any requests that have been cancelled
+        batch = [b for b in batch if b[1].set_running_or_notify_cancel()]
+
+        # group the requests by input shape
+        groups = {}
+        for b in batch:
+            groups.setdefault((b[0].shape[1:], b[0].dtype), []).append(b)
+
+        for group in groups.values():
+            start = time.time()
+            try:
+                inputs = (group[0][0] if len(group) == 1 else
+                          np.concatenate([g[0] for g in group]))
+                outputs = self.func(inputs)
+            except Exception as e:
+                for g in group:
+                    g[1].set_exception(e)
+                continue
+            end = time.time()
+
+            offset = 0
+            for g in group:
+                g[1].set_result(outputs[offset:offset + len(g[0])])
+                offset += len(g[0])
+
+            with self.lock:
+                self._stats["requests"] += len(group)
+                self._stats["inputs"] += offset
+                self._stats["batches"] += 1
+                self._stats["compute_time"] += end - start
+                latencies = [end - g[2] for g in group]
+                self._stats["total_latency"] += sum(latencies)
+                self._stats["max_latency"] = max(
+                    [self._stats["max_latency"]] + latencies)
+
+    def reset_stats(self):
+        """Reset the statistics returned by :meth:`stats`."""
+
+        with self.lock:
+            self._stats = {"requests": 0, "inputs": 0, "batches": 0,
+                           "compute_time": 0.0, "total_latency": 0.0,
+                           "max_latency": 0.0, "start_time": time.time()}
+
+    def stats(self):
+        """Return throughput/latency statistics for the completed requests
+        (since the server was created or :meth:`reset_stats` was called).
+
+        :returns: dict with the number of ``requests``, ``inputs``, and
+            ``batches`` processed, the ``mean_batch_size``, the
+            ``mean_latency`` and ``max_latency`` of requests (in seconds),
+            and the ``throughput`` (inputs per second)
+        """
+
+        with self.lock:
+            s = dict(self._stats)
+
+        elapsed = time.time() - s.pop("start_time")
+        return {"requests": s["requests"], "inputs": s["inputs"],
+                "batches": s["batches"],
+                "mean_batch_size": s["inputs"] / max(s["batches"], 1.0),
+                "mean_latency": (s["total_latency"] /
+                                 max(s["requests"], 1.0)),
+                "max_latency": s["max_latency"],
+                "compute_time": s["compute_time"],
+                "throughput": s["inputs"] / elapsed if elapsed > 0 else 0.0}
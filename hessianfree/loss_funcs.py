@@ -3,6 +3,104 @@ from functools import wraps
 import numpy as np
 
 
+class Targets(np.ndarray):
+    """Target array with precomputed information about undefined (nan)
+    targets.
+
+    Loss functions need to treat nan targets as zero error, so this
+    computes that information once (rather than on every call).  It is
+    created automatically in :meth:`.FFNet.cache_minibatch`; loss functions
+    also accept plain arrays (in which case the information is computed as
+    needed).
+
+    Note that arithmetic on a Targets array returns a plain array.
+
+    :param targets: target values (may contain nans)
+    :type targets: :class:`~numpy:numpy.ndarray`
+    """
+
+    def __new__(cls, targets):
+        obj = np.asarray(targets).view(cls)
+        obj._info = _nan_info(np.asarray(targets))
+        return obj
+
+    def __array_finalize__(self, obj):
+        # note: copies will recompute the nan info if needed (slices
+        # are handled in __getitem__)
+        self._info = None
+
+    def __getitem__(self, idx):
+        result = super(Targets, self).__getitem__(idx)
+        if isinstance(result, Targets) and self._info is not None:
+            # slice the precomputed info rather than recomputing it (e.g.
+            # for the per-timestep targets in RNNet)
+            zeroed, valid = self._info
+            if valid is not None:
+                valid = valid[idx]
+                if np.all(valid):
+                    valid = None
+            result._info = (zeroed[idx], valid)
+        return result
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.view(np.ndarray) if isinstance(x, Targets) else x
+                  for x in inputs]
+        if "out" in kwargs:
+            kwargs["out"] = tuple(x.view(np.ndarray) if isinstance(x, Targets)
+                                  else x for x in kwargs["out"])
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    @property
+    def zeroed(self):
+        """The targets with nans replaced by zero (a plain array)."""
+
+        if self._info is None:
+            self._info = _nan_info(self.view(np.ndarray))
+        return self._info[0]
+
+    @property
+    def valid(self):
+        """Boolean array indicating which targets are defined (or None if
+        there are no nan targets)."""
+
+        if self._info is None:
+            self._info = _nan_info(self.view(np.ndarray))
+        return self._info[1]
+
+
+def _nan_info(targets):
+    """Compute the nan-zeroed targets and validity mask (None if all the
+    targets are valid)."""
+
+    if not np.issubdtype(targets.dtype, np.inexact):
+        return targets, None
+
+    invalid = np.isnan(targets)
+    if not np.any(invalid):
+        return targets, None
+
+    return np.where(invalid, 0, targets).astype(targets.dtype), ~invalid
+
+
+def target_info(targets):
+    """Return ``(zeroed, valid)`` for the given targets (see
+    :class:`Targets`)."""
+
+    if isinstance(targets, Targets):
+        return targets.zeroed, targets.valid
+    return _nan_info(np.asarray(targets))
+
+
+def _masked_diff(output, targets):
+    """Compute ``output - targets``, with zeros where targets are nan."""
+
+    zeroed, valid = target_info(targets)
+    diff = output - zeroed
+    if valid is not None:
+        diff *= valid
+    return diff
+
+
 class LossFunction:
     """Defines a loss function that maps nonlinearity activations to error."""
 
@@ -29,18 +127,40 @@ class LossFunction:
         raise NotImplementedError()
 
     def d2_loss(self, activities, targets):
-        """Second derivative of loss function (with respect to activities)."""
+        """Second derivative of loss function (with respect to activities).
+
+        For layers where the second derivative is constant, this can return a
+        scalar rather than a full array; this saves memory, and lets
+        :meth:`.FFNet.calc_G` skip the multiplication if the value is 1.
+        """
         raise NotImplementedError()
 
-    def batch_loss(self, activities, targets):
-        """Utility function to compute a single loss value for the network
-        (taking the mean across batches and summing across and within layers).
+    def loss_value(self, activities, targets):
+        """Compute a single loss value for the network (taking the mean
+        across batches and summing across and within layers).
+
+        By default this is computed from :meth:`loss`, but subclasses can
+        override it with a more efficient implementation (since this is
+        called frequently during the optimization, e.g. in the line search).
         """
 
         losses = self.loss(activities, targets)
         return np.sum([np.true_divide(np.sum(l), l.shape[0]) for l in losses
                        if l is not None])
 
+    def batch_loss(self, activities, targets):
+        """Utility function to compute a single loss value for the network
+        (see :meth:`loss_value`)."""
+
+        return self.loss_value(activities, targets)
+
+
+def _flat_dot(a, b):
+    """Sum of the elementwise product of two arrays, computed with a single
+    dot product."""
+
+    return np.dot(np.ravel(a), np.ravel(b))
+
 
 def output_loss(func):
     """Convenience decorator that takes a loss defined for the output layer
@@ -64,16 +184,20 @@ class SquaredError(LossFunction):
 
     @output_loss
     def loss(self, output, targets):
-        return np.sum(np.nan_to_num(output - targets) ** 2,
+        return np.sum(_masked_diff(output, targets) ** 2,
                       axis=tuple(range(1, output.ndim))) / 2
 
+    def loss_value(self, activities, targets):
+        diff = _masked_diff(activities[-1], targets)
+        return _flat_dot(diff, diff) / (2 * diff.shape[0])
+
     @output_loss
     def d_loss(self, output, targets):
-        return np.nan_to_num(output - targets)
+        return _masked_diff(output, targets)
 
     @output_loss
     def d2_loss(self, output, _):
-        return np.ones_like(output)
+        return 1.0
 
 
 class CrossEntropy(LossFunction):
@@ -83,16 +207,21 @@ class CrossEntropy(LossFunction):
     """
     @output_loss
     def loss(self, output, targets):
-        return -np.sum(np.nan_to_num(targets) * np.log(output),
+        return -np.sum(target_info(targets)[0] * np.log(output),
                        axis=tuple(range(1, output.ndim)))
 
+    def loss_value(self, activities, targets):
+        output = activities[-1]
+        return (-_flat_dot(np.log(output), target_info(targets)[0]) /
+                output.shape[0])
+
     @output_loss
     def d_loss(self, output, targets):
-        return -np.nan_to_num(targets) / output
+        return -target_info(targets)[0] / output
 
     @output_loss
     def d2_loss(self, output, targets):
-        return np.nan_to_num(targets) / output ** 2
+        return target_info(targets)[0] / output ** 2
 
 
 class ClassificationError(LossFunction):
@@ -106,10 +235,11 @@ class ClassificationError(LossFunction):
 
     @output_loss
     def loss(self, output, targets):
-        return np.logical_and(np.argmax(output, axis=-1) !=
-                              np.argmax(targets, axis=-1),
-                              np.logical_not(np.isnan(np.sum(targets,
-                                                             axis=-1))))
+        valid = target_info(targets)[1]
+        errors = np.argmax(output, axis=-1) != np.argmax(targets, axis=-1)
+        if valid is not None:
+            errors &= np.all(valid, axis=-1)
+        return errors
 
 
 class StructuralDamping(LossFunction):
@@ -140,6 +270,9 @@ class StructuralDamping(LossFunction):
     def loss(self, activities, _):
         return [None for _ in activities]
 
+    def loss_value(self, activities, _):
+        return 0.0
+
     def d_loss(self, activities, _):
         return [None for _ in activities]
 
@@ -148,7 +281,7 @@ class StructuralDamping(LossFunction):
 
         d2_loss = [None for _ in activities]
         for l in np.arange(len(activities))[self.layers]:
-            d2_loss[l] = np.ones_like(activities[l]) * self.weight * opt_damp
+            d2_loss[l] = self.weight * opt_damp
 
         return d2_loss
 
@@ -176,6 +309,11 @@ class SparseL1(LossFunction):
 
         return loss
 
+    def loss_value(self, activities, _):
+        return sum(self.weight * np.sum(np.abs(activities[l] - self.target)) /
+                   activities[l].shape[0]
+                   for l in np.arange(len(activities))[self.layers])
+
     def d_loss(self, activities, _):
         d_loss = [None for _ in activities]
         for l in np.arange(len(activities))[self.layers]:
@@ -212,6 +350,14 @@ class SparseL2(LossFunction):
 
         return loss
 
+    def loss_value(self, activities, _):
+        result = 0.0
+        for l in np.arange(len(activities))[self.layers]:
+            diff = activities[l] - self.target
+            result += (0.5 * self.weight * _flat_dot(diff, diff) /
+                       diff.shape[0])
+        return result
+
     def d_loss(self, activities, _):
         d_loss = [None for _ in activities]
         for l in np.arange(len(activities))[self.layers]:
@@ -222,7 +368,7 @@ class SparseL2(LossFunction):
     def d2_loss(self, activities, _):
         d2_loss = [None for _ in activities]
         for l in np.arange(len(activities))[self.layers]:
-            d2_loss[l] = np.ones_like(activities[l]) * self.weight
+            d2_loss[l] = self.weight
 
         return d2_loss
 
@@ -243,20 +389,25 @@ class LossSet(LossFunction):
         """Computes the given function for each :class:`LossFunction` in the
         set, and sums the result."""
 
-        # apply each of the loss functions
-        result = [getattr(s, func_name)(activities, targets)
-                  for s in self.set]
-
-        # sum the losses for each layer across the loss functions
-        result = [np.sum([s[i] for s in result if s[i] is not None], axis=0)
-                  for i in range(len(activities))]
-
-        # convert 0.0's (from np.sum([])) back to None
-        result = [None if (isinstance(x, float) and x == 0.0) else x
-                  for x in result]
+        # sum the result for each layer across the loss functions (layers
+        # without any loss stay None)
+        result = [None for _ in activities]
+        for s in self.set:
+            for i, x in enumerate(getattr(s, func_name)(activities, targets)):
+                if x is None:
+                    continue
+                elif result[i] is None:
+                    result[i] = x
+                else:
+                    # note: not done in-place, since x may be referenced by
+                    # the loss function
+                    result[i] = result[i] + x
 
         return result
 
+    def loss_value(self, activities, targets):
+        return sum(s.loss_value(activities, targets) for s in self.set)
+
     def loss(self, activities, targets):
         return self.group_func("loss", activities, targets)
 
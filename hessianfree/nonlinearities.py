@@ -1,6 +1,27 @@
 import numpy as np
 
 
+_expit = None
+
+
+def expit(x):
+    """Logistic function (uses scipy if it is installed).
+
+    Note: scipy is imported the first time this is called, rather than when
+    this module is imported (to keep ``import hessianfree`` fast).
+    """
+
+    global _expit
+    if _expit is None:
+        try:
+            from scipy.special import expit as _expit
+        except ImportError:
+            def _expit(x):
+                return 1 / (1 + np.exp(-x))
+
+    return _expit(x)
+
+
 class Nonlinearity(object):
     """Base class for layer nonlinearities.
 
@@ -46,8 +67,12 @@ class Tanh(Nonlinearity):
 
     def __init__(self):
         super(Tanh, self).__init__()
-        self.activation = np.tanh
-        self.d_activation = lambda _, a: 1 - a ** 2
+
+    def activation(self, x):
+        return np.tanh(x)
+
+    def d_activation(self, _, a):
+        return 1 - a ** 2
 
 
 class Logistic(Nonlinearity):
@@ -63,13 +88,12 @@ class Logistic(Nonlinearity):
 
     def __init__(self):
         super(Logistic, self).__init__()
-        try:
-            from scipy.special import expit
-        except ImportError:
-            def expit(x):
-                return 1 / (1 + np.exp(-x))
-        self.activation = expit
-        self.d_activation = lambda _, a: a * (1 - a)
+
+    def activation(self, x):
+        return expit(x)
+
+    def d_activation(self, _, a):
+        return a * (1 - a)
 
 
 class Linear(Nonlinearity):
@@ -80,8 +104,12 @@ class Linear(Nonlinearity):
 
     def __init__(self):
         super(Linear, self).__init__()
-        self.activation = lambda x: x
-        self.d_activation = lambda x, _: np.ones_like(x)
+
+    def activation(self, x):
+        return x
+
+    def d_activation(self, x, _):
+        return np.ones_like(x)
 
 
 class ReLU(Nonlinearity):
@@ -94,8 +122,13 @@ class ReLU(Nonlinearity):
 
     def __init__(self, max=1e10):
         super(ReLU, self).__init__()
-        self.activation = lambda x: np.clip(x, 0, max)
-        self.d_activation = lambda x, a: x == a
+        self.max = max
+
+    def activation(self, x):
+        return np.clip(x, 0, self.max)
+
+    def d_activation(self, x, a):
+        return x == a
 
 
 class Gaussian(Nonlinearity):
@@ -106,8 +139,12 @@ class Gaussian(Nonlinearity):
 
     def __init__(self):
         super(Gaussian, self).__init__()
-        self.activation = lambda x: np.exp(-x ** 2)
-        self.d_activation = lambda x, a: a * -2 * x
+
+    def activation(self, x):
+        return np.exp(-x ** 2)
+
+    def d_activation(self, x, a):
+        return a * -2 * x
 
 
 class Softmax(Nonlinearity):
@@ -214,6 +251,8 @@ class Continuous(Nonlinearity):
     def __init__(self, base, tau=1.0, dt=1.0):
         super(Continuous, self).__init__(stateful=True)
         self.base = base
+        self.tau = tau
+        self.dt = dt
         self.coeff = dt / tau
 
         self.reset()
@@ -1,10 +1,11 @@
 from __future__ import print_function
 
-import warnings
 from collections import defaultdict
 
 import numpy as np
 
+from hessianfree.solvers import ConjugateGradient, SteihaugCG
+
 
 class Optimizer(object):
     """Base class for optimizers.
@@ -28,22 +29,82 @@ class Optimizer(object):
         """
         raise NotImplementedError()
 
+    def get_state(self):
+        """Return the internal state of the optimizer (e.g., for
+        checkpointing a training run).
+
+        The returned values are copies, so they won't be affected by
+        subsequent calls to :meth:`compute_update`.
+        """
+
+        plots = getattr(self, "plots", {})
+        return {"plots": dict((k, list(v)) for k, v in plots.items())}
+
+    def set_state(self, state):
+        """Restore the internal state returned by :meth:`get_state`."""
+
+        if "plots" in state:
+            self.plots = defaultdict(list, state["plots"])
+
 
 class HessianFree(Optimizer):
     """Use Hessian-free optimization to compute the weight update.
 
     :param int CG_iter: maximum number of CG iterations to run per epoch
-    :param float init_damping: the initial value of the Tikhonov damping
+    :param init_damping: the initial value of the Tikhonov damping (or
+        ``"auto"`` to choose the initial value based on the curvature spectrum
+        of the first minibatch, see :meth:`estimate_spectrum`)
+    :type init_damping: `float` or `str`
     :param bool plotting: if True then collect data for plotting (actual
         plotting handled in parent network)
+    :param solver: solver used to minimize the quadratic approximation each
+        epoch (defaults to :class:`~.solvers.ConjugateGradient`, or
+        :class:`~.solvers.SteihaugCG` if ``trust_region`` is set)
+    :type solver: :class:`~.solvers.Solver`
+    :param float trust_region: if not None, use trust-region step control
+        (starting with this radius) instead of CG backtracking and line search
+    :param str backtracking: method used to search the stored CG deltas for
+        the one with the lowest error; ``"linear"`` scans backwards from the
+        last delta until the error increases, while ``"bisection"`` and
+        ``"golden"`` assume the error is unimodal across the deltas in order
+        to use a logarithmic number of error evaluations
     """
 
-    def __init__(self, CG_iter=250, init_damping=1, plotting=True):
+    # maximum number of error evaluations per update with trust-region
+    # step control
+    tr_evals = 3
+
+    def __init__(self, CG_iter=250, init_damping=1, plotting=True,
+                 solver=None, trust_region=None, backtracking="linear"):
         super(HessianFree, self).__init__()
 
+        if backtracking not in ("linear", "bisection", "golden"):
+            raise ValueError("Unknown backtracking method (%s)" % backtracking)
+
         self.CG_iter = CG_iter
+        self.backtracking = backtracking
         self.init_delta = None
-        self.damping = init_damping
+        self.radius = trust_region
+
+        if solver is None:
+            if trust_region is None:
+                solver = ConjugateGradient()
+            else:
+                solver = SteihaugCG(trust_region)
+        self.solver = solver
+
+        if init_damping == "auto":
+            # note: we still need a placeholder value here, as the damping may
+            # be used (e.g., in StructuralDamping) before the first update
+            self.auto_damping = True
+            self.damping = 1.0
+        else:
+            self.auto_damping = False
+            self.damping = init_damping
+
+        # (min, max) eigenvalue estimates from the last call to
+        # estimate_spectrum
+        self.spectrum = None
 
         self.plotting = plotting
         self.plots = defaultdict(list)
@@ -62,37 +123,41 @@ class HessianFree(Optimizer):
             print("initial err", err)
             print("grad norm", np.linalg.norm(grad))
 
+        if self.auto_damping:
+            # pick the initial damping based on the spectrum of the first batch
+            self.auto_damping = False
+            self.damping = self.init_damping_from_spectrum(
+                *self.estimate_spectrum())
+
+            if printing:
+                print("spectrum estimate", self.spectrum)
+                print("initial damping", self.damping)
+
         # run CG
         if self.init_delta is None:
             self.init_delta = np.zeros_like(self.net.W)
-        deltas = self.conjugate_gradient(self.init_delta * 0.95, grad,
-                                         iters=self.CG_iter,
-                                         printing=printing and self.net.debug)
+        if self.radius is not None and hasattr(self.solver, "radius"):
+            self.solver.radius = self.radius
+        deltas = self.solver.solve(self.init_delta * 0.95, grad,
+                                   iters=self.CG_iter,
+                                   printing=printing and self.net.debug)
 
         if printing:
             print("CG steps", deltas[-1][0])
 
         self.init_delta = deltas[-1][1]  # note: don't backtrack this
 
+        if self.radius is not None:
+            return self.trust_region_update(err, grad, deltas, printing)
+
         # CG backtracking
-        new_err = np.inf
-        for j in range(len(deltas) - 1, -1, -1):
-            prev_err = self.net.error(self.net.W + deltas[j][1])
-            # note: we keep using the cached inputs, not rerunning the plant
-            # (if there is one). that is, we are evaluating whether the update
-            # improves on those inputs, not whether it improves the overall
-            # objective. we could do the latter instead, but it makes things
-            # more prone to instability.
-            if prev_err > new_err:
-                break
-            delta = deltas[j][1]
-            new_err = prev_err
-        else:
-            j -= 1
+        j, new_err, n_evals = self.backtrack(deltas)
+        delta = deltas[j][1]
 
         if printing:
-            print("using iteration", deltas[j + 1][0])
+            print("using iteration", deltas[j][0])
             print("backtracked err", new_err)
+            print("backtracking evaluations", n_evals)
 
         # update damping parameter (compare improvement predicted by
         # quadratic model to the actual improvement in the error)
@@ -101,10 +166,7 @@ class HessianFree(Optimizer):
                 np.dot(grad, delta))
 
         improvement_ratio = ((new_err - err) / quad) if quad != 0 else 1
-        if improvement_ratio < 0.25:
-            self.damping *= 1.5
-        elif improvement_ratio > 0.75:
-            self.damping *= 0.66
+        self.update_damping(improvement_ratio)
 
         if printing:
             print("improvement_ratio", improvement_ratio)
@@ -138,119 +200,262 @@ class HessianFree(Optimizer):
             self.plots["damping (log)"] += [self.damping]
             self.plots["CG iterations"] += [deltas[-1][0]]
             self.plots["backtracked steps"] += [deltas[-1][0] -
-                                                deltas[j + 1][0]]
+                                                deltas[j][0]]
+            self.plots["backtracking evaluations"] += [n_evals]
 
         return l_rate * delta
 
-    def conjugate_gradient(self, init_delta, grad, iters=250, printing=False):
-        """Find minimum of quadratic approximation using conjugate gradient
-        algorithm."""
+    def backtrack(self, deltas):
+        """Find the stored CG delta with the lowest error.
 
-        if self.net.debug:
-            self.net.check_grad(grad)
+        :param list deltas: output of the solver
+        :returns: tuple of the index of the chosen delta, the error of that
+            delta, and the number of error evaluations used
+        """
 
-        store_iter = 5
-        store_mult = 1.3
-        deltas = []
-        grad = -grad  # note negative, some CG algorithms are flipped
-        vals = np.zeros(iters, dtype=self.net.dtype)
+        errs = {}
+
+        def error(j):
+            if j not in errs:
+                # note: we keep using the cached inputs, not rerunning the
+                # plant (if there is one). that is, we are evaluating whether
+                # the update improves on those inputs, not whether it improves
+                # the overall objective. we could do the latter instead, but it
+                # makes things more prone to instability.
+                errs[j] = self.net.error(self.net.W + deltas[j][1])
+            return errs[j]
+
+        lo, hi = 0, len(deltas) - 1
+        if self.backtracking == "linear":
+            j = hi
+            for i in range(hi - 1, -1, -1):
+                if error(i) > error(j):
+                    break
+                j = i
+
+            return j, error(j), len(errs)
+
+        if self.backtracking == "bisection":
+            # compare neighbouring deltas to find which side of the minimum
+            # we are on
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if error(mid) <= error(mid + 1):
+                    hi = mid
+                else:
+                    lo = mid + 1
+        else:
+            # golden section search (note: errors are cached, so the interior
+            # point carried over between iterations is not re-evaluated)
+            while hi - lo > 2:
+                offset = int((hi - lo) * 0.381966)
+                if error(lo + offset) <= error(hi - offset):
+                    hi = hi - offset
+                else:
+                    lo = lo + offset
+
+        # pick the best of the remaining candidates (preferring later deltas)
+        j = min(range(hi, lo - 1, -1), key=error)
+
+        return j, error(j), len(errs)
+
+    def trust_region_update(self, err, grad, deltas, printing=False):
+        """Compute the weight update using trust-region step control.
+
+        The radius of the trust region is adapted based on the ratio of
+        actual to predicted improvement, and if the step is rejected it is
+        shrunk to the new radius and re-evaluated (up to ``tr_evals`` error
+        evaluations in total).
+
+        :param float err: error before the update
+        :param grad: gradient for the current batch
+        :type grad: :class:`~numpy:numpy.ndarray`
+        :param list deltas: output of the solver
+        :param bool printing: if True, print out data about the optimization
+        """
 
-        if self.net.use_GPU:
-            from pycuda import gpuarray
-            base_grad = gpuarray.to_gpu(grad)
-            delta = gpuarray.to_gpu(init_delta)
-            G_dir = gpuarray.zeros(grad.shape, dtype=self.net.dtype)
-            self.calc_G = self.net.GPU_calc_G
+        delta = deltas[-1][1]
 
-            def dot(a, b):
-                return gpuarray.dot(a, b).get()
+        # we only need one curvature product, since the quadratic model along
+        # delta is a function of these two values
+        dGd = np.dot(self.calc_G(delta, damping=self.damping), delta)
+        gd = np.dot(grad, delta)
 
-            def get(x):
-                return x.get(pagelocked=True)
-        else:
-            base_grad = grad
-            delta = init_delta
-            G_dir = np.zeros_like(grad)
-            self.calc_G = self.net.calc_G
-            dot = np.dot
-            get = np.copy
-
-        residual = base_grad.copy()
-        residual -= self.calc_G(delta, damping=self.damping, out=G_dir)
-        res_norm = dot(residual, residual)
-        direction = residual.copy()
+        norm = np.linalg.norm(delta)
+        l_rate = 1.0 if norm <= self.radius else self.radius / norm
 
-        for i in range(iters):
-            if printing:
-                print("-" * 20)
-                print("CG iteration", i)
-                print("delta norm", np.linalg.norm(get(delta)))
-                print("direction norm", np.linalg.norm(get(direction)))
+        for i in range(self.tr_evals):
+            new_err = self.net.error(self.net.W + l_rate * delta)
 
-            self.calc_G(direction, damping=self.damping, out=G_dir)
+            quad = 0.5 * l_rate ** 2 * dGd + l_rate * gd
+            improvement_ratio = ((new_err - err) / quad) if quad != 0 else 1
 
-            # calculate step size
-            step = res_norm / dot(direction, G_dir)
+            if i == 0:
+                self.update_damping(improvement_ratio)
 
-            if not np.isfinite(step):
-                warnings.warn("Non-finite step value (%f)" % step)
-                break
+            step_norm = l_rate * norm
+            if improvement_ratio < 0.25:
+                # note: we don't let the radius collapse all the way to zero,
+                # as then it could never grow again
+                self.radius = max(0.25 * step_norm, 1e-10)
+            elif improvement_ratio > 0.75 and step_norm >= 0.99 * self.radius:
+                self.radius *= 2
 
             if printing:
-                print("G_dir norm", np.linalg.norm(get(G_dir)))
-                print("step", step)
-
-            if self.net.debug:
-                tmp_G_dir = get(G_dir)
-                tmp_dir = get(direction)
-                self.net.check_G(tmp_G_dir, tmp_dir, self.damping)
-
-                assert np.isfinite(step)
-                assert step >= 0
-                assert (np.linalg.norm(np.dot(tmp_dir, tmp_G_dir)) >=
-                        np.linalg.norm(np.dot(tmp_dir,
-                                              self.net.calc_G(tmp_dir,
-                                                              damping=0))))
-
-            # update weight delta
-            delta += step * direction
-
-            # update residual
-            residual -= step * G_dir
-            new_res_norm = dot(residual, residual)
-
-            if new_res_norm < 1e-20:
-                # early termination (mainly to prevent numerical errors);
-                # the main termination condition is below.
+                print("l_rate", l_rate)
+                print("l_rate err", new_err)
+                print("improvement_ratio", improvement_ratio)
+                print("trust radius", self.radius)
+
+            if improvement_ratio > 0 and new_err <= err:
                 break
 
-            # update direction
-            beta = new_res_norm / res_norm
-            direction *= beta
-            direction += residual
+            # shrink the step to the new radius
+            l_rate = min(l_rate, self.radius / norm)
+        else:
+            # no good update, so skip this iteration
+            l_rate = 0.0
+            new_err = err
 
-            res_norm = new_res_norm
+        if printing:
+            print("damping", self.damping)
+            print("improvement", new_err - err)
 
-            # store deltas for backtracking
-            if i == store_iter:
-                deltas += [(i, get(delta))]
-                store_iter = int(store_iter * store_mult)
+        if self.plotting:
+            self.plots["training error (log)"] += [new_err]
+            self.plots["learning rate"] += [l_rate]
+            self.plots["damping (log)"] += [self.damping]
+            self.plots["CG iterations"] += [deltas[-1][0]]
+            self.plots["trust radius (log)"] += [self.radius]
 
-            # martens termination conditions
-            vals[i] = -0.5 * dot(residual + base_grad, delta)
+        return l_rate * delta
 
-            gap = max(int(0.1 * i), 10)
+    def get_state(self):
+        state = super(HessianFree, self).get_state()
+        state.update(damping=self.damping, auto_damping=self.auto_damping,
+                     radius=self.radius,
+                     init_delta=(None if self.init_delta is None else
+                                 np.array(self.init_delta)))
+        return state
 
-            if printing:
-                print("termination val", vals[i])
+    def set_state(self, state):
+        super(HessianFree, self).set_state(state)
+        for k in ("damping", "auto_damping", "radius", "init_delta"):
+            if k in state:
+                setattr(self, k, state[k])
+
+    def update_damping(self, improvement_ratio):
+        """Adapt the damping based on the ratio of the actual improvement to
+        the improvement predicted by the quadratic model."""
+
+        if improvement_ratio < 0.25:
+            self.damping *= 1.5
+        elif improvement_ratio > 0.75:
+            self.damping *= 0.66
+
+    def calc_G(self, v, damping=0):
+        """Compute Gauss-Newton matrix-vector product for the current batch
+        (on the GPU if the network is using it)."""
+
+        if self.net.use_GPU:
+            return self.net.GPU_calc_G(v, damping=damping)
+
+        return self.net.calc_G(v, damping=damping)
+
+    def estimate_spectrum(self, iters=20, damping=0):
+        """Estimate the smallest and largest eigenvalues of the Gauss-Newton
+        matrix for the current batch, using the Lanczos algorithm.
+
+        Note that the smallest eigenvalue converges more slowly than the
+        largest, so for small ``iters`` it should be treated as an upper
+        bound.
+
+        :param int iters: number of Lanczos iterations (each requires one
+            curvature-vector product)
+        :param float damping: Tikhonov damping applied to the curvature matrix
+        :returns: tuple of (min, max) eigenvalue estimates (also stored in
+            ``self.spectrum``)
+        """
+
+        N = self.net.W.size
+        iters = min(iters, N)
 
-            if (i > gap and vals[i - gap] < 0 and
-                    (vals[i] - vals[i - gap]) / vals[i] < 5e-6 * gap):
+        # orthonormal Lanczos basis (we keep the whole thing so that we can
+        # reorthogonalize, since otherwise the basis quickly loses
+        # orthogonality in finite precision)
+        Q = np.zeros((iters, N), dtype=self.net.dtype)
+        alpha = np.zeros(iters)
+        beta = np.zeros(iters)
+
+        q = self.net.rng.randn(N)
+        q /= np.linalg.norm(q)
+        for i in range(iters):
+            Q[i] = q
+            w = np.asarray(self.calc_G(Q[i], damping=damping),
+                           dtype=np.float64)
+
+            alpha[i] = np.dot(w, Q[i])
+
+            # full reorthogonalization against the previous basis vectors
+            w -= np.dot(Q[:i + 1].T, np.dot(Q[:i + 1], w))
+
+            beta[i] = np.linalg.norm(w)
+            if beta[i] < 1e-10 * max(abs(alpha[i]), 1):
+                # found an invariant subspace, so the estimate is exact
+                i += 1
                 break
 
-        deltas += [(i, get(delta))]
+            q = w / beta[i]
+        else:
+            i = iters
+
+        # eigenvalues of the tridiagonal matrix approximate the extremes of
+        # the spectrum
+        T = np.diag(alpha[:i]) + np.diag(beta[:i - 1], 1) + np.diag(
+            beta[:i - 1], -1)
+        eigs = np.linalg.eigvalsh(T)
+
+        self.spectrum = (eigs[0], eigs[-1])
+
+        return self.spectrum
+
+    def init_damping_from_spectrum(self, min_eig, max_eig):
+        """Choose a damping value based on the curvature spectrum.
+
+        The damping is chosen so that the condition number of the damped
+        curvature matrix is at most ``CG_iter**2``, which is the regime in
+        which CG can make good progress within ``CG_iter`` iterations.
+
+        :param float min_eig: smallest eigenvalue of the curvature matrix
+        :param float max_eig: largest eigenvalue of the curvature matrix
+        """
+
+        cond = max(self.CG_iter ** 2, 2)
+        min_eig = max(min_eig, 0)
+
+        damping = max((max_eig - cond * min_eig) / (cond - 1), 0)
+
+        # we don't want the damping to go all the way to zero (it couldn't be
+        # adapted back up in a reasonable amount of time)
+        return max(damping, 1e-6 * max_eig, 1e-8)
+
+    def conjugate_gradient(self, init_delta, grad, iters=250, printing=False):
+        """Find minimum of quadratic approximation using the optimizer's
+        solver (conjugate gradient by default).
+
+        See :meth:`.solvers.Solver.solve` for parameter descriptions."""
+
+        return self.solver.solve(init_delta, grad, iters=iters,
+                                 printing=printing)
+
+    @property
+    def solver(self):
+        return self._solver
 
-        return deltas
+    @solver.setter
+    def solver(self, s):
+        self._solver = s
+        s.optimizer = self
 
 
 class SGD(Optimizer):
@@ -0,0 +1,244 @@
+"""Precomputed execution plan for the layer graph of a network.
+
+The plan is compiled once (see :attr:`.FFNet.plan`), so that the forward
+and backward passes can iterate over flat sequences of connections rather
+than re-deriving the traversal (and parameter offsets) on every call.
+"""
+
+from __future__ import print_function
+
+from collections import namedtuple
+
+import numpy as np
+
+
+class Edge(namedtuple("Edge", ["pre", "post", "conn", "W_start", "W_end",
+                               "b_end", "pre_size", "post_size"])):
+    """A single connection in the execution plan.
+
+    :param int pre: index of the presynaptic layer
+    :param int post: index of the postsynaptic layer
+    :param conn: the connection type
+    :type conn: :class:`~.connections.Connection`
+    :param int W_start: start of the weights in the parameter vector
+    :param int W_end: end of the weights (start of the biases)
+    :param int b_end: end of the biases
+    :param int pre_size: number of units in the presynaptic layer
+    :param int post_size: number of units in the postsynaptic layer
+    """
+
+    __slots__ = ()
+
+    def weights(self, params):
+        """Get the weights and biases for this connection from a parameter
+        vector (views, not copies)."""
+
+        return (self.conn.reshape(params[self.W_start:self.W_end],
+                                  self.pre_size, self.post_size),
+                params[self.W_end:self.b_end])
+
+
+class ExecutionPlan(object):
+    """The order in which a network's layers and connections are processed.
+
+    Layers are grouped into stages (topological levels of the connection
+    graph), so that the layers within a stage only depend on layers in
+    earlier stages.
+
+    Each layer is also assigned a scratch buffer, used for temporary values
+    while that layer is being processed.  Layers in different stages are
+    never processed at the same time, so they share buffers where their
+    sizes match.  The input layer does not get a scratch buffer (it is never
+    computed, and the inputs may be a large sparse matrix).
+
+    The buffers for the R operator in :meth:`.FFNet.calc_G` are allocated
+    based on a liveness analysis of the graph (see :meth:`alloc_R`), so that
+    layers share memory when their values aren't needed at the same time.
+
+    All of the attributes are tuples, since the plan should not change once
+    it has been compiled.
+
+    :param list shape: number of units in each layer
+    :param dict conns: ``{pre: [post, ...], ...}`` connections between layers
+    :param dict conn_types: ``{(pre, post): connection, ...}``
+    :param dict offsets: ``{(pre, post): (W_start, W_end, b_end), ...}``
+        location of each connection in the parameter vector (see
+        :meth:`.FFNet.compute_offsets`)
+    """
+
+    def __init__(self, shape, conns, conn_types, offsets):
+        self.n_layers = len(shape)
+        self.shape = tuple(shape)
+
+        in_edges = [[] for _ in range(self.n_layers)]
+        out_edges = [[] for _ in range(self.n_layers)]
+        for pre in sorted(conns):
+            for post in conns[pre]:
+                e = Edge(pre, post, conn_types[(pre, post)],
+                         *(offsets[(pre, post)] + (shape[pre], shape[post])))
+                in_edges[post] += [e]
+                out_edges[pre] += [e]
+
+        #: edges into each layer, ``in_edges[post] = (edge, ...)``
+        self.in_edges = tuple(tuple(sorted(e, key=lambda e: e.pre))
+                              for e in in_edges)
+        #: edges out of each layer, ``out_edges[pre] = (edge, ...)``
+        self.out_edges = tuple(tuple(sorted(e, key=lambda e: e.post))
+                               for e in out_edges)
+
+        # group layers into topological levels (the input layer is always on
+        # its own in the first stage)
+        levels = [0 for _ in range(self.n_layers)]
+        for i in range(1, self.n_layers):
+            levels[i] = 1 + max([levels[e.pre] for e in self.in_edges[i]] or
+                                [0])
+
+        #: layers in each stage, ``stages[s] = (layer, ...)``
+        self.stages = tuple(tuple(i for i in range(self.n_layers)
+                                  if levels[i] == l)
+                            for l in range(max(levels) + 1))
+        #: order in which to process layers in the forward pass
+        self.forward_order = tuple(i for s in self.stages for i in s)
+        #: order in which to process layers in the backward pass
+        self.backward_order = self.forward_order[::-1]
+
+        # assign scratch buffers. within a stage each layer gets a separate
+        # buffer, but buffers are reused across stages.
+        scratch = [None for _ in range(self.n_layers)]
+        slots = {}
+        scratch_sizes = []
+        for stage in self.stages[1:]:
+            used = {}
+            for i in stage:
+                k = used.get(shape[i], 0)
+                used[shape[i]] = k + 1
+                if (shape[i], k) not in slots:
+                    slots[(shape[i], k)] = len(scratch_sizes)
+                    scratch_sizes += [shape[i]]
+                scratch[i] = slots[(shape[i], k)]
+
+        #: scratch buffer index for each layer (None for the input layer)
+        self.scratch = tuple(scratch)
+        #: number of units in each scratch buffer
+        self.scratch_sizes = tuple(scratch_sizes)
+
+    def R_intervals(self, loss_layers):
+        """Compute the lifetime of the R buffers used in :meth:`.FFNet.calc_G`.
+
+        Time is measured in stages: the forward pass processes stage ``s`` at
+        time ``s`` and the backward pass processes it at time
+        ``2 * len(stages) - 1 - s`` (so layers in the same stage are always
+        alive at the same time).
+
+        In the forward pass ``R_activations[i]`` is needed until all the
+        layers it connects to have been computed.  In the backward pass
+        ``R_error[i]`` is needed until all the layers that connect to it have
+        been processed.  If layer ``i`` has a loss then ``R_error[i]`` is
+        computed from ``R_activations[i]``, so the two share a single buffer
+        that is alive throughout.
+
+        The input layer does not need a buffer (its R activations are always
+        zero, and its R error is never used).
+
+        :param loss_layers: layers with a loss function applied (i.e., with a
+            ``d2_loss`` that is not None)
+        :returns: list of ``(start, end, layer, kind)`` tuples (inclusive),
+            where ``kind`` is ``"forward"``, ``"backward"``, or ``"both"``
+        """
+
+        n_stages = len(self.stages)
+        stage = [None for _ in range(self.n_layers)]
+        for s, layers in enumerate(self.stages):
+            for i in layers:
+                stage[i] = s
+
+        def fwd(i):
+            return stage[i]
+
+        def bwd(i):
+            return 2 * n_stages - 1 - stage[i]
+
+        intervals = []
+        for i in range(1, self.n_layers):
+            last_fwd = max([fwd(e.post) for e in self.out_edges[i]] +
+                           [fwd(i)])
+            last_bwd = max([bwd(e.pre) for e in self.in_edges[i]] + [bwd(i)])
+
+            if i in loss_layers:
+                intervals += [(fwd(i), last_bwd, i, "both")]
+            else:
+                intervals += [(fwd(i), last_fwd, i, "forward"),
+                              (bwd(i), last_bwd, i, "backward")]
+
+        return intervals
+
+    def alloc_R(self, batch_size, dtype, loss_layers):
+        """Allocate the R buffers used in :meth:`.FFNet.calc_G`.
+
+        Buffers are reused once their contents are no longer needed (see
+        :meth:`R_intervals`); each buffer is a flat array, so it can be
+        reused by layers of different sizes.
+
+        :param int batch_size: number of items in the batch
+        :param dtype: data type of the buffers
+        :param loss_layers: layers with a loss function applied
+        :returns: ``(R_activations, R_errors)``, lists containing the buffer
+            for each layer in the forward/backward pass
+        """
+
+        intervals = sorted(self.R_intervals(loss_layers))
+
+        # greedy interval coloring, assigning each interval to the smallest
+        # free buffer that is large enough (growing a free buffer if none are)
+        capacity = []
+        active = []
+        free = []
+        assignment = []
+        for start, end, i, kind in intervals:
+            for a in [a for a in active if a[0] < start]:
+                active.remove(a)
+                free += [a[1]]
+
+            size = batch_size * self.shape[i]
+            fits = [b for b in free if capacity[b] >= size]
+            if len(fits) > 0:
+                b = min(fits, key=lambda b: capacity[b])
+            elif len(free) > 0:
+                b = max(free, key=lambda b: capacity[b])
+                capacity[b] = size
+            else:
+                b = len(capacity)
+                capacity += [size]
+            if b in free:
+                free.remove(b)
+
+            active += [(end, b)]
+            assignment += [(i, kind, b)]
+
+        buffers = [np.zeros(c, dtype=dtype) for c in capacity]
+
+        R_activations = [None for _ in range(self.n_layers)]
+        R_errors = [None for _ in range(self.n_layers)]
+        for i, kind, b in assignment:
+            buf = buffers[b][:batch_size * self.shape[i]].reshape(
+                (batch_size, self.shape[i]))
+            if kind in ("forward", "both"):
+                R_activations[i] = buf
+            if kind in ("backward", "both"):
+                R_errors[i] = buf
+
+        return R_activations, R_errors
+
+    def alloc_scratch(self, batch_size, dtype):
+        """Allocate the scratch buffers.
+
+        :param int batch_size: number of items in the batch
+        :param dtype: data type of the buffers
+        :returns: list containing the scratch buffer for each layer (layers
+            that share a buffer will refer to the same array, and the input
+            layer's entry is None)
+        """
+
+        buffers = [np.zeros((batch_size, s), dtype=dtype)
+                   for s in self.scratch_sizes]
+        return [None if s is None else buffers[s] for s in self.scratch]
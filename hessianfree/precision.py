@@ -0,0 +1,230 @@
+"""Reduced precision storage for the values cached in
+:meth:`.FFNet.cache_minibatch`.
+
+The cached ``activations``/``d_activations`` are read many times (once per
+CG iteration in :meth:`.FFNet.calc_G`), but they tolerate much lower
+precision than the computations that use them.  These classes define how
+they are stored; the values are upcast back to the network's ``dtype`` on
+the fly when they are used.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+class Precision(object):
+    """Base class for storage formats.
+
+    :param storage_dtype: data type of the stored values
+    :type storage_dtype: :class:`~numpy:numpy.dtype`
+    """
+
+    def __init__(self, storage_dtype):
+        self.storage_dtype = np.dtype(storage_dtype)
+
+    def encode(self, x):
+        """Convert values to the storage format.
+
+        :param x: values to be stored
+        :type x: :class:`~numpy:numpy.ndarray`
+        :returns: array of ``storage_dtype``
+        """
+
+        raise NotImplementedError()
+
+    def decode(self, x, dtype, out=None):
+        """Convert stored values back to full precision.
+
+        :param x: stored values (from :meth:`encode`)
+        :type x: :class:`~numpy:numpy.ndarray`
+        :param dtype: data type of the returned values
+        :type dtype: :class:`~numpy:numpy.dtype`
+        :param out: if given, the values will be decoded into this array
+            (rather than allocating a new one)
+        :type out: :class:`~numpy:numpy.ndarray`
+        """
+
+        raise NotImplementedError()
+
+    def operand(self, x, dtype, out):
+        """Get the stored values in a form that can be used as an operand to
+        numpy ufuncs (e.g. ``np.multiply``).
+
+        By default this decodes the values into ``out``; formats that numpy
+        supports natively return the storage itself (ufuncs will upcast it
+        in buffered chunks, without decoding the whole array).
+
+        :param x: stored values (from :meth:`encode`)
+        :type x: :class:`~numpy:numpy.ndarray`
+        :param dtype: data type of the decoded values
+        :type dtype: :class:`~numpy:numpy.dtype`
+        :param out: array to decode the values into (if necessary)
+        :type out: :class:`~numpy:numpy.ndarray`
+        """
+
+        return self.decode(x, dtype, out=out)
+
+    def __repr__(self):
+        return "%s()" % type(self).__name__
+
+
+class Native(Precision):
+    """Values stored with a data type natively supported by numpy (e.g.,
+    ``np.float16``).
+
+    Note: values outside the range of the data type will be stored as
+    ``inf``.
+    """
+
+    def encode(self, x):
+        return np.asarray(x, dtype=self.storage_dtype)
+
+    def decode(self, x, dtype, out=None):
+        if out is None:
+            return np.asarray(x, dtype=dtype)
+        out[...] = x
+        return out
+
+    def operand(self, x, dtype, out):
+        return x
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, self.storage_dtype.name)
+
+
+class BFloat16(Precision):
+    """bfloat16 values, emulated with ``uint16`` storage.
+
+    These are the top 16 bits of a ``float32`` (so they have the same range
+    as ``float32``, but only 8 bits of precision in the mantissa).  Values
+    are rounded to the nearest representable number when they are encoded.
+    """
+
+    def __init__(self):
+        super(BFloat16, self).__init__(np.uint16)
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        bits = x.view(np.uint32)
+
+        # round to nearest even
+        rounded = bits + np.uint32(0x7fff)
+        rounded += (bits >> 16) & np.uint32(1)
+        rounded >>= 16
+
+        # note: rounding can carry a nan into inf (or wrap around), so nans
+        # are set explicitly
+        rounded[np.isnan(x)] = 0x7fc0
+
+        return rounded.astype(np.uint16)
+
+    def decode(self, x, dtype, out=None):
+        if out is not None and out.dtype == np.float32:
+            result = out
+        else:
+            result = np.empty(x.shape, dtype=np.float32)
+
+        # shift the bits directly into the float32 result (avoiding
+        # intermediate uint32 arrays)
+        np.left_shift(x, 16, out=result.view(np.uint32), dtype=np.uint32)
+
+        if out is None:
+            return np.asarray(result, dtype=dtype)
+        if result is not out:
+            out[...] = result
+        return out
+
+
+def lookup(precision):
+    """Get the storage format for a given specification.
+
+    :param precision: a :class:`Precision` instance, ``"bfloat16"``, or the
+        name of a numpy data type (e.g. ``"float16"``)
+    :returns: :class:`Precision` instance
+    """
+
+    if isinstance(precision, Precision):
+        return precision
+    if isinstance(precision, str) and precision == "bfloat16":
+        return BFloat16()
+    try:
+        return Native(precision)
+    except TypeError:
+        raise TypeError("Unknown precision (%s); must be an instance of "
+                        "precision.Precision or a data type" % (precision,))
+
+
+class CachedArray(object):
+    """An array stored in reduced precision.
+
+    Indexing returns the (upcast) values for that part of the array, so
+    parts of the array can be read without decoding the whole thing (e.g.
+    ``x[:, s]`` in :meth:`.RNNet.calc_G`).  ``np.asarray`` can be used to
+    decode the whole array.
+
+    :param x: values to be stored
+    :type x: :class:`~numpy:numpy.ndarray`
+    :param precision: storage format
+    :type precision: :class:`Precision`
+    :param dtype: data type of the decoded values
+    :type dtype: :class:`~numpy:numpy.dtype`
+    """
+
+    def __init__(self, x, precision, dtype):
+        self.precision = precision
+        self.dtype = np.dtype(dtype)
+        self.data = precision.encode(x)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return self.precision.decode(self.data[idx], self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.precision.decode(self.data,
+                                     self.dtype if dtype is None else dtype)
+
+    def decode(self, out=None):
+        """Decode the whole array.
+
+        :param out: if given, the values will be decoded into this array
+        :type out: :class:`~numpy:numpy.ndarray`
+        """
+
+        return self.precision.decode(self.data, self.dtype, out=out)
+
+    def operand(self, out):
+        """Get the values as a ufunc operand (see
+        :meth:`Precision.operand`).
+
+        :param out: array to decode the values into (if necessary)
+        :type out: :class:`~numpy:numpy.ndarray`
+        """
+
+        return self.precision.operand(self.data, self.dtype, out)
+
+
+def decode(x, out=None):
+    """Get the full precision values of a cached array.
+
+    :param x: a :class:`CachedArray` (anything else, e.g. arrays that are
+        not stored in reduced precision, is returned unchanged)
+    :param out: if given, ``x`` will be decoded into this array
+    :type out: :class:`~numpy:numpy.ndarray`
+    """
+
+    return x.decode(out=out) if isinstance(x, CachedArray) else x
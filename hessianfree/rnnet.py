@@ -43,6 +43,9 @@ class RNNet(hf.FFNet):
         # super constructor
         super(RNNet, self).__init__(shape, **kwargs)
 
+        if not self.dense:
+            raise ValueError("RNNet only supports Dense connections")
+
         self.truncation = truncation
 
         # add on recurrent weights
@@ -171,6 +174,16 @@ class RNNet(hf.FFNet):
 
         return activations
 
+    def export_predictor(self, max_batch_size=256):
+        """Create a frozen, inference-only version of this network.
+
+        :param int max_batch_size: batch size used to allocate the buffers
+            in the predictor (larger batches are processed in chunks)
+        :returns: :class:`~.inference.RNNPredictor`
+        """
+
+        return hf.inference.RNNPredictor(self, max_batch_size)
+
     def calc_grad(self):
         """Compute parameter gradient."""
 
@@ -303,10 +316,10 @@ class RNNet(hf.FFNet):
                                        init_activations=init_a,
                                        init_state=init_s)
 
-                error_inc = self.loss.batch_loss(out_inc,
+                error_inc = self.loss.loss_value(out_inc,
                                                  self.targets[:, start:n])
 
-                error_dec = self.loss.batch_loss(out_dec,
+                error_dec = self.loss.loss_value(out_dec,
                                                  self.targets[:, start:n])
 
                 grad[i] += (error_inc - error_dec) / (2 * eps)
@@ -421,10 +434,11 @@ class RNNet(hf.FFNet):
 
             for s in range(n, np.maximum(n - trunc_len, -1), -1):
                 for l in range(self.n_layers - 1, -1, -1):
-                    if self.d2_loss[l] is not None:
-                        np.multiply(self.d2_loss[l][:, s],
-                                    R_activations[l][:, s],
-                                    out=R_error[l])
+                    d2 = self.d2_loss[l]
+                    if d2 is not None:
+                        # note: d2_loss may be a (constant) scalar
+                        np.multiply(d2 if np.ndim(d2) == 0 else d2[:, s],
+                                    R_activations[l][:, s], out=R_error[l])
                     else:
                         R_error[l].fill(0)
 
@@ -481,6 +495,18 @@ class RNNet(hf.FFNet):
 
         return Gv
 
+    def alloc_tmp_space(self):
+        """Allocate the temporary space used in :meth:`calc_G`.
+
+        Note: unlike :meth:`.FFNet.alloc_tmp_space`, this is a full copy of
+        the activations for each layer (since :meth:`calc_G` uses it to store
+        the R activations for every timestep), and is not shared between
+        layers.
+        """
+
+        self.tmp_space = [np.zeros(a.shape, self.dtype)
+                          for a in self.activations]
+
     def load_GPU_data(self):
         """Load data for the current epoch onto GPU."""
 
@@ -515,21 +541,24 @@ class RNNet(hf.FFNet):
         # that each time step is a single block of memory in GPU_calc_G)
         self.GPU_activations = [
             split_axes(gpuarray.to_gpu(np.ascontiguousarray(
-                np.swapaxes(a, 0, 1))), 1)
+                np.swapaxes(np.asarray(a), 0, 1))), 1)
             for a in self.activations]
 
+        # note: values stored in reduced precision are upcast before they
+        # are loaded onto the GPU
         self.GPU_d_activations = [
             split_axes(gpuarray.to_gpu(np.ascontiguousarray(
-                np.rollaxis(np.swapaxes(a, 0, 1), -1, 1))), 2)
+                np.rollaxis(np.swapaxes(np.asarray(a), 0, 1), -1, 1))), 2)
             if self.layers[i].stateful else
             split_axes(gpuarray.to_gpu(np.ascontiguousarray(
-                np.swapaxes(a, 0, 1))), 1)
+                np.swapaxes(np.asarray(a), 0, 1))), 1)
             for i, a in enumerate(self.d_activations)]
 
         self.GPU_d2_loss = [
             split_axes(gpuarray.to_gpu(np.ascontiguousarray(
-                np.swapaxes(a, 0, 1))), 1)
-            if a is not None else None for a in self.d2_loss]
+                np.swapaxes(d2 * np.ones(a.shape, self.dtype), 0, 1))), 1)
+            if d2 is not None else None
+            for a, d2 in zip(self.activations, self.d2_loss)]
 
         self.GPU_tmp_space = [split_axes(gpuarray.empty((a.shape[1],
                                                          a.shape[0],
@@ -783,7 +812,10 @@ class RNNet(hf.FFNet):
                                   self.targets[:, :n])
             # TODO: check loss via finite differences
 
-            G += np.sum([np.einsum("abji,abj,abjk->ik", trunc_J[l], L[l], J[l])
+            G += np.sum([np.einsum("abji,abj,abjk->ik", trunc_J[l],
+                                   L[l] * np.ones(
+                                       self.activations[l][:, :n].shape),
+                                   J[l])
                          for l in range(self.n_layers) if L[l] is not None],
                         axis=0)
 
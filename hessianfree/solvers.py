@@ -0,0 +1,516 @@
+"""Linear solvers used by :class:`.HessianFree` to minimize the quadratic
+approximation of the objective.
+
+Each solver uses the (damped) Gauss-Newton matrix-vector product
+(:meth:`.FFNet.calc_G`) as its only matrix operator.
+"""
+
+from __future__ import print_function
+
+import warnings
+
+import numpy as np
+
+
+class Snapshots(object):
+    """Preallocated storage for the intermediate deltas stored by a solver.
+
+    The buffer is reused across calls to :meth:`Solver.solve`, so the
+    stored deltas are only valid until the next call.  Indexing returns
+    ``(iteration, delta)`` tuples (in the order they were stored), so this
+    can be used in place of a list of tuples.
+
+    :param int size: maximum number of deltas that will be stored
+    :param int n_params: length of each delta
+    :param dtype: dtype of the deltas
+    :type dtype: :class:`~numpy:numpy.dtype`
+    :param int keep: if not None, only keep the most recent ``keep`` deltas
+        (older deltas are overwritten)
+    :param str filename: if not None, back the buffer with a memory-mapped
+        file (so that older deltas can be paged out to disk)
+    """
+
+    def __init__(self, size, n_params, dtype, keep=None, filename=None):
+        if keep is not None:
+            size = min(size, keep)
+
+        if filename is None:
+            self.buffer = np.zeros((size, n_params), dtype=dtype)
+        else:
+            self.buffer = np.memmap(filename, dtype=dtype, mode="w+",
+                                    shape=(size, n_params))
+        self.iters = np.zeros(size, dtype=np.int64)
+
+        self.reset()
+
+    def reset(self):
+        """Clear out the stored deltas."""
+
+        # index of the oldest delta in the ring buffer, and the number of
+        # deltas stored
+        self.start = 0
+        self.n = 0
+
+    def slot(self, i):
+        """Get the next slot in the buffer, to store the delta for iteration
+        ``i``."""
+
+        size = len(self.iters)
+        if self.n < size:
+            idx = (self.start + self.n) % size
+            self.n += 1
+        else:
+            # overwrite the oldest delta
+            idx = self.start
+            self.start = (self.start + 1) % size
+
+        self.iters[idx] = i
+        return self.buffer[idx]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += self.n
+        if not 0 <= j < self.n:
+            raise IndexError("Snapshot index out of range")
+
+        idx = (self.start + j) % len(self.iters)
+        return self.iters[idx], self.buffer[idx]
+
+    def __iter__(self):
+        for j in range(self.n):
+            yield self[j]
+
+
+class Solver(object):
+    """Base class for solvers.
+
+    Each solver has a ``self.optimizer`` parameter that will be set
+    automatically when the solver is added to a
+    :class:`~.optimizers.HessianFree` optimizer (referring to that
+    optimizer).
+
+    :param int max_snapshots: if not None, only keep this many of the most
+        recent deltas for backtracking
+    :param str snapshot_file: if not None, store the deltas for backtracking
+        in a memory-mapped file with this name (rather than in memory)
+    """
+
+    # intermediate deltas are stored (for backtracking) on a geometrically
+    # increasing schedule, starting at store_iter
+    store_iter = 5
+    store_mult = 1.3
+
+    def __init__(self, max_snapshots=None, snapshot_file=None):
+        self.optimizer = None
+
+        if max_snapshots is not None and max_snapshots < 1:
+            raise ValueError("max_snapshots must be at least 1 (the final "
+                             "delta is always stored), got %s" %
+                             max_snapshots)
+
+        self.max_snapshots = max_snapshots
+        self.snapshot_file = snapshot_file
+        self.snapshots = None
+
+    def __getstate__(self):
+        # don't pickle the snapshot buffer or backend functions (they will be
+        # recreated on the next call to solve)
+        state = dict((k, v) for k, v in self.__dict__.items()
+                     if k not in ("G_dir", "net_calc_G", "dot", "get"))
+        state["snapshots"] = None
+        return state
+
+    def n_snapshots(self, iters):
+        """Number of deltas that will be stored when running for ``iters``
+        iterations."""
+
+        n = 1  # the final delta
+        i = self.store_iter
+        while i < iters:
+            n += 1
+            next_i = int(i * self.store_mult)
+            if next_i <= i:
+                break
+            i = next_i
+
+        return n
+
+    def solve(self, init_delta, grad, iters=250, printing=False):
+        """Find the minimum of the quadratic model
+        :math:`\\frac{1}{2} \\delta^T (G + \\lambda I) \\delta +
+        \\nabla^T \\delta`.
+
+        :param init_delta: initial value of the weight update
+        :type init_delta: :class:`~numpy:numpy.ndarray`
+        :param grad: gradient of the objective for the current batch
+        :type grad: :class:`~numpy:numpy.ndarray`
+        :param int iters: maximum number of solver iterations
+        :param bool printing: if True, print out data about the optimization
+        :returns: sequence of ``(iteration, delta)`` tuples giving the
+            intermediate deltas stored for backtracking (the last entry is
+            the final result)
+        :rtype: :class:`Snapshots`
+        """
+        raise NotImplementedError()
+
+    def init_backend(self, init_delta, grad, iters):
+        """Set up the vector operations for the CPU or GPU, and the storage
+        for intermediate deltas.
+
+        :returns: ``(base_grad, delta)``, the negative gradient and the
+            initial delta (in the appropriate format for the backend)
+        """
+
+        net = self.optimizer.net
+
+        if net.debug:
+            net.check_grad(grad)
+
+        grad = -grad  # note negative, some CG algorithms are flipped
+
+        if net.use_GPU:
+            from pycuda import gpuarray
+            base_grad = gpuarray.to_gpu(grad)
+            delta = gpuarray.to_gpu(init_delta)
+            self.G_dir = gpuarray.zeros(grad.shape, dtype=net.dtype)
+            self.net_calc_G = net.GPU_calc_G
+
+            def dot(a, b):
+                return gpuarray.dot(a, b).get()
+
+            def get(x, out=None):
+                if out is None:
+                    return x.get(pagelocked=True)
+                return x.get(ary=out)
+        else:
+            base_grad = grad
+            delta = init_delta
+            self.G_dir = np.zeros_like(grad)
+            self.net_calc_G = net.calc_G
+            dot = np.dot
+
+            def get(x, out=None):
+                if out is None:
+                    return x.copy()
+                out[...] = x
+                return out
+
+        self.dot = dot
+        self.get = get
+
+        # reuse the snapshot buffer from previous calls if possible
+        size = self.n_snapshots(iters)
+        if (self.snapshots is None or
+                self.snapshots.buffer.shape[1] != grad.size or
+                self.snapshots.buffer.dtype != net.dtype or
+                len(self.snapshots.iters) < min(
+                    size, self.max_snapshots or size)):
+            self.snapshots = None  # release the old buffer first
+            self.snapshots = Snapshots(size, grad.size, net.dtype,
+                                       keep=self.max_snapshots,
+                                       filename=self.snapshot_file)
+        self.snapshots.reset()
+        self.next_store = self.store_iter
+
+        return base_grad, delta
+
+    def calc_G(self, v, out=None):
+        """Damped curvature-vector product."""
+
+        return self.net_calc_G(v, damping=self.optimizer.damping,
+                               out=self.G_dir if out is None else out)
+
+    def store(self, i, delta):
+        """Store a copy of ``delta`` for backtracking, if ``i`` is one of the
+        storage iterations."""
+
+        if i == self.next_store:
+            self.get(delta, out=self.snapshots.slot(i))
+            self.next_store = int(self.next_store * self.store_mult)
+
+    def finish(self, i, delta):
+        """Store the final delta and return the stored deltas."""
+
+        self.get(delta, out=self.snapshots.slot(i))
+
+        return self.snapshots
+
+
+class ConjugateGradient(Solver):
+    """Conjugate gradient, with the termination conditions from Martens
+    (2010)."""
+
+    # if not None, reset the search direction every `restart` iterations
+    restart = None
+
+    def solve(self, init_delta, grad, iters=250, printing=False):
+        net = self.optimizer.net
+        base_grad, delta = self.init_backend(init_delta, grad, iters)
+        dot, get = self.dot, self.get
+
+        vals = np.zeros(iters, dtype=net.dtype)
+
+        delta = self.prepare_delta(delta)
+
+        residual = base_grad.copy()
+        residual -= self.calc_G(delta)
+        res_norm = dot(residual, residual)
+        direction = residual.copy()
+
+        for i in range(iters):
+            if printing:
+                print("-" * 20)
+                print("CG iteration", i)
+                print("delta norm", np.linalg.norm(get(delta)))
+                print("direction norm", np.linalg.norm(get(direction)))
+
+            G_dir = self.calc_G(direction)
+
+            # calculate step size
+            step = res_norm / dot(direction, G_dir)
+
+            if not np.isfinite(step):
+                warnings.warn("Non-finite step value (%f)" % step)
+                break
+
+            if printing:
+                print("G_dir norm", np.linalg.norm(get(G_dir)))
+                print("step", step)
+
+            if net.debug:
+                tmp_G_dir = get(G_dir)
+                tmp_dir = get(direction)
+                net.check_G(tmp_G_dir, tmp_dir, self.optimizer.damping)
+
+                assert np.isfinite(step)
+                assert step >= 0
+                assert (np.linalg.norm(np.dot(tmp_dir, tmp_G_dir)) >=
+                        np.linalg.norm(np.dot(tmp_dir,
+                                              net.calc_G(tmp_dir,
+                                                         damping=0))))
+
+            step, stop = self.limit_step(delta, direction, step)
+
+            # update weight delta
+            delta += step * direction
+
+            if stop:
+                break
+
+            # update residual
+            if self.restart is not None and (i + 1) % self.restart == 0:
+                # recompute the residual from scratch and restart from the
+                # steepest descent direction (this avoids the accumulation
+                # of errors in the recursively computed residual)
+                residual = base_grad.copy()
+                residual -= self.calc_G(delta)
+                new_res_norm = dot(residual, residual)
+                direction = residual.copy()
+            else:
+                residual -= step * G_dir
+                new_res_norm = dot(residual, residual)
+
+                # update direction
+                beta = new_res_norm / res_norm
+                direction *= beta
+                direction += residual
+
+            if new_res_norm < 1e-20:
+                # early termination (mainly to prevent numerical errors);
+                # the main termination condition is below.
+                break
+
+            res_norm = new_res_norm
+
+            # store deltas for backtracking
+            self.store(i, delta)
+
+            # martens termination conditions
+            vals[i] = -0.5 * dot(residual + base_grad, delta)
+
+            gap = max(int(0.1 * i), 10)
+
+            if printing:
+                print("termination val", vals[i])
+
+            if (i > gap and vals[i - gap] < 0 and
+                    (vals[i] - vals[i - gap]) / vals[i] < 5e-6 * gap):
+                break
+
+        return self.finish(i, delta)
+
+    def prepare_delta(self, delta):
+        """Modify the initial delta before starting the iterations."""
+
+        return delta
+
+    def limit_step(self, delta, direction, step):
+        """Modify the step size along the current search direction.
+
+        :returns: tuple of the new step size and a boolean indicating whether
+            the iterations should stop after taking that step
+        """
+
+        return step, False
+
+
+class RestartedCG(ConjugateGradient):
+    """Conjugate gradient that periodically restarts from the steepest
+    descent direction.
+
+    :param int restart: number of iterations between restarts
+
+    See :class:`Solver` for the remaining parameters.
+    """
+
+    def __init__(self, restart=50, **kwargs):
+        super(RestartedCG, self).__init__(**kwargs)
+
+        self.restart = restart
+
+
+class SteihaugCG(ConjugateGradient):
+    """Steihaug-Toint truncated conjugate gradient, which terminates when the
+    update reaches the boundary of a trust region (or encounters negative
+    curvature).
+
+    :param float radius: radius of the trust region (can be modified between
+        calls to adapt the trust region)
+
+    See :class:`Solver` for the remaining parameters.
+    """
+
+    def __init__(self, radius=1.0, **kwargs):
+        super(SteihaugCG, self).__init__(**kwargs)
+
+        self.radius = radius
+
+        # whether the last solution was stopped at the trust region boundary
+        self.hit_boundary = False
+
+    def prepare_delta(self, delta):
+        self.hit_boundary = False
+
+        # scale initial delta to lie within the trust region
+        norm = float(np.sqrt(self.dot(delta, delta)))
+        if norm > self.radius:
+            delta *= self.radius / norm
+
+        return delta
+
+    def limit_step(self, delta, direction, step):
+        if step > 0:
+            new_norm = (self.dot(delta, delta) +
+                        2 * step * self.dot(delta, direction) +
+                        step ** 2 * self.dot(direction, direction))
+            if new_norm < self.radius ** 2:
+                return step, False
+
+        # step to the trust region boundary along direction (i.e., solve
+        # ||delta + tau * direction|| = radius for tau >= 0)
+        a = self.dot(direction, direction)
+        b = 2 * self.dot(delta, direction)
+        c = self.dot(delta, delta) - self.radius ** 2
+        tau = float((-b + np.sqrt(max(b ** 2 - 4 * a * c, 0))) / (2 * a))
+
+        self.hit_boundary = True
+
+        return tau, True
+
+
+class MINRES(Solver):
+    """Minimum residual method (Paige and Saunders, 1975).
+
+    Unlike CG this minimizes the norm of the residual, rather than the
+    quadratic model, so it terminates based on the relative residual norm.
+
+    :param float tol: terminate when the residual norm has been reduced by
+        this factor
+
+    See :class:`Solver` for the remaining parameters.
+    """
+
+    def __init__(self, tol=1e-6, **kwargs):
+        super(MINRES, self).__init__(**kwargs)
+
+        self.tol = tol
+
+    def solve(self, init_delta, grad, iters=250, printing=False):
+        base_grad, delta = self.init_backend(init_delta, grad, iters)
+        dot, get = self.dot, self.get
+
+        # note: we convert the scalars to python floats throughout, so that
+        # they don't change the dtype of the vectors
+        eps = float(np.finfo(np.float64).eps)
+
+        r1 = base_grad - self.calc_G(delta)
+        y = r1
+        beta1 = float(np.sqrt(dot(r1, r1)))
+
+        if beta1 == 0:
+            return self.finish(0, delta)
+
+        oldb = 0
+        beta = beta1
+        dbar = 0
+        epsln = 0
+        phibar = beta1
+        cs = -1
+        sn = 0
+        w = 0 * delta
+        w2 = 0 * delta
+        r2 = r1
+
+        for i in range(iters):
+            # Lanczos step
+            v = y * (1.0 / beta)
+            y = self.calc_G(v).copy()
+            if i > 0:
+                y -= (beta / oldb) * r1
+            alpha = float(dot(v, y))
+            y -= (alpha / beta) * r2
+            r1 = r2
+            r2 = y
+            oldb = beta
+            beta = float(np.sqrt(dot(r2, r2)))
+
+            # apply previous rotation
+            oldeps = epsln
+            delta_k = cs * dbar + sn * alpha
+            gbar = sn * dbar - cs * alpha
+            epsln = sn * beta
+            dbar = -cs * beta
+
+            # compute next rotation
+            gamma = max(float(np.hypot(gbar, beta)), eps)
+            cs = gbar / gamma
+            sn = beta / gamma
+            phi = cs * phibar
+            phibar = sn * phibar
+
+            # update solution
+            w1 = w2
+            w2 = w
+            w = (v - oldeps * w1 - delta_k * w2) * (1.0 / gamma)
+            delta += phi * w
+
+            if printing:
+                print("-" * 20)
+                print("MINRES iteration", i)
+                print("delta norm", np.linalg.norm(get(delta)))
+                print("residual norm", phibar)
+
+            if not np.isfinite(phibar):
+                warnings.warn("Non-finite residual value (%f)" % phibar)
+                break
+
+            if phibar < self.tol * beta1 or beta < eps * beta1:
+                break
+
+            # store deltas for backtracking
+            self.store(i, delta)
+
+        return self.finish(i, delta)
@@ -1,3 +1,8 @@
+import os
+import pickle
+import threading
+import time
+
 import numpy as np
 import pytest
 
@@ -142,6 +147,23 @@ def test_asym_dact(use_GPU):
                   max_epochs=40, print_period=None)
 
 
+def test_sparse_init(use_GPU):
+    # note: the 10 and 500 unit layers test the two different sampling methods
+    ff = hf.FFNet([10, 500, 20], use_GPU=use_GPU,
+                  W_init_params={"biases": 0.5},
+                  rng=np.random.RandomState(0))
+
+    for pre, post in ((0, 1), (1, 2)):
+        W, b = ff.get_weights(ff.W, (pre, post))
+        assert np.all(np.sum(W != 0, axis=0) ==
+                      min(15, ff.shape[pre]))
+        assert np.all(b == 0.5)
+
+    # connections are evenly distributed across the pre units
+    W, _ = ff.get_weights(ff.W, (1, 2))
+    assert np.all(np.sum(W != 0, axis=1) <= 5)
+
+
 def test_stripped_batch(use_GPU):
     inputs = np.asarray([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float32)
     targets = np.asarray([[0], [1], [1], [0]], dtype=np.float32)
@@ -159,5 +181,662 @@ def test_stripped_batch(use_GPU):
 
     assert np.allclose(ff.forward(inputs)[-1], ff2.forward(inputs)[-1])
 
+
+def test_checkpoint(use_GPU, tmpdir):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(100, 2).astype(np.float32)
+    targets = rng.randn(100, 1).astype(np.float32)
+
+    def run(max_epochs, file_output, resume=None, W=None):
+        ff = hf.FFNet([2, 5, 1], use_GPU=use_GPU, load_weights=W,
+                      rng=np.random.RandomState(1))
+        ff.run_epochs(inputs, targets,
+                      optimizer=hf.opt.HessianFree(CG_iter=10),
+                      max_epochs=max_epochs, minibatch_size=20,
+                      print_period=None, plotting=True,
+                      file_output=str(tmpdir.join(file_output)),
+                      resume=resume)
+        return ff
+
+    def read_plots(file_output):
+        plots = {}
+        with open(str(tmpdir.join(file_output + "_plots.jsonl")), "rb") as f:
+            for record in hf.fileio.read_records(f):
+                for k, v in record.items():
+                    plots.setdefault(k, []).extend(v)
+        return plots
+
+    ff = run(10, "full")
+
+    # run the first half, then resume from the checkpoint in a new network
+    ff2 = run(5, "half")
+    ff2 = run(10, "half", resume=str(tmpdir.join("half_checkpoint.pkl")),
+              W=np.zeros_like(ff2.W))
+
+    assert np.allclose(ff.W, ff2.W)
+    assert np.allclose(ff.best_W, ff2.best_W)
+    assert np.allclose(ff.optimizer.damping, ff2.optimizer.damping)
+    assert np.allclose(np.load(str(tmpdir.join("half_weights.npy"))), ff2.W)
+
+    # output files get the normal permissions for new files
+    if os.name != "nt":
+        tmpdir.join("new_file").write("")
+        assert (os.stat(str(tmpdir.join("half_weights.npy"))).st_mode ==
+                os.stat(str(tmpdir.join("new_file"))).st_mode)
+
+    # check that the plot logs match
+    plots = read_plots("full")
+    plots2 = read_plots("half")
+    assert len(plots["test error (log)"]) == 10
+    assert plots["CG iterations"] == ff.optimizer.plots["CG iterations"]
+    assert sorted(plots.keys()) == sorted(plots2.keys())
+    for k in plots:
+        assert np.allclose(plots[k], plots2[k])
+
+
+def test_read_records(use_GPU, tmpdir):
+    filename = str(tmpdir.join("log.jsonl"))
+    hf.fileio.write_records(filename, [{"a": [1]}])
+
+    with open(filename, "rb") as f:
+        assert hf.fileio.read_records(f) == [{"a": [1]}]
+
+        # partially written records are left until they are complete
+        with open(filename, "ab") as f2:
+            f2.write(b'{"a": ')
+            f2.flush()
+            assert hf.fileio.read_records(f) == []
+            f2.write(b'[2, 3]}\n')
+            f2.flush()
+            assert hf.fileio.read_records(f) == [{"a": [2, 3]}]
+
+
+def test_background_writer(use_GPU):
+    writer = hf.fileio.BackgroundWriter(max_pending=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def wait():
+        started.set()
+        release.wait()
+
+    writer.submit(wait)
+    started.wait()
+    writer.submit(lambda: None)
+
+    # the queue is full, so submitting blocks until the writes catch up
+    t = threading.Thread(target=writer.submit, args=(lambda: None,))
+    t.start()
+    t.join(0.1)
+    assert t.is_alive()
+
+    release.set()
+    t.join()
+    writer.close()
+
+
+def test_predictor(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(50, 3).astype(np.float32)
+
+    ff = hf.FFNet([3, 5, 4, 2], conns={0: [1, 2], 1: [2, 3], 2: [3]},
+                  layers=[hf.nl.Linear(), hf.nl.Tanh(), hf.nl.Linear(),
+                          hf.nl.Softmax()],
+                  use_GPU=use_GPU, rng=rng)
+
+    # note: batches larger than max_batch_size are processed in chunks
+    predictor = ff.export_predictor(max_batch_size=16)
+    for batch in (inputs[:1], inputs[:16], inputs):
+        assert np.allclose(predictor.predict(batch), ff.forward(batch)[-1])
+
+    # predictor is unaffected by further changes to the network
+    ff.W[:] = 0
+    assert not np.allclose(predictor(inputs), ff.forward(inputs)[-1])
+
+
+def test_batch_server(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(20, 3).astype(np.float32)
+
+    ff = hf.FFNet([3, 5, 2], use_GPU=use_GPU, rng=rng)
+    outputs = ff.forward(inputs)[-1]
+
+    for model in (ff, ff.export_predictor()):
+        with hf.inference.BatchServer(model, max_batch_size=20,
+                                      max_latency=10) as server:
+            # all the requests should be combined into one batch
+            futures = [server.submit(inputs[i:i + 2])
+                       for i in range(0, 20, 2)]
+            for i, f in enumerate(futures):
+                assert np.allclose(f.result(timeout=10),
+                                   outputs[2 * i:2 * i + 2])
+
+            stats = server.stats()
+            assert stats["requests"] == 10
+            assert stats["inputs"] == 20
+            assert stats["batches"] == 1
+
+            # note: pending requests are processed when the server is closed
+            future = server.submit(np.zeros((1, 4), dtype=np.float32))
+
+        # errors are returned to the request
+        with pytest.raises(ValueError):
+            future.result(timeout=10)
+
+
+def test_batch_server_close(use_GPU):
+    started = threading.Event()
+    release = threading.Event()
+
+    def func(x):
+        started.set()
+        release.wait()
+        return x
+
+    server = hf.inference.BatchServer(hf.FFNet([2, 2], use_GPU=use_GPU),
+                                      max_latency=0)
+    server.func = func
+    first = server.submit(np.zeros((1, 2)))
+    started.wait()
+
+    # simulate a request arriving after the shutdown sentinel
+    closer = threading.Thread(target=server.close)
+    closer.start()
+    while not server.closed:
+        time.sleep(0.001)
+    late = server.Future()
+    server.queue.put((np.zeros((1, 2)), late, time.time()))
+
+    with pytest.raises(RuntimeError):
+        server.submit(np.zeros((1, 2)))
+
+    release.set()
+    closer.join()
+    assert np.all(first.result(timeout=10) == 0)
+    with pytest.raises(RuntimeError):
+        late.result(timeout=10)
+
+
+class Cube(hf.nl.Nonlinearity):
+    # note: defined at the module level so that it can be pickled
+
+    def activation(self, x):
+        return x ** 3
+
+    def d_activation(self, x, _):
+        return 3 * x ** 2
+
+
+def test_save_model(use_GPU, tmpdir):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(10, 3).astype(np.float32)
+    filename = str(tmpdir.join("model.hf"))
+
+    ff = hf.FFNet([3, 5, 4, 2], conns={0: [1, 2], 1: [2], 2: [3]},
+                  layers=[hf.nl.Linear(), hf.nl.ReLU(max=3),
+                          hf.nl.SoftLIF(sigma=0.5, amp=0.1), Cube()],
+                  use_GPU=use_GPU, rng=rng)
+    hf.fileio.save_model(ff, filename)
+
+    ff2 = hf.fileio.load_model(filename, use_GPU=use_GPU)
+    assert isinstance(ff2.W, np.memmap)
+    assert ff2.shape == ff.shape
+    assert ff2.conns == ff.conns
+    assert ff2.layers[1].max == 3
+    assert ff2.layers[2].sigma == 0.5
+    assert isinstance(ff2.layers[3], Cube)
+    assert np.allclose(ff.forward(inputs)[-1], ff2.forward(inputs)[-1])
+
+    # modifying the loaded weights doesn't change the file
+    ff2.W += 1
+    ff3 = hf.fileio.load_model(filename, mmap_mode=None)
+    assert not isinstance(ff3.W, np.memmap)
+    assert np.allclose(ff3.W, ff.W)
+
+
+def test_pickle(use_GPU):
+    inputs = np.asarray([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float32)
+    targets = np.asarray([[0], [1], [1], [0]], dtype=np.float32)
+
+    ff = hf.FFNet([2, 5, 1], layers=[hf.nl.Linear(), hf.nl.Tanh(),
+                                     hf.nl.Logistic()],
+                  use_GPU=use_GPU, rng=np.random.RandomState(0))
+    ff.run_epochs(inputs, targets, optimizer=hf.opt.HessianFree(CG_iter=10),
+                  max_epochs=2, print_period=None)
+    ff.cache_minibatch(inputs, targets)
+
+    ff2 = pickle.loads(pickle.dumps(ff))
+    assert ff2.activations is None
+    assert ff2.best_W is None
+    assert ff2.optimizer.solver.snapshots is None
+    assert np.allclose(ff2.W, ff.W)
+    assert np.allclose(ff2.forward(inputs)[-1], ff.forward(inputs)[-1])
+
+    # training can continue after the caches are recomputed
+    ff2.cache_minibatch(inputs, targets)
+    ff2.W += ff2.optimizer.compute_update()
+
+    # optionally keep the cached data
+    ff.pickle_cache = True
+    ff3 = pickle.loads(pickle.dumps(ff))
+    assert np.allclose(ff3.activations[-1], ff.activations[-1])
+    assert np.allclose(ff3.best_W, ff.best_W)
+
+
+def test_sparse_connections(use_GPU, tmpdir):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(10, 6)
+    targets = rng.randn(10, 2)
+    patterns = {(0, 1): rng.rand(6, 8) < 0.3, (1, 2): rng.rand(8, 2) < 0.5}
+
+    if use_GPU:
+        with pytest.raises(ValueError):
+            hf.FFNet([6, 8, 2], use_GPU=True, conn_types=dict(
+                (c, hf.connections.Sparse(p)) for c, p in patterns.items()))
+        return
+
+    sparse = hf.FFNet([6, 8, 2], layers=hf.nl.Tanh(), debug=True, rng=rng,
+                      conn_types=dict((c, hf.connections.Sparse(p))
+                                      for c, p in patterns.items()))
+    dense = hf.FFNet([6, 8, 2], layers=hf.nl.Tanh(), debug=True)
+    assert len(sparse.W) == sum(np.sum(p) + p.shape[1]
+                                for p in patterns.values())
+
+    # equivalent dense network, with the missing connections set to zero
+    def to_dense(params):
+        out = np.zeros(len(dense.W))
+        for c, p in patterns.items():
+            W, b = sparse.get_weights(params, c)
+            W_d, b_d = dense.get_weights(out, c)
+            W_d[...] = W.toarray()
+            b_d[...] = b
+        return out
+    dense.W = to_dense(sparse.W)
+
+    assert np.allclose(sparse.forward(inputs)[-1], dense.forward(inputs)[-1])
+
+    sparse.cache_minibatch(inputs, targets)
+    dense.cache_minibatch(inputs, targets)
+    assert np.allclose(to_dense(sparse.calc_grad()),
+                       dense.calc_grad() * (to_dense(np.ones_like(sparse.W))
+                                            > 0))
+    sparse.check_grad(sparse.calc_grad())
+
+    v = rng.randn(len(sparse.W))
+    assert np.allclose(to_dense(sparse.calc_G(v)),
+                       dense.calc_G(to_dense(v)) *
+                       (to_dense(np.ones_like(sparse.W)) > 0))
+
+    # training
+    sparse.run_epochs(inputs, targets,
+                      optimizer=hf.opt.HessianFree(CG_iter=20),
+                      max_epochs=5, print_period=None)
+    assert sparse.loss.batch_loss(sparse.forward(inputs), targets) < \
+        dense.loss.batch_loss(dense.forward(inputs), targets)
+
+    # inference and saving
+    assert np.allclose(sparse.export_predictor()(inputs),
+                       sparse.forward(inputs)[-1])
+    filename = str(tmpdir.join("model.hf"))
+    hf.fileio.save_model(sparse, filename)
+    sparse2 = hf.fileio.load_model(filename)
+    assert np.allclose(sparse2.forward(inputs)[-1],
+                       sparse.forward(inputs)[-1])
+    sparse3 = pickle.loads(pickle.dumps(sparse))
+    assert np.allclose(sparse3.forward(inputs)[-1],
+                       sparse.forward(inputs)[-1])
+
+
+def test_structured_init(use_GPU):
+    rng = np.random.RandomState(0)
+    x = rng.randn(200, 400)
+
+    # high fan-in sparse pattern (~200 inputs per unit); the input variance
+    # should match the sparse initialization of dense connections (15 inputs)
+    conn = hf.connections.Sparse(rng.rand(400, 50) < 0.5)
+    W = conn.reshape(conn.init_weights(rng, 400, 50), 400, 50)
+    assert np.allclose(np.std(conn.dot(x, W)), np.sqrt(15), rtol=0.2)
+
+    # convolution with a large kernel (fan-in 4 * 5 * 5 = 100)
+    conn = hf.connections.Conv2D((4, 10, 10), (3, 5, 5))
+    n_post = int(np.prod(conn.out_shape))
+    W = conn.reshape(conn.init_weights(rng, 400, n_post), 400, n_post)
+    assert np.allclose(np.std(conn.dot(x, W)), 1, rtol=0.2)
+
+
+def test_sparse_inputs(use_GPU):
+    scipy_sparse = pytest.importorskip("scipy.sparse")
+
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(20, 50) * (rng.rand(20, 50) < 0.05)
+    targets = rng.randn(20, 2)
+    sparse_inputs = scipy_sparse.csr_matrix(inputs)
+
+    ff = hf.FFNet([50, 10, 2], conns={0: [1, 2], 1: [2]}, dtype=np.float64,
+                  use_GPU=use_GPU, rng=rng)
+
+    if use_GPU:
+        with pytest.raises(TypeError):
+            ff.cache_minibatch(sparse_inputs, targets)
+        return
+
+    assert np.allclose(ff.forward(sparse_inputs)[-1],
+                       ff.forward(inputs)[-1])
+
+    ff.cache_minibatch(inputs, targets)
+    grad = ff.calc_grad()
+    v = rng.randn(len(ff.W))
+    G = ff.calc_G(v)
+
+    ff.cache_minibatch(sparse_inputs, targets)
+    assert scipy_sparse.issparse(ff.inputs)
+    assert ff.tmp_space[0] is None
+    assert np.allclose(ff.calc_grad(), grad)
+    assert np.allclose(ff.calc_G(v), G)
+
+    # structured connections
+    ff2 = hf.FFNet([50, 10, 2], dtype=np.float64, conn_types={
+        (0, 1): hf.connections.Sparse(rng.rand(50, 10) < 0.2)})
+    ff2.cache_minibatch(inputs, targets)
+    grad = ff2.calc_grad()
+    G = ff2.calc_G(v[:len(ff2.W)])
+    ff2.cache_minibatch(sparse_inputs, targets)
+    assert np.allclose(ff2.calc_grad(), grad)
+    assert np.allclose(ff2.calc_G(v[:len(ff2.W)]), G)
+
+    # training
+    ff.run_epochs(sparse_inputs, targets, minibatch_size=10,
+                  optimizer=hf.opt.HessianFree(CG_iter=10), max_epochs=5,
+                  test=(sparse_inputs, targets), print_period=None)
+    assert np.allclose(ff.export_predictor(max_batch_size=8)(sparse_inputs),
+                       ff.forward(inputs)[-1])
+
+    with pytest.raises(TypeError):
+        hf.FFNet([50, 2], layers=[hf.nl.Tanh(), hf.nl.Tanh()]).forward(
+            sparse_inputs)
+
+
+def test_conv_connections(use_GPU, tmpdir):
+    rng = np.random.RandomState(0)
+
+    # compare to direct computation of the convolution
+    conn = hf.connections.Conv2D((2, 5, 4), (3, 3, 2), stride=2, padding=1)
+    assert conn.out_shape == (3, 3, 3)
+    W = rng.randn(conn.n_weights(40, 27))
+    K = conn.reshape(W, 40, 27)
+    x = rng.randn(3, 40)
+    x_pad = np.pad(x.reshape(3, 2, 5, 4), [(0, 0), (0, 0), (1, 1), (1, 1)],
+                   mode="constant")
+    y = np.zeros((3, 3, 3, 3))
+    for i in range(3):
+        for j in range(3):
+            y[:, :, i, j] = np.einsum(
+                "bcij,fcij->bf", x_pad[:, :, 2 * i:2 * i + 3, 2 * j:2 * j + 2],
+                K)
+    assert np.allclose(conn.dot(x, K), y.reshape(3, 27))
+
+    inputs = rng.randn(10, 12)
+    targets = rng.randn(10, 1)
+    conn_types = {(0, 1): hf.connections.Conv1D((2, 6), (3, 3), padding=1),
+                  (1, 2): hf.connections.Conv1D((3, 6), (1, 5), stride=2)}
+
+    if use_GPU:
+        with pytest.raises(ValueError):
+            hf.FFNet([12, 18, 1], use_GPU=True, conn_types=conn_types)
+        return
+
+    # debug mode checks the gradient and curvature computations
+    ff = hf.FFNet([12, 18, 1], layers=hf.nl.Tanh(), debug=True, rng=rng,
+                  conn_types=conn_types)
+    assert len(ff.W) == 2 * 3 * 3 + 18 + 3 * 5 + 1
+    ff.run_epochs(inputs, targets, optimizer=hf.opt.HessianFree(CG_iter=5),
+                  max_epochs=3, print_period=None)
+
+    assert np.allclose(ff.export_predictor()(inputs), ff.forward(inputs)[-1])
+
+    filename = str(tmpdir.join("model.hf"))
+    hf.fileio.save_model(ff, filename)
+    ff2 = hf.fileio.load_model(filename)
+    assert ff2.conn_types[(0, 1)].padding == 1
+    assert np.allclose(ff2.forward(inputs)[-1], ff.forward(inputs)[-1])
+
+
+def test_plan(use_GPU):
+    ff = hf.FFNet([2, 5, 5, 3, 5, 1], conns={0: [1, 2], 1: [3], 2: [3],
+                                             3: [4], 4: [5]},
+                  use_GPU=use_GPU)
+    plan = ff.plan
+
+    assert plan.stages == ((0,), (1, 2), (3,), (4,), (5,))
+    assert [e.pre for e in plan.in_edges[3]] == [1, 2]
+    assert [e.post for e in plan.out_edges[0]] == [1, 2]
+    assert plan.backward_order == (5, 4, 3, 2, 1, 0)
+
+    # layers 1 and 2 are in the same stage, so they need separate buffers;
+    # layer 4 can reuse one of them
+    assert plan.scratch[1] != plan.scratch[2]
+    assert plan.scratch[4] == plan.scratch[1]
+    assert plan.scratch[0] is None
+
+    W, b = plan.in_edges[3][1].weights(ff.W)
+    W2, b2 = ff.get_weights(ff.W, (2, 3))
+    assert np.all(W == W2) and np.all(b == b2)
+
+    inputs = np.ones((4, 2), dtype=np.float32)
+    ff.cache_minibatch(inputs, np.zeros((4, 1), dtype=np.float32))
+    assert ff.tmp_space[1] is not ff.tmp_space[2]
+    assert ff.tmp_space[4] is ff.tmp_space[1]
+
+
+def test_R_buffers(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(10, 4)
+    targets = rng.randn(10, 2)
+
+    # series network, so only a couple layers are alive at a time
+    ff = hf.FFNet([4, 20, 10, 20, 10, 2], layers=hf.nl.Tanh(), debug=True,
+                  use_GPU=use_GPU, rng=rng)
+    ff.cache_minibatch(inputs, targets)
+    if use_GPU:
+        assert ff.R_activations is None
+        return
+
+    buffers = set(id(a.base) for a in ff.R_activations[1:] +
+                  ff.R_errors[1:])
+    assert len(buffers) <= 3
+    assert ff.R_activations[-1] is ff.R_errors[-1]
+
+    # compare to dense calculation (via finite differences)
+    v = rng.randn(len(ff.W))
+    ff.check_G(ff.calc_G(v), v)
+    Gv = ff.calc_G(v)
+    assert np.allclose(ff.calc_G(v), Gv)
+
+    # graph with a loss on a hidden layer
+    ff = hf.FFNet([4, 5, 5, 2], conns={0: [1, 2], 1: [3], 2: [3]},
+                  layers=hf.nl.Tanh(), debug=True, use_GPU=use_GPU, rng=rng,
+                  loss_type=[hf.loss_funcs.SquaredError(),
+                             hf.loss_funcs.SparseL2(0.1, layers=[1])])
+    ff.cache_minibatch(inputs, targets)
+    assert ff.R_activations[1] is ff.R_errors[1]
+    assert ff.R_activations[1] is not ff.R_activations[2]
+    v = rng.randn(len(ff.W))
+    ff.check_G(ff.calc_G(v), v)
+
+
+def test_threads(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(20, 4)
+    targets = rng.randn(20, 2)
+    conns = {0: [1, 2, 3], 1: [4], 2: [4], 3: [4, 5], 4: [5]}
+
+    nets = [hf.FFNet([4, 8, 8, 6, 5, 2], conns=conns, layers=hf.nl.Tanh(),
+                     debug=True, threads=t, use_GPU=use_GPU,
+                     rng=np.random.RandomState(1)) for t in (None, 3)]
+    assert nets[1].plan.stages[1] == (1, 2, 3)
+
+    v = rng.randn(len(nets[0].W))
+    results = []
+    for ff in nets:
+        ff.cache_minibatch(inputs, targets)
+        results += [(ff.forward(inputs)[-1], ff.calc_grad(), ff.calc_G(v))]
+    for a, b in zip(*results):
+        assert np.allclose(a, b)
+
+    ff = nets[1]
+    ff.run_epochs(inputs, targets, optimizer=hf.opt.HessianFree(CG_iter=5),
+                  max_epochs=2, print_period=None)
+
+    ff2 = pickle.loads(pickle.dumps(ff))
+    assert ff2._thread_pool is None
+    assert np.allclose(ff2.forward(inputs)[-1], ff.forward(inputs)[-1])
+
+    # errors in the worker threads are raised in the calling thread
+    with pytest.raises(ValueError):
+        ff.forward(inputs[:, :3])
+
+
+def test_loss_value(use_GPU):
+    rng = np.random.RandomState(0)
+    activities = [rng.rand(5, 3), rng.rand(5, 4), rng.rand(5, 4, 2)]
+    targets = rng.rand(5, 4, 2)
+    targets[0, 1, 1] = np.nan
+
+    for loss in [hf.loss_funcs.SquaredError(), hf.loss_funcs.CrossEntropy(),
+                 hf.loss_funcs.ClassificationError(),
+                 hf.loss_funcs.SparseL1(0.1),
+                 hf.loss_funcs.SparseL2(0.2, target=0.1),
+                 hf.loss_funcs.StructuralDamping(0.1),
+                 hf.loss_funcs.LossSet([hf.loss_funcs.SquaredError(),
+                                        hf.loss_funcs.SparseL2(0.1)])]:
+        losses = loss.loss(activities, targets)
+        expected = np.sum([np.sum(l) / l.shape[0] for l in losses
+                           if l is not None])
+        assert np.allclose(loss.loss_value(activities, targets), expected)
+        assert np.allclose(loss.batch_loss(activities, targets), expected)
+
+    # precomputed nan information gives the same results
+    t = hf.loss_funcs.Targets(targets)
+    assert np.all(t.valid == ~np.isnan(targets))
+    assert np.all(t.zeroed == np.nan_to_num(targets))
+    for loss in [hf.loss_funcs.SquaredError(), hf.loss_funcs.CrossEntropy(),
+                 hf.loss_funcs.ClassificationError()]:
+        assert np.allclose(loss.loss_value(activities, t),
+                           loss.loss_value(activities, targets))
+        assert np.allclose(loss.loss(activities, t)[-1],
+                           loss.loss(activities, targets)[-1])
+    assert np.allclose(hf.loss_funcs.SquaredError().d_loss(activities, t)[-1],
+                       np.nan_to_num(activities[-1] - targets))
+    assert type(t - 1) is np.ndarray
+    assert hf.loss_funcs.Targets(np.ones(3)).valid is None
+    assert np.all(t[:2].valid == ~np.isnan(targets[:2]))
+    assert t[1:].valid is None
+
+    loss = hf.loss_funcs.LossSet([hf.loss_funcs.SquaredError(),
+                                  hf.loss_funcs.StructuralDamping(0.1)])
+    d2_loss = loss.d2_loss(activities, targets)
+    assert d2_loss[0] is None
+    assert np.allclose(d2_loss[1], 0.1)
+    assert np.allclose(d2_loss[2], 1)
+
+
+def test_constant_d2_loss(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(10, 4)
+    targets = rng.randn(10, 2)
+
+    ff = hf.FFNet([4, 5, 2], layers=hf.nl.Tanh(), debug=True,
+                  use_GPU=use_GPU, rng=rng,
+                  loss_type=[hf.loss_funcs.SquaredError(),
+                             hf.loss_funcs.SparseL2(0.1, layers=[1])])
+    ff.cache_minibatch(inputs, targets)
+
+    # constant curvature isn't expanded into full arrays
+    assert ff.d2_loss[0] is None
+    assert np.ndim(ff.d2_loss[1]) == 0
+    assert np.ndim(ff.d2_loss[2]) == 0
+
+    v = rng.randn(len(ff.W))
+    ff.check_G(ff.calc_G(v), v)
+
+    # weighted squared error (constant, but not 1)
+    ff = hf.FFNet([4, 5, 2], layers=hf.nl.Tanh(), debug=True,
+                  use_GPU=use_GPU, rng=rng,
+                  loss_type=[hf.loss_funcs.SquaredError(),
+                             hf.loss_funcs.SquaredError()])
+    ff.cache_minibatch(inputs, targets)
+    assert ff.d2_loss[2] == 2
+    v = rng.randn(len(ff.W))
+    ff.check_G(ff.calc_G(v), v)
+
+
+def test_precision(use_GPU):
+    rng = np.random.RandomState(0)
+
+    # bfloat16 round trip
+    p = hf.precision.lookup("bfloat16")
+    x = np.concatenate((rng.randn(100).astype(np.float32),
+                        [0, np.inf, -np.inf, np.nan, 1e38]))
+    y = p.decode(p.encode(x), np.float32)
+    assert p.encode(x).dtype == np.uint16
+    assert np.allclose(y, x, rtol=2 ** -8, equal_nan=True)
+    assert np.isnan(y[-2])
+    assert y[-3] == -np.inf
+
+    with pytest.raises(TypeError):
+        hf.precision.lookup("not_a_dtype")
+
+    inputs = rng.randn(10, 4).astype(np.float32)
+    targets = rng.randn(10, 2).astype(np.float32)
+    ff = hf.FFNet([4, 5, 5, 2], layers=hf.nl.Tanh(), use_GPU=use_GPU,
+                  rng=rng)
+    ff2 = hf.FFNet([4, 5, 5, 2], layers=hf.nl.Tanh(), use_GPU=use_GPU,
+                   load_weights=ff.W, d_act_precision="float16",
+                   act_precision=[None, "bfloat16", None, None])
+    ff.cache_minibatch(inputs, targets)
+    ff2.cache_minibatch(inputs, targets)
+
+    assert isinstance(ff2.d_activations[1], hf.precision.CachedArray)
+    assert ff2.d_activations[1].nbytes == ff.d_activations[1].nbytes // 2
+    assert isinstance(ff2.activations[1], hf.precision.CachedArray)
+    assert not isinstance(ff2.activations[2], hf.precision.CachedArray)
+    assert ff2.activations[1][:2].dtype == np.float32
+
+    # computations are upcast to the full precision
+    v = rng.randn(len(ff.W)).astype(np.float32)
+    assert ff2.calc_grad().dtype == np.float32
+    assert np.allclose(ff.calc_grad(), ff2.calc_grad(), atol=1e-2)
+    assert np.allclose(ff.calc_G(v), ff2.calc_G(v), atol=1e-2)
+    assert np.allclose(ff.error(), ff2.error(), atol=1e-2)
+
+    # decoding into an existing array
+    out = np.zeros(x.shape, dtype=np.float32)
+    assert p.decode(p.encode(x), np.float32, out=out) is out
+    assert np.allclose(out, y, equal_nan=True)
+    out = np.zeros(x.shape, dtype=np.float64)
+    assert p.decode(p.encode(x), np.float64, out=out) is out
+    assert np.allclose(out, y, equal_nan=True)
+    c = hf.precision.CachedArray(x[:100], hf.precision.lookup("float16"),
+                                 np.float32)
+    assert c.operand(out=None) is c.data
+
+    # full jacobians (softmax), and debug mode (using a lossless storage
+    # format, so that the results match the finite differences)
+    ff = hf.FFNet([4, 5, 2], layers=[hf.nl.Linear(), hf.nl.Tanh(),
+                                     hf.nl.Softmax()],
+                  loss_type=hf.loss_funcs.CrossEntropy(), debug=True,
+                  use_GPU=use_GPU, rng=rng, d_act_precision="float64",
+                  act_precision="float64")
+    ff.cache_minibatch(inputs, np.abs(targets) / np.sum(np.abs(targets),
+                                                        axis=1)[:, None])
+    assert ff.d_activations[2].ndim == 3
+    v = rng.randn(len(ff.W))
+    ff.check_G(ff.calc_G(v), v)
+    assert isinstance(ff.d_activations[2], hf.precision.CachedArray)
+
+    with pytest.raises(ValueError):
+        hf.FFNet([4, 5, 2], act_precision=["float16", None, None])
+
+
 if __name__ == "__main__":
     pytest.main("-x -v --tb=native test_ffnet.py")
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+import pytest
+
+import hessianfree as hf
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="lazy imports require Python 3.7")
+def test_import_time():
+    # note: run in a subprocess, so that we get a fresh import
+    code = ("import sys, time; import numpy; t = time.time(); "
+            "import hessianfree; print(time.time() - t); "
+            "print(' '.join(sys.modules))")
+    output = subprocess.check_output([sys.executable, "-c", code])
+    import_time, modules = output.decode("utf-8").splitlines()
+
+    assert float(import_time) < 0.5
+
+    modules = modules.split()
+    for m in ("matplotlib", "scipy", "pycuda", "skcuda", "hessianfree.gpu",
+              "hessianfree.demos", "hessianfree.dataplotter"):
+        assert m not in modules
+
+
+def test_lazy_attributes():
+    assert hf.gpu_enabled in (True, False)
+    assert hf.demos.xor is not None
+    assert hf.dataplotter.run is not None
+
+    with pytest.raises(AttributeError):
+        hf.not_a_module
@@ -20,16 +20,16 @@ def test_ff_CG(use_GPU):
                                              ff.calc_grad(), iters=20,
                                              printing=False)
 
-    assert deltas[0][0] == 3
+    assert deltas[0][0] == 2
     assert np.allclose(
         deltas[0][1],
-        [-0.01693734, 0.00465961, 0.00173045, -0.00414165, -0.03843474,
-         0.00636764, 0.01423731, -0.00433618, -0.00335347, 0.00935241,
-         0.01242893, -0.00339621, -0.00137015, 0.00311182, 0.02883433,
-         - 0.00534688, -0.01032545, 0.00328636, 0.00244868, -0.00678817,
-         - 0.02461342, -0.02293827, -0.00737021, -0.01145663, -0.0116213,
-         - 0.03512985, -0.02004906, -0.02885171, -0.01596764, -0.02105034,
-         - 0.03943678], atol=1e-5)
+        [0.00252813, -0.00333714, -0.0015275, 0.0013396, -0.00046738,
+         0.00047843, -0.00258915, 0.00066291, -0.00102459, -0.00175569,
+         - 0.00296475, 0.00419035, 0.00180254, -0.00157197, 0.00061789,
+         - 0.00056574, 0.0032923, -0.00079383, 0.00137162, 0.00209055,
+         - 0.00767122, -0.00975151, -0.00669949, -0.00790964, -0.00506235,
+         - 0.00658473, -0.00532276, -0.0090421, -0.0101886, -0.00887875,
+         - 0.01518495], atol=1e-5)
 
 
 def test_rnn_CG(use_GPU):
@@ -48,23 +48,215 @@ def test_rnn_CG(use_GPU):
     assert deltas[1][0] == 6
     assert np.allclose(
         deltas[1][1],
-        [2.88910931e-03, -1.08404364e-02, 6.17342826e-04,
-         - 1.85968506e-03, 1.71574634e-02, 3.08436429e-04,
-         - 5.35693355e-02, -2.39962409e-03, 5.33994753e-03,
-         3.52956937e-03, 1.83414537e-02, -1.20746918e-01,
-         4.14435379e-03, 5.21760620e-03, 7.41007701e-02,
-         - 2.86964715e-01, -2.21885830e-01, -3.84823292e-01,
-         - 2.63742000e-01, -9.64779630e-02, -4.55241114e-01,
-         9.68043320e-03, -5.81301711e-02, 1.87756377e-03,
-         3.52657953e-05, 3.19301970e-02, 7.79627683e-03,
-         - 4.76030372e-02, 1.58238632e-03, 1.87149423e-03,
-         2.43508108e-02, 1.32407937e-02, -8.43726397e-02,
-         2.58994917e-03, 2.43114564e-03, 4.95423339e-02,
-         1.13963615e-02, -7.54035711e-02, 2.11156602e-03,
-         4.81781084e-03, 4.49908487e-02, 4.63910261e-03,
-         - 3.11208423e-02, 1.24892767e-03, 2.63486174e-03,
-         1.77674163e-02, 1.60023139e-03, -1.40727460e-02,
-         7.28542393e-04, 6.10395044e-04, 1.20819537e-02], atol=1e-5)
+        [0.06803902, 0.0257012, 0.00502353, -0.06662474, 0.00987671,
+         - 0.02339015, -0.02259841, -0.00745942, 0.02483079, -0.00844913,
+         0.14859486, 0.00157796, 0.03280239, -0.0718063, 0.01579403,
+         - 0.18063188, -0.1162356, -0.08427554, -0.24599074, -0.11990599,
+         - 0.43940774, 0.08595565, -0.00019909, 0.01685303, -0.03922736,
+         0.00775958, 0.04612762, -0.00090268, 0.00945404, -0.02161662,
+         0.00427787, 0.04646111, -0.00215594, 0.00793017, -0.01980977,
+         0.00358745, 0.05104098, -0.00151089, 0.01101138, -0.02326087,
+         0.00441748, 0.02719309, -0.00091978, 0.00568528, -0.01257799,
+         0.00242024, 0.01292204, 0.00119561, 0.00352117, -0.00840723,
+         0.00273994], atol=1e-5)
+
+def test_estimate_spectrum(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(100, 1).astype(np.float32)
+    targets = rng.randn(100, 1).astype(np.float32)
+    ff = hf.FFNet([1, 5, 1], debug=True, use_GPU=use_GPU, rng=rng)
+    ff.optimizer = hf.opt.HessianFree()
+    ff.cache_minibatch(inputs, targets)
+
+    # explicitly construct the Gauss-Newton matrix
+    G = np.column_stack([ff.calc_G(v) for v in np.eye(ff.W.size)])
+    eigs = np.linalg.eigvalsh(G)
+
+    # with a full set of iterations the estimate should be exact
+    min_eig, max_eig = ff.optimizer.estimate_spectrum(iters=ff.W.size)
+    assert np.allclose(max_eig, eigs[-1], rtol=1e-4)
+    assert np.allclose(min_eig, eigs[0], atol=1e-6 * eigs[-1])
+
+    # with fewer iterations the extremes should still be bounded
+    min_eig, max_eig = ff.optimizer.estimate_spectrum(iters=5)
+    assert max_eig <= eigs[-1] * (1 + 1e-4)
+    assert min_eig >= eigs[0] - 1e-6 * eigs[-1]
+    assert ff.optimizer.spectrum == (min_eig, max_eig)
+
+
+@pytest.mark.parametrize("solver", [hf.solvers.ConjugateGradient(),
+                                    hf.solvers.RestartedCG(restart=5),
+                                    hf.solvers.MINRES(tol=1e-10)])
+def test_solvers(use_GPU, solver):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(100, 1)
+    targets = rng.randn(100, 1)
+    ff = hf.FFNet([1, 5, 1], debug=False, use_GPU=use_GPU, rng=rng,
+                  dtype=np.float64)
+    ff.optimizer = hf.opt.HessianFree(init_damping=0.1, solver=solver)
+    ff.cache_minibatch(inputs, targets)
+
+    grad = ff.calc_grad()
+    G = np.column_stack([ff.calc_G(v, damping=0.1)
+                         for v in np.eye(ff.W.size)])
+    target = np.linalg.solve(G, -grad)
+
+    deltas = ff.optimizer.conjugate_gradient(np.zeros_like(ff.W), grad,
+                                             iters=200)
+
+    assert [d[0] for d in deltas] == sorted(d[0] for d in deltas)
+    assert np.allclose(deltas[-1][1], target, atol=1e-4)
+
+
+def test_steihaug(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(100, 1)
+    targets = rng.randn(100, 1)
+    ff = hf.FFNet([1, 5, 1], debug=False, use_GPU=use_GPU, rng=rng,
+                  dtype=np.float64)
+    solver = hf.solvers.SteihaugCG(radius=1e-3)
+    ff.optimizer = hf.opt.HessianFree(init_damping=0.1, solver=solver)
+    ff.cache_minibatch(inputs, targets)
+
+    deltas = ff.optimizer.conjugate_gradient(np.zeros_like(ff.W),
+                                             ff.calc_grad(), iters=200)
+
+    assert solver.hit_boundary
+    assert np.allclose(np.linalg.norm(deltas[-1][1]), 1e-3)
+
+    # a large trust region shouldn't affect the solution
+    solver.radius = 1e6
+    deltas2 = ff.optimizer.conjugate_gradient(np.zeros_like(ff.W),
+                                              ff.calc_grad(), iters=200)
+    deltas2 = [(i, d.copy()) for i, d in deltas2]
+    deltas3 = ff.optimizer.solver.solve(np.zeros_like(ff.W), ff.calc_grad(),
+                                        iters=200)
+    assert not solver.hit_boundary
+    assert np.allclose(deltas2[-1][1], deltas3[-1][1])
+    assert np.linalg.norm(deltas2[-1][1]) > 1e-3
+
+    # training with the truncated solver
+    inputs = np.asarray([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float32)
+    targets = np.asarray([[0], [1], [1], [0]], dtype=np.float32)
+    ff = hf.FFNet([2, 5, 1], use_GPU=use_GPU, rng=np.random.RandomState(0))
+    ff.run_epochs(inputs, targets,
+                  optimizer=hf.opt.HessianFree(
+                      CG_iter=10, solver=hf.solvers.SteihaugCG(radius=10)),
+                  max_epochs=40, print_period=None)
+    assert ff.error() < 1e-2
+
+
+@pytest.mark.parametrize("max_snapshots", [None, 3])
+def test_snapshots(use_GPU, max_snapshots, tmpdir):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(100, 1).astype(np.float32)
+    targets = rng.randn(100, 1).astype(np.float32)
+    ff = hf.FFNet([1, 10, 1], use_GPU=use_GPU, rng=rng)
+
+    solver = hf.solvers.ConjugateGradient(
+        max_snapshots=max_snapshots,
+        snapshot_file=str(tmpdir.join("snapshots.dat")))
+    ff.optimizer = hf.opt.HessianFree(init_damping=1e-3, solver=solver)
+    ff.cache_minibatch(inputs, targets)
+    grad = ff.calc_grad()
+
+    deltas = ff.optimizer.conjugate_gradient(np.zeros_like(ff.W), grad,
+                                             iters=50)
+    iters = [d[0] for d in deltas]
+    assert iters == sorted(iters)
+    assert len(deltas) <= solver.n_snapshots(50)
+    if max_snapshots is not None:
+        assert len(deltas) == max_snapshots
+    assert isinstance(solver.snapshots.buffer, np.memmap)
+
+    # the stored deltas should match a separate CG run without snapshot limits
+    ref = hf.solvers.ConjugateGradient()
+    ff.optimizer.solver = ref
+    ref_deltas = dict(
+        (i, d.copy()) for i, d in ff.optimizer.conjugate_gradient(
+            np.zeros_like(ff.W), grad, iters=50))
+    for i, d in deltas:
+        assert np.allclose(d, ref_deltas[i])
+
+    # the buffer gets reused
+    buffer = ref.snapshots.buffer
+    ff.optimizer.conjugate_gradient(np.zeros_like(ff.W), grad, iters=50)
+    assert ref.snapshots.buffer is buffer
+
+    with pytest.raises(ValueError):
+        hf.solvers.ConjugateGradient(max_snapshots=0)
+
+
+def test_trust_region(use_GPU):
+    inputs = np.asarray([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float32)
+    targets = np.asarray([[0], [1], [1], [0]], dtype=np.float32)
+
+    class CountingNet(hf.FFNet):
+        n_errors = 0
+
+        def error(self, *args, **kwargs):
+            self.n_errors += 1
+            return super(CountingNet, self).error(*args, **kwargs)
+
+    ff = CountingNet([2, 5, 1], use_GPU=use_GPU,
+                     rng=np.random.RandomState(0))
+    optimizer = hf.opt.HessianFree(CG_iter=10, trust_region=1.0)
+    assert isinstance(optimizer.solver, hf.solvers.SteihaugCG)
+
+    ff.optimizer = optimizer
+    for _ in range(50):
+        ff.cache_minibatch(inputs, targets)
+        ff.n_errors = 0
+        ff.W += optimizer.compute_update()
+
+        # initial error plus at most tr_evals evaluations of the update
+        assert ff.n_errors <= 1 + optimizer.tr_evals
+
+    assert ff.error() < 1e-2
+    assert len(optimizer.plots["trust radius (log)"]) == 50
+
+
+@pytest.mark.parametrize("backtracking", ["linear", "bisection", "golden"])
+def test_backtracking(use_GPU, backtracking):
+    ff = hf.FFNet([1, 1], use_GPU=use_GPU)
+    ff.optimizer = hf.opt.HessianFree(backtracking=backtracking)
+
+    # fake a unimodal error curve across the stored deltas
+    n = 20
+    curve = (np.arange(n) - 13.0) ** 2
+    deltas = [(i, np.ones_like(ff.W) * i) for i in range(n)]
+    evals = []
+
+    def error(W):
+        i = int(round(W[0] - ff.W[0]))
+        evals.append(i)
+        return curve[i]
+
+    ff.error = error
+
+    j, err, n_evals = ff.optimizer.backtrack(deltas)
+    assert j == 13
+    assert err == 0
+    assert n_evals == len(set(evals))
+    if backtracking == "linear":
+        assert n_evals == n - 13 + 1
+    else:
+        assert n_evals <= 2 * np.ceil(np.log2(n)) + 2
+
+
+def test_auto_damping(use_GPU):
+    inputs = np.asarray([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float32)
+    targets = np.asarray([[0], [1], [1], [0]], dtype=np.float32)
+
+    ff = hf.FFNet([2, 5, 1], use_GPU=use_GPU, rng=np.random.RandomState(0))
+    optimizer = hf.opt.HessianFree(CG_iter=10, init_damping="auto")
+    ff.run_epochs(inputs, targets, optimizer=optimizer, max_epochs=1,
+                  print_period=None)
+
+    min_eig, max_eig = optimizer.spectrum
+    assert 0 < max_eig
+    assert not optimizer.auto_damping
+    assert optimizer.damping != 1.0
 
 if __name__ == "__main__":
     pytest.main("-x -v --tb=native test_optimizers.py")
@@ -230,5 +230,126 @@ def test_truncation(use_GPU):
                    max_epochs=10, print_period=None)
 
 
+def test_predictor(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(20, 7, 2).astype(np.float32)
+
+    rnn = hf.RNNet([2, 5, 4, 3], rec_layers=[1, 2],
+                   layers=[Linear(), Tanh(), Continuous(Logistic(), tau=2),
+                           Linear()],
+                   conns={0: [1, 2], 1: [2], 2: [3]}, use_GPU=use_GPU, rng=rng)
+
+    predictor = rnn.export_predictor(max_batch_size=8)
+    for batch in (inputs[:1], inputs[:8], inputs):
+        assert np.allclose(predictor.predict(batch), rnn.forward(batch)[-1],
+                           atol=1e-6)
+
+
+def test_stream(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(4, 9, 2).astype(np.float32)
+
+    rnn = hf.RNNet([2, 5, 4, 3], rec_layers=[1, 2],
+                   layers=[Linear(), Tanh(), Continuous(Logistic(), tau=2),
+                           Linear()],
+                   use_GPU=use_GPU, rng=rng)
+    outputs = rnn.forward(inputs)[-1]
+
+    stream = rnn.export_predictor().stream(n_streams=4)
+
+    # feed in the signal in pieces of different sizes
+    assert np.allclose(stream.step(inputs[:, 0]), outputs[:, 0], atol=1e-6)
+    assert np.allclose(stream.run(inputs[:, 1:4]), outputs[:, 1:4], atol=1e-6)
+    for s in range(4, 9):
+        assert np.allclose(stream.step(inputs[:, s]), outputs[:, s],
+                           atol=1e-6)
+
+    # continue from a given initial state
+    init_act = [rng.randn(4, l).astype(np.float32) for l in rnn.shape]
+    init_state = [None, None, rng.randn(4, 4).astype(np.float32), None]
+    outputs = rnn.forward(inputs, init_activations=init_act,
+                          init_state=init_state)[-1]
+    stream.reset(init_activations=init_act, init_state=init_state)
+    assert np.allclose(stream.run(inputs), outputs, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        stream.step(inputs[:2, 0])
+
+
+def test_save_model(use_GPU, tmpdir):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(4, 6, 2).astype(np.float32)
+    filename = str(tmpdir.join("model.hf"))
+
+    rnn = hf.RNNet([2, 5, 3], rec_layers=[1], truncation=(2, 3),
+                   layers=[Linear(), Continuous(Tanh(), tau=3, dt=0.5),
+                           Logistic()],
+                   use_GPU=use_GPU, rng=rng, dtype=np.float64)
+    hf.fileio.save_model(rnn, filename)
+
+    rnn2 = hf.fileio.load_model(filename)
+    assert isinstance(rnn2, hf.RNNet)
+    assert rnn2.dtype == np.float64
+    assert list(rnn2.rec_layers) == [1]
+    assert rnn2.truncation == (2, 3)
+    assert rnn2.layers[1].coeff == rnn.layers[1].coeff
+    assert np.allclose(rnn.forward(inputs)[-1], rnn2.forward(inputs)[-1])
+
+
+def test_precision(use_GPU):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(5, 10, 2).astype(np.float32)
+    targets = rng.randn(5, 10, 1).astype(np.float32)
+
+    rnn = hf.RNNet([2, 5, 1], layers=Tanh(), use_GPU=use_GPU, rng=rng)
+    rnn2 = hf.RNNet([2, 5, 1], layers=Tanh(), use_GPU=use_GPU,
+                    load_weights=rnn.W, d_act_precision="bfloat16",
+                    act_precision="float16")
+    rnn.cache_minibatch(inputs, targets)
+    rnn2.cache_minibatch(inputs, targets)
+
+    assert isinstance(rnn2.d_activations[1], hf.precision.CachedArray)
+    assert rnn2.d_activations[1][:, 0].shape == (5, 5)
+
+    v = rng.randn(len(rnn.W)).astype(np.float32)
+    assert np.allclose(rnn.calc_grad(), rnn2.calc_grad(), rtol=1e-2,
+                       atol=1e-2)
+    assert np.allclose(rnn.calc_G(v), rnn2.calc_G(v), rtol=1e-2, atol=1e-2)
+
+
+def test_targets_slices(use_GPU, monkeypatch):
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(5, 10, 2).astype(np.float32)
+    targets = rng.randn(5, 10, 1).astype(np.float32)
+    targets[::2, 3:7] = np.nan
+
+    rnn = hf.RNNet([2, 5, 1], layers=Tanh(), use_GPU=use_GPU, rng=rng)
+    rnn.cache_minibatch(inputs, targets)
+
+    # the nan information is only computed once per minibatch (not for
+    # every timestep)
+    calls = []
+    nan_info = hf.loss_funcs._nan_info
+
+    def counted_nan_info(x):
+        calls.append(x.shape)
+        return nan_info(x)
+
+    monkeypatch.setattr(hf.loss_funcs, "_nan_info", counted_nan_info)
+    grad = rnn.calc_grad()
+    rnn.calc_G(rng.randn(len(rnn.W)).astype(np.float32))
+    assert calls == []
+
+    # slices give the same results as computing the info from scratch
+    t = rnn.targets[:, 4]
+    assert np.all(t.zeroed == np.nan_to_num(targets[:, 4]))
+    assert np.all(t.valid == ~np.isnan(targets[:, 4]))
+    assert rnn.targets[1:2, 4].valid is None
+
+    monkeypatch.undo()
+    rnn.targets = np.asarray(rnn.targets)
+    assert np.allclose(rnn.calc_grad(), grad)
+
+
 if __name__ == "__main__":
     pytest.main("-x -v --tb=native test_rnnet.py")